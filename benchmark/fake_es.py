@@ -0,0 +1,704 @@
+# coding: utf-8
+'''
+@message: 模拟Elasticsearch, 只实现esTools用到的接口
+          可配置index数量、请求延迟与快照耗时, 统计请求数与传输字节
+'''
+import json
+import threading
+import time
+import zlib
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from fnmatch import fnmatchcase
+from urlparse import urlparse, parse_qs
+
+DAY_MS = 86400000
+
+
+def filter_path(data, expr):
+    '''
+    @description: 按filter_path过滤返回, 支持*通配
+    '''
+    if not expr:
+        return data
+    patterns = [_.split(".") for _ in expr.split(",")]
+
+    def _filter(value, patterns):
+        if any(not _ for _ in patterns):
+            return value
+        if isinstance(value, list):
+            value = [_filter(_, patterns) for _ in value]
+            return [_ for _ in value if _ not in (None, {})] or None
+        if not isinstance(value, dict):
+            return None
+        result = {}
+        for k, v in value.items():
+            sub = [_[1:] for _ in patterns if fnmatchcase(k, _[0])]
+            if sub:
+                v = _filter(v, sub)
+                if v not in (None, {}):
+                    result[k] = v
+        return result
+
+    return _filter(data, patterns) or {}
+
+
+class FakeCluster:
+    '''
+    @description: 集群数据
+    @param {int}    indices           index数量
+    @param {int}    families          index前缀数量, 每个前缀每天一个index
+    @param {float}  snapshot_seconds  每个快照的执行时间
+    @param {string} version           ES版本号
+    '''
+
+    def __init__(self,
+                 indices=1000,
+                 families=10,
+                 snapshot_seconds=1.0,
+                 version="7.10.2",
+                 shards=1):
+        self.version = version
+        self.snapshot_seconds = snapshot_seconds
+        self.lock = threading.Lock()
+        self.indices = {}
+        self.repositories = {}
+        self.pending_tasks = 0
+        self.merge_seconds = 0.0
+        # 恢复中的index与开始时间
+        self.restores = {}
+        # 依次返回的错误状态码, 用于测试重试
+        self.failures = []
+        # 恢复失败的index, 主分片分配失败
+        self.restore_failures = set()
+        # 共享该集群的服务地址, 用于sniff
+        self.addresses = []
+
+        now = int(time.time() * 1000)
+        days = max(1, indices // families)
+        for i in range(indices):
+            family, day = i % families, i // families
+            created = now - (days - day) * DAY_MS
+            name = "logstash-family{:03d}-{}".format(
+                family, time.strftime("%Y.%m.%d", time.localtime(created / 1000)))
+            self.indices[name] = {
+                "uuid": "uuid{:08d}".format(i),
+                "creation_date": str(created),
+                "state": "open",
+                "aliases": set(["logstash-family{:03d}".format(family)])
+                if days - day <= 7 else set(),
+                "blocks": {"write": "true"} if i % 17 == 0 else {},
+                "frozen": i % 31 == 0,
+                "size": 1024 * 1024 * (1 + i % 50),
+                "docs": 1000 * (1 + i % 50),
+                "shards": shards,
+                "replicas": 1,
+                "segments": 1 if i % 3 == 0 else 8,
+                # 其他修改过的配置, 点分隔的key
+                "settings": {},
+                "node": "node-{}".format(i % 3),
+            }
+
+    def resolve(self, expr, expand=None):
+        '''
+        @description: 解析index表达式(逗号、通配符、别名), expand为通配符匹配的index状态
+        '''
+        result = set()
+        states = ["open", "closed"] if expand in [None, "all"] else \
+            expand.split(",")
+        for _ in expr.split(","):
+            if _ in ["_all", ""]:
+                _ = "*"
+            if _ in self.indices:
+                result.add(_)
+                continue
+            for name, meta in self.indices.items():
+                if meta["state"] not in states:
+                    continue
+                if fnmatchcase(name, _) or any(
+                        fnmatchcase(a, _) for a in meta["aliases"]):
+                    result.add(name)
+        return sorted(result)
+
+    def index_settings(self, name):
+        meta = self.indices[name]
+        settings = {
+            "creation_date": meta["creation_date"],
+            "uuid": meta["uuid"],
+            "number_of_shards": str(meta["shards"]),
+            "number_of_replicas": str(meta["replicas"]),
+            "provided_name": name,
+            "version": {"created": "7100299"},
+        }
+        if meta["blocks"]:
+            settings["blocks"] = meta["blocks"]
+        if meta["frozen"]:
+            settings["frozen"] = "true"
+        for key, value in meta["settings"].items():
+            parent = settings
+            parts = key.split(".")
+            for _ in parts[:-1]:
+                parent = parent.setdefault(_, {})
+            parent[parts[-1]] = value
+        return {"index": settings}
+
+    def version_info(self):
+        return tuple(int(_) for _ in self.version.split(".")[:2])
+
+    def restore(self, repository, name, body):
+        '''
+        @description: 从快照恢复, 按index名与rename参数新建index
+        '''
+        import re
+        snapshot = self.repositories[repository]["snapshots"][name]
+        indices = snapshot["indices"]
+        if body.get("indices"):
+            patterns = body["indices"].split(",")
+            indices = [
+                _ for _ in indices if any(fnmatchcase(_, p) for p in patterns)
+            ]
+        targets = {}
+        for _ in indices:
+            target = _
+            if body.get("rename_pattern"):
+                target = re.sub(
+                    body["rename_pattern"],
+                    re.sub(r"\$(\d+)", r"\\g<\1>",
+                           body.get("rename_replacement", "")), _)
+            targets[target] = _
+        with self.lock:
+            exists = [_ for _ in targets if _ in self.indices]
+            if exists:
+                return 500, {
+                    "error": {
+                        "type": "snapshot_restore_exception",
+                        "reason": "index [{}] already exists".format(exists[0])
+                    },
+                    "status": 500
+                }
+            for target, source in targets.items():
+                meta = dict(self.indices.get(source) or {})
+                meta.update({"aliases": set(), "blocks": {}, "frozen": False})
+                meta.setdefault("size", 1024 * 1024)
+                meta.setdefault("docs", 1000)
+                meta.setdefault("state", "open")
+                meta.setdefault("creation_date", str(int(time.time() * 1000)))
+                meta.setdefault("uuid", "restored-{}".format(target))
+                meta.setdefault("replicas", 1)
+                meta.setdefault("segments", 1)
+                meta.setdefault("node", "node-0")
+                self.indices[target] = meta
+                self.restores[target] = time.time()
+        return 200, {"accepted": True}
+
+    def restore_ratio(self, name):
+        if name not in self.restores:
+            return 1.0
+        elapsed = time.time() - self.restores[name]
+        return min(elapsed / max(self.snapshot_seconds, 0.001), 1.0)
+
+    def restore_done(self, name):
+        return name not in self.restore_failures and self.restore_ratio(
+            name) >= 1.0
+
+    def shard_rows(self, names):
+        '''
+        @description: 分片列表, 恢复中主分片为INITIALIZING, 副本未分配
+        '''
+        for name in names:
+            meta = self.indices[name]
+            restoring = not self.restore_done(name)
+            for shard in range(meta["shards"]):
+                for copy in range(1 + meta["replicas"]):
+                    row = {
+                        "index": name,
+                        "shard": shard,
+                        "prirep": "p" if copy == 0 else "r",
+                        "state": "STARTED",
+                        "docs": meta["docs"] // meta["shards"],
+                        "store": meta["size"] // meta["shards"],
+                        "node": "node-{}".format(
+                            (int(meta["node"][5:]) + shard + copy) % 3),
+                        "unassigned.reason": "",
+                    }
+                    if name in self.restore_failures and copy == 0:
+                        row.update(state="UNASSIGNED", docs="", store="",
+                                   node="")
+                        row["unassigned.reason"] = "ALLOCATION_FAILED"
+                    elif restoring and copy == 0:
+                        row.update(state="INITIALIZING", docs="", store="")
+                    elif restoring or (copy and copy == meta["replicas"] and
+                                       meta["frozen"]):
+                        # 每个frozen index的最后一个副本未分配
+                        row.update(state="UNASSIGNED", docs="", store="",
+                                   node="")
+                        row["unassigned.reason"] = "NEW_INDEX_RESTORED" \
+                            if restoring else "NODE_LEFT"
+                    yield row
+
+    def unassigned_shards(self, name):
+        return len([
+            _ for _ in self.shard_rows([name]) if _["state"] == "UNASSIGNED"
+        ])
+
+    def snapshot_status(self, repository, name):
+        snapshot = self.repositories[repository]["snapshots"][name]
+        elapsed = time.time() - snapshot["start"]
+        done = min(elapsed / max(self.snapshot_seconds, 0.001), 1.0)
+        total = sum(self.indices.get(_, {}).get("size", 0)
+                    for _ in snapshot["indices"])
+        return {
+            "snapshot": name,
+            "repository": repository,
+            "state": "SUCCESS" if done >= 1 else "STARTED",
+            "shards_stats": {
+                "done": int(len(snapshot["indices"]) * done),
+                "total": len(snapshot["indices"]),
+            },
+            "stats": {
+                "incremental": {"size_in_bytes": total},
+                "processed": {"size_in_bytes": int(total * done)},
+                "total": {"size_in_bytes": total},
+            },
+            "indices": {},
+        }
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    # 响应头与响应体一起发送, 避免Nagle算法带来的延迟
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self):
+        server = self.server
+        length = int(self.headers.getheader("content-length") or 0)
+        body = self.rfile.read(length) if length else ""
+        bytes_in = len(body)
+        if body and self.headers.getheader("content-encoding") == "gzip":
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        url = urlparse(self.path)
+        params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        parts = [_ for _ in url.path.split("/") if _]
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        with server.cluster.lock:
+            failure = server.cluster.failures.pop(
+                0) if server.cluster.failures else None
+        try:
+            if failure:
+                status, data = failure, {
+                    "error": {"type": "injected_failure",
+                              "reason": "injected {}".format(failure)},
+                    "status": failure
+                }
+            else:
+                status, data = self.route(self.command, parts, params,
+                                          json.loads(body) if body else None)
+        except KeyError as e:
+            status, data = 404, {
+                "error": {"type": "resource_not_found_exception",
+                          "reason": str(e)},
+                "status": 404
+            }
+        if isinstance(data, dict) and params.get("filter_path"):
+            data = filter_path(data, params["filter_path"])
+        payload = data if isinstance(data, str) else json.dumps(data)
+
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain" if isinstance(
+            data, str) else "application/json")
+        if "gzip" in (self.headers.getheader("accept-encoding") or ""):
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            payload = compressor.compress(payload) + compressor.flush()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+        server.record(self.command, parts, len(self.path) + bytes_in,
+                      len(payload))
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _handle
+
+    def route(self, method, parts, params, body):
+        cluster = self.server.cluster
+        if not parts:
+            return 200, {
+                "cluster_name": "fake",
+                "cluster_uuid": "fake-uuid",
+                "version": {"number": cluster.version}
+            }
+
+        if parts[0] == "_cluster":
+            if parts[1] == "state":
+                return 200, {
+                    "metadata": {
+                        "indices": {
+                            name: {
+                                "state": meta["state"],
+                                "aliases": sorted(meta["aliases"]),
+                                "settings": cluster.index_settings(name)
+                            }
+                            for name, meta in cluster.indices.items()
+                        }
+                    }
+                }
+            if parts[1] == "health":
+                result = {
+                    "cluster_name": "fake",
+                    "status": "green",
+                    "number_of_pending_tasks": cluster.pending_tasks,
+                    "task_max_waiting_in_queue_millis": 0
+                }
+                if len(parts) > 2 and params.get("level") == "indices":
+                    result["indices"] = {
+                        name: {
+                            "status":
+                            "green" if cluster.restore_done(name) else "red",
+                            "unassigned_shards": cluster.unassigned_shards(name)
+                        }
+                        for name in cluster.resolve(parts[2])
+                    }
+                return 200, result
+            if parts[1] == "settings":
+                return 200, {"persistent": {}, "transient": {}, "defaults": {}}
+
+        if parts[0] == "_nodes" and "http" in parts:
+            return 200, {
+                "nodes": {
+                    "node-{}".format(i): {
+                        "name": "node-{}".format(i),
+                        "roles": ["master", "data"],
+                        "http": {"publish_address": address}
+                    }
+                    for i, address in enumerate(cluster.addresses)
+                }
+            }
+
+        if parts[0] == "_nodes" and "stats" in parts:
+            return 200, {
+                "nodes": {
+                    "node-0": {"jvm": {"mem": {"heap_used_percent": 40}}}
+                }
+            }
+
+        if parts[0] == "_cat" and parts[1] == "snapshots":
+            snapshots = cluster.repositories[parts[2]]["snapshots"]
+            return 200, [{
+                "id": name,
+                "status": cluster.snapshot_status(parts[2], name)["state"],
+                "start_epoch": str(int(snapshots[name]["start"]))
+            } for name in sorted(snapshots)]
+
+        if len(parts) > 1 and parts[1] == "_recovery":
+            return 200, {
+                name: {
+                    "shards": [{
+                        "type": "SNAPSHOT",
+                        "stage":
+                        "DONE" if cluster.restore_done(name) else "INDEX",
+                        "index": {
+                            "size": {
+                                "total_in_bytes":
+                                cluster.indices[name]["size"],
+                                "recovered_in_bytes":
+                                int(cluster.indices[name]["size"] *
+                                    cluster.restore_ratio(name))
+                            }
+                        }
+                    }]
+                }
+                for name in cluster.resolve(parts[0])
+                if name in cluster.restores
+            }
+
+        if parts[0] == "_cat" and parts[1] == "indices" and params.get(
+                "format") != "json":
+            # h=index,pri,rep,docs.count,pri.store.size,store.size
+            return 200, "".join(
+                "{} {} {} {} {} {}\n".format(
+                    name, meta["shards"], meta["replicas"], meta["docs"],
+                    meta["size"], meta["size"] * (1 + meta["replicas"]))
+                for name, meta in sorted(cluster.indices.items())
+                if len(parts) < 3 or name in cluster.resolve(parts[2]))
+
+        if parts[0] == "_cat" and parts[1] == "shards":
+            # 没有值的列为空, 与ES一致
+            columns = params.get("h", "index,shard,prirep,state,docs,store,"
+                                 "node").split(",")
+            names = cluster.resolve(parts[2]) if len(parts) > 2 else sorted(
+                cluster.indices)
+            return 200, "".join(
+                " ".join(str(row.get(_, "")) for _ in columns) + "\n"
+                for row in cluster.shard_rows(names))
+
+        if parts[0] == "_cat" and parts[1] == "indices":
+            return 200, [{
+                "index": name,
+                "store.size": str(meta["size"]),
+                "docs.count": str(meta["docs"])
+            } for name, meta in sorted(cluster.indices.items())]
+
+        if parts[0] == "_aliases" and method == "POST":
+            with cluster.lock:
+                for action in body["actions"]:
+                    for kind, value in action.items():
+                        names = value.get("indices") or [value["index"]]
+                        for name in cluster.resolve(",".join(names)):
+                            if kind == "add":
+                                cluster.indices[name]["aliases"].add(
+                                    value["alias"])
+                            elif kind == "remove":
+                                cluster.indices[name]["aliases"].discard(
+                                    value["alias"])
+            return 200, {"acknowledged": True}
+
+        if parts[0] == "_snapshot":
+            return self.route_snapshot(method, parts[1:], params, body)
+
+        if parts[0] == "_alias" or (len(parts) > 1 and parts[1] == "_alias"):
+            names = cluster.resolve(parts[0] if parts[0] != "_alias" else "*")
+            if not names:
+                raise KeyError(parts[0])
+            return 200, {
+                name: {
+                    "aliases":
+                    {a: {}
+                     for a in cluster.indices[name]["aliases"]}
+                }
+                for name in names
+            }
+
+        if len(parts) > 1 and parts[1] == "_stats":
+            return 200, {
+                "indices": {
+                    name: {
+                        "uuid": cluster.indices[name]["uuid"],
+                        "primaries": {
+                            "docs": {
+                                "count": cluster.indices[name]["docs"],
+                                "deleted": 0
+                            }
+                        },
+                        "shards": {
+                            "0": [{
+                                "routing": {
+                                    "primary": True,
+                                    "node": cluster.indices[name]["node"]
+                                },
+                                "segments": {
+                                    "count": cluster.indices[name]["segments"]
+                                },
+                                "seq_no": {
+                                    "max_seq_no":
+                                    cluster.indices[name]["docs"] - 1
+                                }
+                            }]
+                        }
+                    }
+                    for name in cluster.resolve(parts[0])
+                }
+            }
+
+        if len(parts) > 1 and parts[1] == "_settings" and method == "PUT":
+            with cluster.lock:
+                for name in cluster.resolve(parts[0],
+                                            params.get("expand_wildcards")):
+                    meta = cluster.indices[name]
+                    for key, value in body.items():
+                        key = key[6:] if key.startswith("index.") else key
+                        if key == "number_of_replicas":
+                            meta["replicas"] = value
+                        elif key == "blocks.write":
+                            meta["blocks"] = {"write": "true"} if str(
+                                value).lower() == "true" else {}
+                        elif value is None:
+                            meta["settings"].pop(key, None)
+                        else:
+                            meta["settings"][key] = str(value).lower() \
+                                if isinstance(value, bool) else str(value)
+            return 200, {"acknowledged": True}
+
+        if len(parts) > 1 and parts[1] in ["_freeze", "_unfreeze"]:
+            with cluster.lock:
+                for name in cluster.resolve(parts[0]):
+                    cluster.indices[name]["frozen"] = parts[1] == "_freeze"
+            return 200, {"acknowledged": True, "shards_acknowledged": True}
+
+        if len(parts) > 1 and parts[1] == "_forcemerge":
+            time.sleep(cluster.merge_seconds)
+            with cluster.lock:
+                for name in cluster.resolve(parts[0]):
+                    cluster.indices[name]["segments"] = int(
+                        params.get("max_num_segments", 1))
+            return 200, {"_shards": {"failed": 0}}
+
+        if len(parts) > 1 and parts[1] == "_settings" and method == "GET":
+            return 200, {
+                name: {"settings": cluster.index_settings(name)}
+                for name in cluster.resolve(parts[0],
+                                            params.get("expand_wildcards"))
+            }
+
+        if len(parts) == 1 and method == "DELETE":
+            names = parts[0].split(",")
+            with cluster.lock:
+                missing = [_ for _ in names if _ not in cluster.indices]
+                if missing:
+                    raise KeyError(missing[0])
+                for _ in names:
+                    cluster.indices.pop(_)
+            return 200, {"acknowledged": True}
+
+        raise KeyError("/".join(parts))
+
+    def route_snapshot(self, method, parts, params, body):
+        cluster = self.server.cluster
+        repositories = cluster.repositories
+        if not parts:
+            return 200, {
+                k: {"type": v["type"], "settings": v["settings"]}
+                for k, v in repositories.items()
+            }
+
+        repository = parts[0]
+        if len(parts) == 1:
+            if method == "DELETE":
+                repositories.pop(repository)
+                return 200, {"acknowledged": True}
+            if method in ["PUT", "POST"]:
+                repositories[repository] = {
+                    "type": body.get("type", "fs"),
+                    "settings": body.get("settings", {}),
+                    "snapshots": {}
+                }
+                return 200, {"acknowledged": True}
+            if repository not in repositories:
+                raise KeyError(repository)
+            return 200, {
+                repository: {
+                    "type": repositories[repository]["type"],
+                    "settings": repositories[repository]["settings"]
+                }
+            }
+
+        snapshots = repositories[repository]["snapshots"]
+        if method == "DELETE":
+            names = parts[1].split(",")
+            if len(names) > 1 and cluster.version_info() < (7, 8):
+                return 400, {
+                    "error": {
+                        "type": "invalid_snapshot_name_exception",
+                        "reason": "multiple snapshot names are not supported"
+                    },
+                    "status": 400
+                }
+            for _ in names:
+                snapshots.pop(_)
+            return 200, {"acknowledged": True}
+        if len(parts) > 2 and parts[2] == "_restore":
+            return cluster.restore(repository, parts[1], body or {})
+        if method in ["PUT", "POST"]:
+            if parts[1] in snapshots:
+                return 400, {
+                    "error": {
+                        "type": "invalid_snapshot_name_exception",
+                        "reason": "snapshot with the same name already exists"
+                    },
+                    "status": 400
+                }
+            snapshots[parts[1]] = {
+                "start": time.time(),
+                "indices": cluster.resolve((body or {}).get("indices", "*"))
+            }
+            return 200, {"accepted": True}
+
+        names = [
+            _ for _ in sorted(snapshots)
+            if any(fnmatchcase(_, p) for p in parts[1].split(","))
+        ]
+        if len(parts) > 2 and parts[2] == "_status":
+            return 200, {
+                "snapshots":
+                [cluster.snapshot_status(repository, _) for _ in names]
+            }
+        return 200, {
+            "snapshots": [{
+                "snapshot": _,
+                "state": cluster.snapshot_status(repository, _)["state"],
+                "indices": snapshots[_]["indices"],
+                "start_time_in_millis": int(snapshots[_]["start"] * 1000),
+            } for _ in names]
+        }
+
+
+class FakeServer(ThreadingMixIn, HTTPServer):
+    '''
+    @description: 模拟ES服务, 在后台线程运行
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, cluster, latency=0.0, port=0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), Handler)
+        self.cluster = cluster
+        self.latency = latency
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.server_port)
+
+    def reset_stats(self):
+        self.requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.endpoints = {}
+
+    def record(self, method, parts, bytes_in, bytes_out):
+        endpoint = "{} /{}".format(
+            method, "/".join(_ if _.startswith("_") else "{}" for _ in parts))
+        with self.stats_lock:
+            self.requests += 1
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            self.endpoints[endpoint] = self.endpoints.get(endpoint, 0) + 1
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "endpoints": dict(self.endpoints),
+        }
+
+    def start(self):
+        self.cluster.addresses.append("127.0.0.1:{}".format(
+            self.server_port))
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--indices", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--snapshot-seconds", type=float, default=1.0)
+    parser.add_argument("--port", type=int, default=9200)
+    args = parser.parse_args()
+    server = FakeServer(FakeCluster(args.indices,
+                                    snapshot_seconds=args.snapshot_seconds),
+                        args.latency, args.port)
+    print("fake elasticsearch: {}".format(server.url))
+    server.serve_forever()
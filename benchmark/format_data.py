@@ -0,0 +1,67 @@
+# coding: utf-8
+'''
+@message: Config.format_data 渲染耗时对比(str/literal_eval旧实现 vs Template)
+          python benchmark/format_data.py [index数量]
+'''
+import os
+import sys
+import timeit
+
+from ast import literal_eval
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+from esTools import Config
+
+
+# 旧实现
+def legacy_format_data(source_data, mapping_dict):
+    filter_mapping_key = dict(
+        filter(lambda x: x[0] in str(source_data), mapping_dict.items()))
+    if filter_mapping_key:
+        source_data = str(source_data)
+        source_data = source_data.replace("{", "{{").replace("}", "}}")
+        for _ in filter_mapping_key.keys():
+            source_data = source_data.replace("{{%s}}" % (_), "{%s}" % (_))
+        source_data = source_data.format(**filter_mapping_key)
+        return literal_eval(source_data)
+    else:
+        return source_data
+
+
+BODY = {
+    "indices": "{index}",
+    "include_global_state": False,
+    "ignore_unavailable": True,
+    "metadata": {
+        "taken_by": "esTools",
+        "taken_because": "backup {index} {today}",
+        "tags": ["daily", "{today}", "{index}"],
+    },
+}
+
+
+def main(count):
+    index_list = ["logstash-nginx_access_{:06d}".format(_)
+                  for _ in range(count)]
+    mapping = {"today": "20191001"}
+
+    # 结果一致
+    for index in index_list[:10]:
+        _mapping = dict(mapping, index=index)
+        assert legacy_format_data(BODY, _mapping) == Config.format_data(
+            BODY, _mapping)
+
+    for name, func in [("legacy", legacy_format_data),
+                       ("template", Config.format_data)]:
+        cost = timeit.timeit(
+            lambda: [func(BODY, dict(mapping, index=_)) for _ in index_list],
+            number=3) / 3
+        print("{:<10}{:>8} index  {:8.4f}s  {:8.2f}us/index".format(
+            name, count, cost, cost * 1e6 / count))
+
+
+if __name__ == "__main__":
+    main(COUNT)
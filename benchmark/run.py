@@ -0,0 +1,142 @@
+# coding: utf-8
+'''
+@message: 在模拟ES上运行esTools任务, 记录耗时、请求数、传输字节与内存峰值
+          python benchmark/run.py --indices 1000,10000 --latency 0.002
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+from fake_es import FakeCluster, FakeServer
+
+SCENARIOS = ["delete", "backup", "aliases", "readonly"]
+
+
+def scenario(name, url, options):
+    '''
+    @description: 子进程中执行单个场景, 返回耗时与内存峰值
+    '''
+    import resource
+    from time import time
+
+    sys.path.insert(0, os.path.join(HERE, ".."))
+    import esTools
+
+    es = esTools.Es(url, timeout=60)
+    families = ["logstash-family{:03d}".format(_)
+                for _ in range(options["families"])]
+    settings = {
+        "snapshot": {
+            "repository": "bench",
+            "body": {"type": "fs", "settings": {"location": "/tmp"}}
+        }
+    }
+    playbooks = {
+        "delete": [{
+            "job": "delete",
+            "index": ["{}-".format(_) for _ in families],
+            "save": options["save"],
+            "workers": options["workers"],
+        }],
+        "backup": [{
+            "job": "backup",
+            "index": families,
+            "include_mode": True,
+            "concurrency": options["workers"],
+            "body": {"indices": "{index}", "include_global_state": False},
+        }],
+        "aliases": [{
+            "job": "aliases",
+            "actions": [{"add": {"index": "{}-*".format(_),
+                                 "alias": "{}-all".format(_)}}
+                        for _ in families],
+        }],
+    }
+
+    start = time()
+    if name == "readonly":
+        esTools.Cmd(es, "getReadOnly").run()
+    else:
+        esTools.PlayBook(playbooks[name], settings, es, True).run()
+    return {
+        "wall": time() - start,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def bench(indices, options):
+    '''
+    @description: 每个场景使用新的模拟集群和新的子进程
+    '''
+    result = []
+    for name in options["scenarios"]:
+        server = FakeServer(
+            FakeCluster(indices, options["families"],
+                        options["snapshot_seconds"]),
+            options["latency"]).start()
+        try:
+            output = subprocess.check_output([
+                sys.executable, os.path.abspath(__file__), "--child", name,
+                "--url", server.url, "--options",
+                json.dumps(options)
+            ])
+        finally:
+            server.shutdown()
+            server.server_close()
+        item = json.loads(output.strip().splitlines()[-1])
+        item.update(server.stats())
+        item.update({"scenario": name, "indices": indices})
+        result.append(item)
+        print("{:<10}{:>8} index  {:8.3f}s  {:>6} req  {:>10} B in  "
+              "{:>12} B out  {:>8} KB rss".format(
+                  name, indices, item["wall"], item["requests"],
+                  item["bytes_in"], item["bytes_out"], item["peak_rss_kb"]))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--indices", default="1000,10000",
+                        help="集群index数量, 逗号分隔")
+    parser.add_argument("--families", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="每个请求的延迟秒数")
+    parser.add_argument("--snapshot-seconds", type=float, default=1.0)
+    parser.add_argument("--save", type=int, default=30,
+                        help="delete任务保留天数")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--output", help="结果写入的json文件")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--url", help=argparse.SUPPRESS)
+    parser.add_argument("--options", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(scenario(args.child, args.url,
+                                  json.loads(args.options))))
+        return
+
+    options = {
+        "families": args.families,
+        "latency": args.latency,
+        "snapshot_seconds": args.snapshot_seconds,
+        "save": args.save,
+        "workers": args.workers,
+        "scenarios": args.scenarios.split(","),
+    }
+    result = []
+    for indices in [int(_) for _ in args.indices.split(",")]:
+        result.extend(bench(indices, options))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# coding: utf-8
+'''
+@message: esTools启动耗时, 每次使用新的子进程
+          python benchmark/startup.py [次数]
+'''
+import json
+import os
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, "..")
+COUNT = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+# 子进程中执行, 输出各阶段耗时
+CHILD = '''
+import json, sys, time
+sys.path.insert(0, %r)
+start = time.time()
+import esTools
+imported = time.time()
+modules = len(sys.modules)
+esTools.Es("http://127.0.0.1:9200")
+client = time.time()
+esTools.yaml.safe_load("a: 1")
+loaded = time.time()
+print(json.dumps({
+    "import": imported - start,
+    "modules": modules,
+    "first_client": client - imported,
+    "first_yaml": loaded - client,
+}))
+'''
+
+
+def measure(code):
+    output = subprocess.check_output([sys.executable, "-c", code])
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def cli():
+    '''
+    @description: 命令行启动到解析完参数的耗时
+    '''
+    from time import time
+    start = time()
+    with open(os.devnull, "w") as f:
+        subprocess.call(
+            [sys.executable, os.path.join(ROOT, "esTools.py"), "-h"],
+            stdout=f)
+    return time() - start
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    samples = [measure(CHILD % ROOT) for _ in range(COUNT)]
+    cli_samples = [cli() for _ in range(COUNT)]
+    print("runs: {}".format(COUNT))
+    for key in ["import", "first_client", "first_yaml"]:
+        print("{:<14}{:8.1f} ms".format(
+            key, median([_[key] for _ in samples]) * 1000))
+    print("{:<14}{:8d}".format("modules", samples[0]["modules"]))
+    print("{:<14}{:8.1f} ms".format("cli -h", median(cli_samples) * 1000))
+
+
+if __name__ == "__main__":
+    main()
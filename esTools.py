@@ -7,17 +7,37 @@
 @message: ES操作工具
 '''
 import os
-import yaml
-
-import logging.config
-import argparse
+import re
+import logging
 
 from abc import ABCMeta
 from abc import abstractmethod
 
-from ast import literal_eval
-from elasticsearch import Elasticsearch
-from elasticsearch.exceptions import NotFoundError, TransportError
+from contextlib import contextmanager
+
+
+class _LazyModule:
+    '''
+    @description: 第一次访问属性时才import, 避免import esTools时加载yaml与elasticsearch
+    '''
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def __getattr__(self, attr):
+        module = self.__dict__["_module"]
+        if module is None:
+            from importlib import import_module
+            module = import_module(self.__dict__["_name"])
+            self.__dict__["_module"] = module
+        return getattr(module, attr)
+
+
+yaml = _LazyModule("yaml")
+
+# except子句在异常发生时才取属性, 此时elasticsearch已经加载
+es_exceptions = _LazyModule("elasticsearch.exceptions")
 
 
 # config log level
@@ -51,6 +71,164 @@ def _log_config(level):
     }
 
 
+# 并发引擎: thread/gevent
+_engine = "thread"
+
+
+def use_engine(name="thread"):
+    '''
+    @description: 切换并发引擎, gevent在单个线程内以协程并发所有ES请求
+    @param {string}  name  thread/gevent
+    @return: 实际使用的引擎
+    '''
+    global _engine
+    if name == "gevent":
+        if _optional_import("gevent") is None:
+            logger.error("没有安装gevent, 使用thread引擎")
+            return _engine
+        # socket/threading/time等替换为协程版本, 之后的ES请求、sleep都会让出
+        from gevent import monkey
+        monkey.patch_all()
+    _engine = name
+    return _engine
+
+
+class JobCancelled(BaseException):
+    '''
+    @description: 任务超时被取消, 继承BaseException避免被except Exception吞掉
+    '''
+
+
+# 当前线程所属任务的取消事件、截止时间与集群名, 切换引擎后才创建, gevent下为协程本地
+_job_context = None
+
+
+def _job_local():
+    global _job_context
+    if _job_context is None:
+        from threading import local
+        _job_context = local()
+    return _job_context
+
+
+def _job_remaining():
+    '''
+    @description: 当前任务距超时的秒数, 没有超时限制时为None
+    '''
+    from time import time
+    deadline = getattr(_job_local(), "deadline", None)
+    return None if deadline is None else max(0, deadline - time())
+
+
+def _job_sleep(seconds):
+    '''
+    @description: 调度轮询用的sleep, 所属任务超时被取消时抛出JobCancelled
+    '''
+    from time import sleep
+    cancel = getattr(_job_local(), "cancel", None)
+    if cancel is None:
+        sleep(seconds)
+    elif cancel.wait(seconds) or cancel.is_set():
+        raise JobCancelled()
+
+
+# 有界线程池, workers<=1时顺序执行
+def _thread_map(func, items, workers=1):
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [func(_) for _ in items]
+    # 工作线程继承调用方任务的取消事件; 线程池只传递Exception, 取消时在调用方抛出
+    context = dict(_job_local().__dict__)
+    cancelled = []
+
+    def _call(item):
+        _job_local().__dict__.update(context)
+        try:
+            return func(item)
+        except JobCancelled:
+            cancelled.append(item)
+
+    if _engine == "gevent":
+        from gevent.pool import Pool
+        result = Pool(min(workers, len(items))).map(_call, items)
+    else:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(workers, len(items)))
+        try:
+            result = pool.map(_call, items)
+        finally:
+            pool.close()
+            pool.join()
+    if cancelled:
+        raise JobCancelled()
+    return result
+
+
+# 按URL长度切分index列表, 逗号拼接后不超过max_length
+def _chunk_index_names(names, max_length=4000):
+    batch, length = [], 0
+    for name in names:
+        # 逗号分隔符占一位
+        size = len(name) + (1 if batch else 0)
+        if batch and length + size > max_length:
+            yield batch
+            batch, length = [], 0
+            size = len(name)
+        batch.append(name)
+        length += size
+    if batch:
+        yield batch
+
+
+# 按index表达式匹配名称列表, 支持逗号分隔、通配符与"-"排除
+def _match_names(names, pattern="*"):
+    from fnmatch import fnmatchcase
+    result = set()
+    for expr in pattern.split(","):
+        expr = expr.strip()
+        if not expr:
+            continue
+        exclude = expr.startswith("-") and len(expr) > 1
+        expr = expr[1:] if exclude else expr
+        if expr == "_all":
+            expr = "*"
+        matched = set(_ for _ in names if fnmatchcase(_, expr))
+        if exclude:
+            result -= matched
+        else:
+            result |= matched
+    return sorted(result)
+
+
+# 可选依赖, 不存在时返回None
+def _optional_import(name):
+    try:
+        return __import__(name)
+    except ImportError:
+        return None
+
+
+# 流式解析JSON, 逐个返回prefix下对象的(key, value)
+def _iter_kvitems(stream, prefix=""):
+    from ijson import parse
+    from ijson.common import ObjectBuilder
+    events = parse(stream)
+    for path, event, key in events:
+        if path != prefix or event != "map_key":
+            continue
+        builder = ObjectBuilder()
+        depth = 0
+        for _, value_event, value in events:
+            builder.event(value_event, value)
+            if value_event in ("start_map", "start_array"):
+                depth += 1
+            elif value_event in ("end_map", "end_array"):
+                depth -= 1
+            if depth == 0:
+                break
+        yield key, builder.value
+
+
 # nothing to do
 class QuietLOG:
     @classmethod
@@ -65,41 +243,269 @@ class QuietLOG:
     def error(self, message):
         pass
 
+    @classmethod
+    def warning(self, message):
+        pass
+
+
+# 作为库使用时不输出日志, 由调用方配置logging
+logger = logging.getLogger(__file__)
+logger.addHandler(logging.NullHandler())
 
-# default
-logging.config.dictConfig(_log_config("INFO"))
 
-parser = argparse.ArgumentParser()
-parser.add_argument("mode",
-                    choices=["playbook", "cmd"],
-                    help="选择运行模式: playbook/cmd")
-parser.add_argument("-cmd", metavar="cmd", default="", help='输入操作指令')
-parser.add_argument("-v", default=0, action="count", help="-vv开启DEBUG模式,默认-v")
-parser.add_argument("-c", default="config.yaml", help="指定配置文件,默认config.yaml")
-parser.add_argument("-s", default="http://127.0.0.1:9200", help="指定ES主机")
-parser.add_argument("-q", action="store_true", help="安静模式")
+def _parse_args(argv=None):
+    '''
+    @description: 解析命令行参数
+    @param {list}  argv  参数列表, 默认sys.argv[1:]
+    '''
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode",
+                        choices=["playbook", "cmd", "daemon"],
+                        help="选择运行模式: playbook/cmd/daemon")
+    parser.add_argument("-cmd", metavar="cmd", default="", help='输入操作指令')
+    parser.add_argument("-v", default=0, action="count", help="-vv开启DEBUG模式,默认-v")
+    parser.add_argument("-c",
+                        default=None,
+                        help="指定配置文件,默认config.yaml; cmd模式只在指定时读取")
+    parser.add_argument("-s",
+                        action="append",
+                        help="指定ES主机, 可多次指定以同时操作多个集群")
+    parser.add_argument("-q", action="store_true", help="安静模式")
+    parser.add_argument("-o",
+                        action="append",
+                        metavar="key=value",
+                        help="cmd参数, 可多次指定, 值按yaml解析")
 
-parser.add_argument("--playbook", help="playbook")
-parser.add_argument("--force", action="store_true", help="强制模式")
+    parser.add_argument("--playbook", help="playbook")
+    parser.add_argument("--force", action="store_true", help="强制模式")
+    parser.add_argument("--resume",
+                        action="store_true",
+                        help="跳过上次中断运行中已完成的操作")
+    parser.add_argument("--report", help="多集群模式下汇总结果写入的json文件")
+    parser.add_argument("--metrics-json", help="运行统计写入的json文件")
+    parser.add_argument("--metrics-prom",
+                        help="运行统计写入的Prometheus textfile")
+    parser.add_argument("--engine",
+                        choices=["thread", "gevent"],
+                        default="thread",
+                        help="并发引擎, gevent需要安装gevent")
 
-args = parser.parse_args()
+    return parser.parse_args(argv)
 
-if args.v == 2:
-    logging.config.dictConfig(_log_config("DEBUG"))
 
-logger = logging.getLogger(__file__)
+def _init_logging(verbose=0, quiet=False):
+    '''
+    @description: 命令行运行时配置日志, -vv为DEBUG, -q不输出
+    '''
+    import logging.config
+    global logger
+    logging.config.dictConfig(_log_config("DEBUG" if verbose == 2 else "INFO"))
+    logger = QuietLOG if quiet else logging.getLogger(__file__)
+
+
+class Metrics:
+    '''
+    @description: 统计ES请求、任务、快照、批量删除的次数与耗时, 从进程启动开始累计, 运行结束后导出
+    '''
+
+    def __init__(self):
+        from threading import Lock
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        from time import time
+        # {(名称, 标签): [次数, 总耗时, 最大耗时]}
+        self.data = {}
+        self.start = time()
+
+    def observe(self, metric, seconds, **labels):
+        # 多集群执行时按集群区分
+        cluster = getattr(_job_local(), "cluster", None)
+        if cluster:
+            labels.setdefault("cluster", cluster)
+        key = (metric, tuple(sorted(labels.items())))
+        with self.lock:
+            item = self.data.setdefault(key, [0, 0.0, 0.0])
+            item[0] += 1
+            item[1] += seconds
+            item[2] = max(item[2], seconds)
+
+    @contextmanager
+    def timer(self, metric, **labels):
+        '''
+        @description: 记录代码块耗时, 异常时status为error
+        '''
+        from time import time
+        start = time()
+        status = "success"
+        try:
+            yield
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            self.observe(metric, time() - start, status=status, **labels)
+
+    def summary(self):
+        '''
+        @return: dict
+        '''
+        from time import time
+        with self.lock:
+            data = sorted(self.data.items())
+        return {
+            "start": self.start,
+            "duration": time() - self.start,
+            "metrics": [{
+                "name": name,
+                "labels": dict(labels),
+                "count": count,
+                "sum": total,
+                "max": max_seconds,
+            } for (name, labels), (count, total, max_seconds) in data],
+        }
+
+    def prometheus(self):
+        '''
+        @description: Prometheus textfile格式
+        @return: string
+        '''
+        summary = self.summary()
+        lines = [
+            "# HELP estools_run_start_timestamp_seconds process start time",
+            "# TYPE estools_run_start_timestamp_seconds gauge",
+            "estools_run_start_timestamp_seconds {:.3f}".format(
+                summary["start"]),
+            "# HELP estools_run_duration_seconds run duration in seconds",
+            "# TYPE estools_run_duration_seconds gauge",
+            "estools_run_duration_seconds {:.3f}".format(
+                summary["duration"]),
+        ]
+        names = []
+        for _ in summary["metrics"]:
+            if _["name"] not in names:
+                names.append(_["name"])
+        for name in names:
+            metric = "estools_{}_seconds".format(name)
+            samples = []
+            for _ in summary["metrics"]:
+                if _["name"] != name:
+                    continue
+                labels = ",".join([
+                    '{}="{}"'.format(k,
+                                     str(v).replace("\\", "\\\\").replace(
+                                         '"', '\\"'))
+                    for k, v in sorted(_["labels"].items())
+                ])
+                samples.append((labels, _))
+            # 同一family的样本必须连续, 最大耗时单独作为gauge family
+            lines.append("# HELP {} {} duration in seconds".format(
+                metric, name))
+            lines.append("# TYPE {} summary".format(metric))
+            for labels, _ in samples:
+                lines.append("{}_count{{{}}} {}".format(
+                    metric, labels, _["count"]))
+                lines.append("{}_sum{{{}}} {:.6f}".format(
+                    metric, labels, _["sum"]))
+            lines.append("# HELP {}_max maximum {} duration in seconds".format(
+                metric, name))
+            lines.append("# TYPE {}_max gauge".format(metric))
+            for labels, _ in samples:
+                lines.append("{}_max{{{}}} {:.6f}".format(
+                    metric, labels, _["max"]))
+        return "\n".join(lines) + "\n"
+
+    def export(self, json_path=None, prometheus_path=None):
+        '''
+        @description: 写入json和/或Prometheus textfile, 先写临时文件再替换
+        '''
+        import json
+        for path, content in [
+            (json_path, lambda: json.dumps(self.summary(), indent=2)),
+            (prometheus_path, self.prometheus),
+        ]:
+            if not path:
+                continue
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                f.write(content())
+            os.rename(tmp_path, path)
+            logger.debug("统计数据已写入[{}]".format(path))
+
+
+metrics = Metrics()
+
+
+class Template:
+    '''
+    @description: 模板字符串编译一次后缓存, 渲染时只填充{name}变量
+    '''
+
+    _cache = {}
+    _pattern = re.compile(r"\{([^{}]+)\}")
+
+    def __init__(self, text):
+        # 偶数位为文本, 奇数位为变量名
+        self.parts = self._pattern.split(text)
+
+    @classmethod
+    def compile(cls, text):
+        template = cls._cache.get(text)
+        if template is None:
+            template = cls._cache[text] = cls(text)
+        return template
+
+    def render(self, mapping):
+        '''
+        @description: 渲染字符串, mapping中没有的变量原样保留
+        '''
+        parts = self.parts
+        if len(parts) == 1:
+            return parts[0]
+        result = []
+        for i, part in enumerate(parts):
+            if not i % 2:
+                result.append(part)
+            elif part in mapping:
+                value = mapping[part]
+                result.append(value if isinstance(value, basestring) else str(
+                    value))
+            else:
+                result.append("{%s}" % (part))
+        return "".join(result)
 
-if args.q:
-    logger = QuietLOG
+    @classmethod
+    def render_data(cls, data, mapping):
+        '''
+        @description: 遍历dict/list, 渲染其中的字符串(包括dict的key)
+        '''
+        if isinstance(data, basestring):
+            return cls.compile(data).render(mapping)
+        if isinstance(data, dict):
+            return {
+                cls.render_data(k, mapping): cls.render_data(v, mapping)
+                for k, v in data.items()
+            }
+        if isinstance(data, list):
+            return [cls.render_data(_, mapping) for _ in data]
+        if isinstance(data, tuple):
+            return tuple(cls.render_data(_, mapping) for _ in data)
+        return data
 
 
 class Config:
-    def __init__(self, path):
+    def __init__(self, path, data=None):
+        '''
+        @param {string}  path  配置文件路径
+        @param {dict}    data  已读取的配置内容, 为None时从path读取; 渲染时会被修改
+        '''
         self.path = path
         self.env = {}
 
         # 读取
-        self.data = self.read(self.path)
+        self.data = data if data is not None else self.read(self.path)
 
         # env
         self.__format_env()
@@ -107,19 +513,44 @@ class Config:
     # 用变量渲染self.data
     def __format_env(self):
         '''
-        @description: 处理变量
+        @description: 处理变量, 各变量并发执行, 支持超时与缓存
         '''
         if self.data and self.data.get("env", ""):
             env_dict = self.data["env"]
-            for k, v in env_dict.items():
-                if isinstance(v, dict):
-                    for kt, command in v.items():
-                        if kt == "python":
-                            self.env[k] = self._run_python(command)
-                        elif kt == "shell":
-                            self.env[k] = self._run_shell(command)
-                else:
-                    self.env[k] = [v]
+            options = self.data.pop("env_options", None) or {}
+            workers = int(options.get("workers", 4))
+            timeout = options.get("timeout", 60)
+            ttl = options.get("ttl", 0)
+            cache = EnvCache(options["cache"]) if options.get("cache") else None
+
+            def _resolve(item):
+                k, v = item
+                if not isinstance(v, dict):
+                    return k, [v]
+                value = None
+                for kt, command in v.items():
+                    if kt not in ["python", "shell"]:
+                        continue
+                    _ttl = v.get("ttl", ttl)
+                    value = cache.get(kt, command, _ttl) if cache else None
+                    if value is not None:
+                        logger.debug("env[{}]命中缓存".format(k))
+                        continue
+                    try:
+                        value = self._evaluate(kt, command,
+                                               v.get("timeout", timeout))
+                        if cache and _ttl:
+                            cache.set(kt, command, value)
+                    except Exception as e:
+                        logger.error("run_{} error: {}".format(kt, e))
+                        value = command
+                return k, value
+
+            for k, value in _thread_map(_resolve, env_dict.items(), workers):
+                if value is not None:
+                    self.env[k] = value
+            if cache:
+                cache.save()
             self.data.pop("env")
             self.data = self.format_data(self.data, self.env)
         logger.debug("config env: {}".format(str(self.env)))
@@ -144,454 +575,3938 @@ class Config:
         @param {dict}    mapping_dict渲染数据
         @return: 
         '''
-        filter_mapping_key = dict(
-            filter(lambda x: x[0] in str(source_data), mapping_dict.items()))
-        if filter_mapping_key:
-            source_data = str(source_data)
+        if not mapping_dict:
+            return source_data
+        return Template.render_data(source_data, mapping_dict)
 
-            # 增加双括号
-            source_data = source_data.replace("{", "{{").replace("}", "}}")
+    @classmethod
+    def _evaluate(cls, kind, command, timeout=None):
+        '''
+        @description: 执行变量命令, 失败或超时抛出异常
+        @param {string}  kind     python/shell
+        @param {string}  command  命令
+        @param {int}     timeout  超时秒数, 为空时不限制
+        '''
+        if kind == "shell":
+            return cls._exec_shell(command, timeout)
 
-            # 取消mapping双括号
-            for _ in filter_mapping_key.keys():
-                source_data = source_data.replace("{{%s}}" % (_), "{%s}" % (_))
+        # exec无法中断, 超时后放弃等待
+        from threading import Thread
+        result = {}
 
-            # format mapping
-            source_data = source_data.format(**filter_mapping_key)
-            return literal_eval(source_data)
-        else:
-            return source_data
+        def _target():
+            try:
+                result["value"] = cls._exec_python(command)
+            except Exception as e:
+                result["error"] = e
+
+        thread = Thread(target=_target)
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+        if thread.is_alive():
+            raise RuntimeError("执行超时({}秒): {}".format(timeout, command))
+        if "error" in result:
+            raise result["error"]
+        return result["value"]
+
+    @classmethod
+    def _exec_python(cls, command):
+        code = compile(command, "script", "exec")
+        result = {}
+        exec code in result
+        return result.get("result", "")
+
+    @classmethod
+    def _exec_shell(cls, command, timeout=None):
+        from signal import SIGKILL
+        from string import rstrip
+        from subprocess import Popen, PIPE
+        from threading import Timer
+        # 独立进程组, 超时后连同子进程一起结束
+        process = Popen(command,
+                        shell=True,
+                        stdout=PIPE,
+                        preexec_fn=os.setsid)
+        killed = []
+
+        def _kill():
+            killed.append(True)
+            try:
+                os.killpg(process.pid, SIGKILL)
+            except OSError:
+                pass
+
+        timer = Timer(timeout, _kill) if timeout else None
+        if timer:
+            timer.start()
+        try:
+            output = process.communicate()[0]
+        finally:
+            if timer:
+                timer.cancel()
+        if killed:
+            raise RuntimeError("执行超时({}秒): {}".format(timeout, command))
+        return ''.join(map(rstrip, output.splitlines()))
 
     @classmethod
-    def _run_python(cls, command):
+    def _run_python(cls, command, timeout=None):
         '''
         @description: 执行python代码
         '''
         try:
-            code = compile(command, "script", "exec")
-            result = {}
-            exec code in result
-            return result.get("result", "")
+            return cls._evaluate("python", command, timeout)
         except Exception as e:
             logger.error("run_python error : {}".format(e))
             return command
 
     @classmethod
-    def _run_shell(cls, command):
+    def _run_shell(cls, command, timeout=None):
         '''
         @description: 执行shell脚本
         '''
         try:
-            from os import popen
-            from string import rstrip
-            run_shell = popen(command)
-            return ''.join(map(rstrip, run_shell.readlines()))
+            return cls._evaluate("shell", command, timeout)
         except Exception as e:
             logger.error("run_shell error: {}".format(e))
             return command
 
 
-class Job:
+class EnvCache:
+    '''
+    @description: env执行结果的本地缓存, 按ttl秒过期
+    '''
 
-    __metaclass__ = ABCMeta
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+        self.changed = False
+        if os.path.exists(path):
+            import json
+            try:
+                with open(path, 'r') as f:
+                    self.data = json.load(f)
+            except ValueError as e:
+                logger.warning("env缓存[{}]读取失败: {}".format(path, e))
 
-    def __init__(self, es):
-        self.es = es
+    @classmethod
+    def _key(cls, kind, command):
+        return "{}:{}".format(kind, command)
 
-    def get_index_list(self, index="*"):
+    def get(self, kind, command, ttl):
         '''
-        @description: 获取index列表
+        @return: 缓存值, 不存在或过期返回None
         '''
-        result = self.es.indices.get_alias(index)
-        if result:
-            return [_ for _ in result]
-        return result
+        from time import time
+        if not ttl:
+            return None
+        item = self.data.get(self._key(kind, command))
+        if item and time() - item["time"] < ttl:
+            return item["value"]
+        return None
 
-    def get_job(self, job):
+    def set(self, kind, command, value):
+        from time import time
+        self.data[self._key(kind, command)] = {"value": value, "time": time()}
+        self.changed = True
+
+    def save(self):
         '''
-        description: 获取任务方法
+        @description: 先写临时文件再替换, 避免并发执行时读到半个文件
         '''
-        return getattr(self, "job_{}".format(job), None)
+        import json
+        if not self.changed:
+            return
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f)
+        os.rename(tmp_path, self.path)
+        self.changed = False
 
-    @abstractmethod
-    def run(self):
-        pass
 
+class Throttle:
+    '''
+    @description: 删除、快照、别名等重操作的限速: 令牌桶 + 集群负载反压
+    '''
 
-class PlayBook(Job):
-    def __init__(self, config, settings=None, es=None, force=False):
+    def __init__(self, es, config=None):
+        '''
+        @param {dict}  config  rate: 每秒操作数, 0为不限制
+                               burst: 令牌桶容量
+                               max_pending_tasks: master待处理任务数上限
+                               max_task_wait: 任务最长排队毫秒数上限
+                               max_heap_percent: 节点堆内存使用率上限
+                               check_interval: 集群状态检查间隔秒数
+                               pause: 超过阈值时每次暂停秒数
+                               max_wait: 最长暂停秒数, 超过后继续执行
+        '''
+        from threading import Lock
+        config = config or {}
         self.es = es
-        self.config = config
-        self.force = force
-        self.settings = settings
+        self.rate = float(config.get("rate", 0))
+        self.burst = float(config.get("burst", 1))
+        self.max_pending_tasks = int(config.get("max_pending_tasks", 0))
+        self.max_task_wait = int(config.get("max_task_wait", 0))
+        self.max_heap_percent = int(config.get("max_heap_percent", 0))
+        self.check_interval = float(config.get("check_interval", 5))
+        self.pause = float(config.get("pause", 10))
+        self.max_wait = float(config.get("max_wait", 600))
 
-    def run(self):
-        for _ in self.config:
-            job_type = _["job"]
-            job_function = self.get_job(job_type)
-            if job_function:
-                job_function(_)
+        self.lock = Lock()
+        self.tokens = self.burst
+        self.updated = 0
+        self.checked = 0
+        self.busy = ""
 
-    def get_snapshot(self, repository_name, snapshot_name):
+    def acquire(self, kind=""):
         '''
-        @description: 获取快照
-        @param {string}  repository_name   仓库名
-        @param {string}  snapshot_name     快照名
-        @return: dict
+        @description: 执行操作前调用, 需要时阻塞等待
         '''
-        try:
-            result = self.es.snapshot.get(repository=repository_name,
-                                          snapshot=snapshot_name)
-            logger.debug("获取快照仓库,返回:{}".format(str(result)))
-        except NotFoundError:
-            result = {}
-            logger.debug("获取快照仓库,返回为空")
-        return result
+        self._take_token()
+        self._wait_cluster(kind)
 
-    def get_snapshot_repository(self, repository_name=None):
+    def _take_token(self):
+        from time import time
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time()
+                if self.updated:
+                    self.tokens = min(
+                        self.burst,
+                        self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            _job_sleep(wait)
+
+    def _wait_cluster(self, kind):
+        from time import time
+        if not any([
+                self.max_pending_tasks, self.max_task_wait,
+                self.max_heap_percent
+        ]):
+            return
+        start = time()
+        while True:
+            # 多个线程共用一次检查结果
+            with self.lock:
+                if time() - self.checked >= self.check_interval:
+                    self.busy = self._cluster_busy()
+                    self.checked = time()
+                busy = self.busy
+            if not busy:
+                return
+            if time() - start >= self.max_wait:
+                logger.warning("集群繁忙({})已等待{}秒, 继续执行{}".format(
+                    busy, self.max_wait, kind))
+                return
+            logger.info("集群繁忙({}), 暂停{}秒后执行{}".format(
+                busy, self.pause, kind))
+            _job_sleep(self.pause)
+
+    def _cluster_busy(self):
         '''
-        @description: 获取快照仓库
-        @param {string}  repository_name   仓库名，默认为None
-        @return: dict
+        @description: 检查master任务队列与堆内存
+        @return: 超过阈值的原因, 空字符串表示空闲
         '''
+        reasons = []
         try:
-            result = self.es.snapshot.get_repository(repository_name)
-            logger.debug("获取快照仓库,返回:{}".format(str(result)))
-        except NotFoundError:
-            result = {}
-            logger.debug("获取快照仓库,返回为空")
-        return result
+            if self.max_pending_tasks or self.max_task_wait:
+                health = self.es.cluster.health(filter_path=",".join(
+                    ["number_of_pending_tasks", "task_max_waiting_in_queue_millis"]))
+                pending = health.get("number_of_pending_tasks", 0)
+                wait = health.get("task_max_waiting_in_queue_millis", 0)
+                if self.max_pending_tasks and pending > self.max_pending_tasks:
+                    reasons.append("pending_tasks:{}".format(pending))
+                if self.max_task_wait and wait > self.max_task_wait:
+                    reasons.append("task_wait:{}ms".format(wait))
+            if self.max_heap_percent:
+                stats = self.es.nodes.stats(
+                    metric="jvm",
+                    filter_path="nodes.*.jvm.mem.heap_used_percent")
+                heap = max([
+                    _["jvm"]["mem"]["heap_used_percent"]
+                    for _ in stats.get("nodes", {}).values()
+                ] or [0])
+                if heap > self.max_heap_percent:
+                    reasons.append("heap:{}%".format(heap))
+        except es_exceptions.TransportError as e:
+            logger.warning("获取集群负载失败, 不做限制: {}".format(e))
+        return ", ".join(reasons)
 
-    def watch_snapshot_job(self,
-                           repository_name,
-                           snapshot_name,
-                           sleep_time=10,
-                           stop_state=[
-                               "SUCCESS",
-                           ],
-                           max_watch=999):
-        '''
-        @description: 持续监听snapshot任务状态
+
+class RetryPolicy:
+    '''
+    @description: 指数退避加随机抖动的重试策略, Es的所有请求共用
+    '''
+
+    def __init__(self,
+                 max_retries=3,
+                 backoff=0.5,
+                 max_backoff=30,
+                 retry_on_status=(429, 502, 503, 504),
+                 retry_on_timeout=False):
         '''
-        from time import sleep
-        status = ""
-        while max_watch >= 0:
-            max_watch -= 1
-            status = self.get_snapshot(repository_name,
-                                       snapshot_name)['snapshots'][0]['state']
-            if status in stop_state:
-                return True, status
-            logger.debug("监听快照[{}], 状态:{}".format(snapshot_name, status))
-            sleep(sleep_time)
-
-        logger.warning("监听快照[{}]达到最大值{},返回最后状态{}".format(
-            snapshot_name, max_watch, status))
-        return False, status
-
-    def create_snapshot(self, repository_name, snapshot_name, body):
-        '''
-        @description: 创建快照
-        @param {string}   repository_name  仓库名
-        @param {string}   snapshot_name    快照名
-        @param {string}   body             post_body
-        @return: True/False
+        @param {int}    max_retries       最多重试次数
+        @param {float}  backoff           第一次重试的最长等待秒数, 之后每次翻倍
+        @param {float}  max_backoff       最长等待秒数
+        @param {list}   retry_on_status   重试的HTTP状态码
+        @param {bool}   retry_on_timeout  请求超时是否重试, 非幂等请求超时后可能已执行
         '''
-        _base_num = 0
-        from time import sleep
-        from random import random
-        while True:
-            random_num = "%2f" % (random() + 600 * _base_num)
-            try:
-                result = self.es.snapshot.create(repository_name,
-                                                 snapshot_name, body)
-                if result.get("acknowledged", ""):
-                    logger.debug("创建快照[{}]成功".format(snapshot_name))
-                    _, status = self.watch_snapshot_job(
-                        repository_name, snapshot_name)
-                    return True
-            except NotFoundError as e:
-                logger.error("创建快照[{}]失败,错误信息:{}".format(snapshot_name, e))
-                return False
-            except TransportError as e:
-                is_exits = self.get_snapshot(repository_name, snapshot_name)
-                if is_exits:
-                    logger.debug("快照[{}]已经存在".format(snapshot_name))
-                    _, status = self.watch_snapshot_job(
-                        repository_name, snapshot_name)
-                    return True
-                _base_num += 1
-                logger.warning("创建快照[{}]失败(第{}次尝试,休息{}秒),错误信息:{}".format(
-                    snapshot_name, _base_num + 1, random_num, e))
-                sleep(float(random_num))
-            if _base_num >= 10:
-                logger.error("创建快照[{}]失败!".format(snapshot_name))
-                return False
+        self.max_retries = int(max_retries)
+        self.backoff = float(backoff)
+        self.max_backoff = float(max_backoff)
+        self.retry_on_status = set(int(_) for _ in retry_on_status)
+        self.retry_on_timeout = retry_on_timeout
 
-    def create_snapshot_repository(self, repository_name, body):
+    def delay(self, attempt):
         '''
-        @description: 创建快照仓库
-        @param {string}  repository_name   仓库名
-        @param {dict}    body              参数
-        @return: True/False
+        @description: 第attempt次(从0开始)重试前的等待秒数, 在0到上限之间随机, 避免同时重试
         '''
-        result = self.es.snapshot.create_repository(repository_name, body)
-        if result.get("acknowledged", ""):
-            logger.debug("成功创建仓库名为[{}]的快照, POST参数:{}".format(
-                repository_name, str(body)))
+        from random import uniform
+        return uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def retryable(self, e):
+        if isinstance(e, es_exceptions.ConnectionTimeout):
+            return bool(self.retry_on_timeout)
+        if isinstance(e, es_exceptions.ConnectionError):
             return True
-        logger.debug("创建仓库名为[{}]的快照失败! POST参数:{}".format(
-            repository_name, str(body)))
-        return False
+        return getattr(e, "status_code", None) in self.retry_on_status
 
-    def job_backup(self, config):
+    def call(self, func, *args, **kwargs):
         '''
-        @description: 备份任务  
+        @description: 执行func, 可重试的异常按退避时间等待后重试
         '''
-        snapshot_settings = self.settings["snapshot"]
-        snapshot_repository_name = snapshot_settings["repository"]
-        snapshot_repository_post_body = snapshot_settings["body"]
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except es_exceptions.TransportError as e:
+                if attempt >= self.max_retries or not self.retryable(e):
+                    raise
+                delay = self.delay(attempt)
+                attempt += 1
+                logger.debug("请求失败(第{}次重试,休息{:.2f}秒),错误信息:{}".format(
+                    attempt, delay, e))
+                _job_sleep(delay)
 
-        index_list = config["index"]
-        index_body = config["body"]
 
-        snapshot_name = config.get("snapshot_name", None)
+class Catalog:
+    '''
+    @description: 集群元数据目录, 每次运行只加载一次, 供所有任务本地匹配
+    '''
 
-        include_mode = config.get("include_mode", False)
+    # 只取需要的字段
+    metadata_filter = [
+        "metadata.indices.*.state",
+        "metadata.indices.*.aliases",
+        "metadata.indices.*.settings.index.creation_date",
+        "metadata.indices.*.settings.index.uuid",
+        "metadata.indices.*.settings.index.blocks",
+        "metadata.indices.*.settings.index.number_of_replicas",
+    ]
 
-        self._exe_create_snapshot_job(snapshot_repository_name,
-                                      snapshot_repository_post_body,
-                                      index_list,
-                                      index_body,
-                                      include_mode,
-                                      snapshot_name=snapshot_name)
+    def __init__(self, es):
+        from threading import Lock
+        self.es = es
+        self.indices = None
+        # index大小, 需要时才加载
+        self.index_sizes = None
+        self.lock = Lock()
 
-    def _exe_update_alias_job(self, body):
+    def load(self):
         '''
-        description: 修改别名
+        @description: 从cluster state加载index名、创建时间、blocks、别名
+        @return: Catalog
         '''
-        result = self.es.indices.update_aliases({"actions": body})
-        if result.get("acknowledged", ""):
-            for _ in body:
-                _job_name = None
-                _index = None
-                _alias = None
-                if _.get("remove", ""):
-                    _job_name = "删除"
-                    _index = _["remove"]["index"]
-                    _alias = _["remove"]["alias"]
-                elif _.get("add", ""):
-                    _job_name = "新增"
-                    _index = _["add"]["index"]
-                    _alias = _["add"]["alias"]
-                if all([_job_name, _index, _alias]):
-                    logger.debug("索引[{}]{}别名:{}".format(
-                        _index, _job_name, _alias))
-            logger.info("修改别名成功, POST内容:[{}]".format(str(body)))
-        else:
-            logger.error("修改别名失败, 返回:[{}]".format(str(result)))
+        metadata = self.es.iter_json(
+            "/_cluster/state/metadata",
+            params={"filter_path": ",".join(self.metadata_filter)},
+            prefix="metadata.indices")
+        indices = {}
+        for name, meta in metadata:
+            settings = meta.get("settings", {}).get("index", {})
+            indices[name] = {
+                "state": meta.get("state", "open"),
+                "aliases": list(meta.get("aliases", [])),
+                "creation_date": settings.get("creation_date", ""),
+                "uuid": settings.get("uuid", ""),
+                "blocks": settings.get("blocks", {}),
+                "replicas": settings.get("number_of_replicas", ""),
+            }
 
-    def job_aliases(self, config):
+        self.indices = indices
+        logger.debug("加载集群元数据, 共{}个index".format(len(indices)))
+        return self
+
+    def data(self):
+        # 并发任务只加载一次
+        with self.lock:
+            if self.indices is None:
+                self.load()
+            return self.indices
+
+    def sizes(self):
         '''
-        description: 别名任务
+        @description: index占用空间, 第一次访问时才请求_cat/indices
+        @return: dict {index: 字节数}
         '''
-        actions_body = config.get("actions", "")
-        if actions_body:
-            self._exe_update_alias_job(actions_body)
+        with self.lock:
+            if self.index_sizes is None:
+                self.index_sizes = dict(
+                    (_["index"], int(_["store.size"]))
+                    for _ in self.es.cat.indices(
+                        format="json", h="index,store.size", bytes="b")
+                    if _.get("store.size"))
+            return self.index_sizes
 
-    def job_delete(self, config):
+    def invalidate(self):
         '''
-        @description: 删除任务
+        @description: 集群有新建等变更时清空, 下次访问重新加载
+        '''
+        self.indices = None
+        self.index_sizes = None
+
+    def discard(self, names):
+        '''
+        @description: 删除index后同步移除, 无需重新加载
+        '''
+        with self.lock:
+            if self.indices is not None:
+                # 替换而非原地修改, 不影响其他任务正在遍历的数据
+                indices = dict(self.indices)
+                for _ in names:
+                    indices.pop(_, None)
+                self.indices = indices
+            if self.index_sizes is not None:
+                sizes = dict(self.index_sizes)
+                for _ in names:
+                    sizes.pop(_, None)
+                self.index_sizes = sizes
+
+    def aliases(self):
+        '''
+        @description: 别名与index的映射
+        @return: dict {alias: [index]}
+        '''
+        result = {}
+        for name, meta in self.data().items():
+            for alias in meta["aliases"]:
+                result.setdefault(alias, []).append(name)
+        return result
+
+    def match(self, pattern="*"):
+        '''
+        @description: 本地解析index表达式, 支持逗号分隔、通配符、"-"排除与别名
+        @param {string}  pattern  index表达式
+        @return: list
+        '''
+        from fnmatch import fnmatchcase
+        indices = self.data()
+        aliases = None
+        result = set()
+        for expr in pattern.split(","):
+            expr = expr.strip()
+            if not expr:
+                continue
+            exclude = expr.startswith("-") and len(expr) > 1
+            expr = expr[1:] if exclude else expr
+            if expr == "_all":
+                expr = "*"
+            names = set(_ for _ in indices if fnmatchcase(_, expr))
+            if aliases is None:
+                aliases = self.aliases()
+            for alias, members in aliases.items():
+                if fnmatchcase(alias, expr):
+                    names.update(members)
+            if exclude:
+                result -= names
+            else:
+                result |= names
+        return sorted(result)
+
+    def creation_dates(self, pattern):
+        '''
+        @description: 匹配index的创建时间
+        @return: dict {index: creation_date}
+        '''
+        indices = self.data()
+        return {_: indices[_]["creation_date"] for _ in self.match(pattern)}
+
+
+class BackupState:
+    '''
+    @description: 增量备份状态, 按集群与index uuid记录最后一次成功快照时的变更指纹
+    '''
+
+    def __init__(self, path):
+        import sqlite3
+        from threading import Lock
+        self.path = path
+        self.lock = Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS backup_state (
+            cluster     TEXT NOT NULL,
+            uuid        TEXT NOT NULL,
+            index_name  TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            repository  TEXT NOT NULL,
+            snapshot    TEXT NOT NULL,
+            updated_at  INTEGER NOT NULL,
+            PRIMARY KEY (cluster, uuid))''')
+        self.db.commit()
+
+    def get(self, cluster, uuids):
+        '''
+        @return: dict {uuid: (fingerprint, repository, snapshot)}
+        '''
+        uuids = list(uuids)
+        result = {}
+        with self.lock:
+            # sqlite单条语句变量数有限制
+            for i in range(0, len(uuids), 500):
+                batch = uuids[i:i + 500]
+                rows = self.db.execute(
+                    "SELECT uuid, fingerprint, repository, snapshot "
+                    "FROM backup_state WHERE cluster = ? AND uuid IN ({})".
+                    format(",".join("?" * len(batch))), [cluster] + batch)
+                for uuid, fingerprint, repository, snapshot in rows:
+                    result[uuid] = (fingerprint, repository, snapshot)
+        return result
+
+    def set(self, cluster, rows):
+        '''
+        @param {list}  rows  [(uuid, index名, 指纹, 仓库名, 快照名)]
+        '''
+        from time import time
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO backup_state VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(cluster, ) + tuple(_) + (int(time()), ) for _ in rows])
+            self.db.commit()
+
+    def references(self, cluster, uuids=None):
+        '''
+        @description: 增量备份仍依赖的快照, 即index最后一次成功快照
+        @param {set}  uuids  只统计这些index uuid, 为None时统计全部
+        @return: dict {(仓库名, 快照名): [index名]}
+        '''
+        result = {}
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT uuid, index_name, repository, snapshot "
+                "FROM backup_state WHERE cluster = ?", [cluster]).fetchall()
+        for uuid, index_name, repository, snapshot in rows:
+            if uuids is None or uuid in uuids:
+                result.setdefault((repository, snapshot), []).append(index_name)
+        return result
+
+    def discard(self, cluster, repository, snapshots=None):
+        '''
+        @description: 删除指向已删除快照的记录, 对应的index下次按已变更处理
+        @param {list}  snapshots  快照名列表, 为None时删除该仓库的全部记录
+        '''
+        with self.lock:
+            if snapshots is None:
+                self.db.execute(
+                    "DELETE FROM backup_state WHERE cluster = ? AND repository = ?",
+                    [cluster, repository])
+            else:
+                snapshots = list(snapshots)
+                for i in range(0, len(snapshots), 500):
+                    batch = snapshots[i:i + 500]
+                    self.db.execute(
+                        "DELETE FROM backup_state WHERE cluster = ? AND "
+                        "repository = ? AND snapshot IN ({})".format(",".join(
+                            "?" * len(batch))), [cluster, repository] + batch)
+            self.db.commit()
+
+
+class Journal:
+    '''
+    @description: 运行日志, 每完成一项操作追加一行json并fsync, 中断后--resume跳过已完成的操作
+    '''
+
+    def __init__(self, path, resume=False):
+        '''
+        @param {string}  path    日志文件路径
+        @param {bool}    resume  读取已有记录并继续追加, 否则清空
+        '''
+        from threading import Lock
+        self.path = path
+        self.lock = Lock()
+        # {(类型, key): 状态}
+        self.done = {}
+        complete = True
+        if resume and os.path.exists(path):
+            complete = self.load()
+        self.file = open(path, "a" if resume else "w")
+        if not complete:
+            # 中断时写了一半的行单独成行, 不影响之后的记录
+            self.file.write("\n")
+
+    def load(self):
+        '''
+        @description: 读取已有记录
+        @return: 文件是否以换行结尾
+        '''
+        import json
+        line = ""
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue
+                for key in item["keys"]:
+                    self.done[(item["kind"], key)] = item["state"]
+        logger.info("从运行日志[{}]恢复, 已完成{}项".format(self.path,
+                                                  len(self.done)))
+        return not line or line.endswith("\n")
+
+    def get(self, kind, key):
+        return self.done.get((kind, key), None)
+
+    def unfinished(self):
+        '''
+        @description: 未成功结束的快照
+        @return: list
+        '''
+        return sorted(key for (kind, key), state in self.done.items()
+                      if kind == "snapshot" and state != "SUCCESS")
+
+    def record(self, kind, keys, state):
+        '''
+        @description: 记录完成的操作, 写入磁盘后返回
+        @param {string}       kind   类型, 如snapshot/delete/aliases
+        @param {string/list}  keys   操作对象
+        @param {string}       state  状态
+        '''
+        import json
+        from time import time
+        if isinstance(keys, basestring):
+            keys = [keys]
+        if not keys:
+            return
+        line = json.dumps({
+            "time": time(),
+            "kind": kind,
+            "keys": list(keys),
+            "state": state
+        })
+        with self.lock:
+            self.file.write(line + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            for _ in keys:
+                self.done[(kind, _)] = state
+
+    def close(self, remove=False):
+        with self.lock:
+            self.file.close()
+            if remove and os.path.exists(self.path):
+                os.remove(self.path)
+
+
+class IndexTimeline:
+    '''
+    @description: 从index名解析日期并排序, 二分查找过期区间
+    '''
+
+    # 支持的strftime指令
+    directives = {
+        "%Y": r"\d{4}",
+        "%y": r"\d{2}",
+        "%m": r"\d{2}",
+        "%d": r"\d{2}",
+        "%H": r"\d{2}",
+        "%j": r"\d{3}",
+    }
+
+    def __init__(self, names, date_pattern):
+        '''
+        @param {list}    names         index名列表
+        @param {string}  date_pattern  日期格式, 如"%Y.%m.%d", 按UTC解析
+        '''
+        self.date_pattern = date_pattern
+        self.regex = self.compile(date_pattern)
+        items = []
+        for name in names:
+            timestamp = self.parse(name)
+            if timestamp is None:
+                logger.debug("index[{}]名称中没有{}格式的日期, 忽略".format(
+                    name, date_pattern))
+            else:
+                items.append((timestamp, name))
+        items.sort()
+        self.times = [_[0] for _ in items]
+        self.names = [_[1] for _ in items]
+
+    @classmethod
+    def compile(cls, date_pattern):
+        regex = []
+        for part in re.split(r"(%[a-zA-Z])", date_pattern):
+            if part in cls.directives:
+                regex.append(cls.directives[part])
+            elif part.startswith("%") and len(part) == 2:
+                raise ValueError("date_pattern不支持{}".format(part))
+            else:
+                regex.append(re.escape(part))
+        return re.compile("".join(regex))
+
+    def parse(self, name):
+        '''
+        @description: 取名称中最后一个日期
+        @return: 毫秒时间戳, 无法解析返回None
+        '''
+        from calendar import timegm
+        from datetime import datetime
+        matches = self.regex.findall(name)
+        if not matches:
+            return None
+        try:
+            date = datetime.strptime(matches[-1], self.date_pattern)
+        except ValueError:
+            return None
+        return timegm(date.timetuple()) * 1000
+
+    def before(self, timestamp):
+        '''
+        @description: 日期早于timestamp的index
+        @param {int}  timestamp  毫秒时间戳
+        @return: dict {index: 毫秒时间戳字符串}
+        '''
+        from bisect import bisect_left
+        end = bisect_left(self.times, timestamp)
+        return {
+            name: str(time)
+            for time, name in zip(self.times[:end], self.names[:end])
+        }
+
+
+class SnapshotProgress:
+    '''
+    @description: 快照进度, 根据_status计算速率、剩余时间和下次轮询间隔
+    '''
+
+    # 结束状态
+    finish_state = ["SUCCESS", "FAILED", "PARTIAL", "INCOMPATIBLE", "ABORTED"]
+
+    def __init__(self, min_sleep=1, max_sleep=60):
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.interval = min_sleep
+        self.state = ""
+        self.shards_done = 0
+        self.shards_total = 0
+        self.processed = 0
+        self.total = 0
+        # [(时间, 已处理字节)]
+        self.samples = []
+
+    def update(self, status):
+        '''
+        @description: 记录一次_status返回
+        @param {dict}  status  _status返回的单个快照
+        '''
+        from time import time
+        self.state = status.get("state", "")
+        shards_stats = status.get("shards_stats", {})
+        self.shards_done = shards_stats.get("done", 0)
+        self.shards_total = shards_stats.get("total", 0)
+
+        stats = status.get("stats", {})
+        if "incremental" in stats:
+            # 7.4+
+            self.total = stats["incremental"].get("size_in_bytes", 0)
+            self.processed = stats.get("processed", {}).get("size_in_bytes", 0)
+        else:
+            self.total = stats.get("total_size_in_bytes", 0)
+            self.processed = stats.get("processed_size_in_bytes", 0)
+
+        self.samples.append((time(), self.processed))
+        self.samples = self.samples[-10:]
+        return self
+
+    def is_finish(self):
+        return self.state in self.finish_state
+
+    def rate(self):
+        '''
+        @description: 最近几次轮询的平均速率
+        @return: bytes/sec
+        '''
+        if len(self.samples) < 2:
+            return 0.0
+        (start, start_bytes), (end, end_bytes) = self.samples[0], self.samples[-1]
+        if end <= start:
+            return 0.0
+        return max(end_bytes - start_bytes, 0) / (end - start)
+
+    def eta(self):
+        '''
+        @description: 预计剩余秒数, 无法估算时返回None
+        '''
+        rate = self.rate()
+        if not rate:
+            return None
+        return max(self.total - self.processed, 0) / rate
+
+    def next_sleep(self):
+        '''
+        @description: 下次轮询间隔, 有速率时取剩余时间的1/4, 否则指数退避
+        '''
+        # 首次轮询前使用最短间隔
+        if not self.samples:
+            return self.interval
+        eta = self.eta()
+        if eta is None:
+            interval = self.interval * 2
+        else:
+            interval = min(eta / 4, self.interval * 2)
+        self.interval = min(max(interval, self.min_sleep), self.max_sleep)
+        return self.interval
+
+    def __str__(self):
+        eta = self.eta()
+        return "状态:{}, 分片:{}/{}, 字节:{}/{}, 速率:{:.0f}B/s, 预计剩余:{}".format(
+            self.state, self.shards_done, self.shards_total, self.processed,
+            self.total, self.rate(),
+            "{:.0f}秒".format(eta) if eta is not None else "未知")
+
+
+class SnapshotScheduler:
+    '''
+    @description: 快照调度, 同时最多执行concurrency个快照, 一次请求轮询所有执行中的快照
+    '''
+
+    def __init__(self,
+                 es,
+                 concurrency=1,
+                 min_sleep=1,
+                 max_sleep=60,
+                 max_watch=999,
+                 max_retry=10,
+                 journal=None):
+        self.es = es
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.max_watch = max_watch
+        self.max_retry = max_retry
+        # 记录快照开始与结束, 为None时不记录
+        self.journal = journal
+        self.limit = max(1, min(int(concurrency), self.cluster_limit()))
+
+    def cluster_limit(self):
+        '''
+        @description: 集群允许的并发快照数, 7.9之前同一时间只能执行一个快照
+        @return: int
+        '''
+        try:
+            if self.es.get_version() < (7, 9):
+                return 1
+            result = self.es.cluster.get_settings(
+                include_defaults=True,
+                flat_settings=True,
+                filter_path="*.snapshot.max_concurrent_operations")
+            for _ in ["transient", "persistent", "defaults"]:
+                limit = result.get(_, {}).get(
+                    "snapshot.max_concurrent_operations", "")
+                if limit:
+                    return int(limit)
+            return 1000
+        except es_exceptions.TransportError as e:
+            logger.warning("获取集群并发快照数失败,按1处理,错误信息:{}".format(e))
+            return 1
+
+    def run(self, tasks):
+        '''
+        @description: 执行快照任务
+        @param {list}  tasks  [(仓库名, 快照名, post_body)]
+        @return: dict {快照名: 最后状态}
+        '''
+        from collections import deque
+        from time import time
+        pending = deque(tasks)
+        running = {}
+        started = {}
+        progress = {}
+        retry = {}
+        results = {}
+        max_watch = self.max_watch
+        while pending or running:
+            # 补满执行队列
+            while pending and len(running) < self.limit:
+                task = pending.popleft()
+                repository_name, snapshot_name, body = task
+                state = self._resume(repository_name, snapshot_name) or \
+                    self._start(repository_name, snapshot_name, body)
+                if state == "running":
+                    self._record(repository_name, snapshot_name, "STARTED")
+                    running[snapshot_name] = repository_name
+                    started[snapshot_name] = time()
+                    progress[snapshot_name] = SnapshotProgress(
+                        self.min_sleep, self.max_sleep)
+                elif state == "busy" and running:
+                    # 集群并发已满, 降低上限后排队等待
+                    self.limit = len(running)
+                    logger.debug("集群快照并发已满,并发数调整为{}".format(self.limit))
+                    pending.appendleft(task)
+                    break
+                elif state in ["busy", "retry"]:
+                    retry[snapshot_name] = retry.get(snapshot_name, 0) + 1
+                    if retry[snapshot_name] >= self.max_retry:
+                        logger.error("创建快照[{}]失败!".format(snapshot_name))
+                        results[snapshot_name] = "FAILED"
+                    else:
+                        pending.append(task)
+                    break
+                else:
+                    results[snapshot_name] = "FAILED"
+
+            if not running:
+                if pending:
+                    _job_sleep(self.max_sleep)
+                continue
+
+            # 取执行中快照最短的轮询间隔
+            _job_sleep(min(progress[_].next_sleep() for _ in running))
+
+            max_watch -= 1
+            polled = self._poll(running)
+            for snapshot_name in [_ for _ in running if _ not in polled]:
+                # _status中已不存在, 快照被删除或中止
+                repository_name = running.pop(snapshot_name)
+                results[snapshot_name] = "FAILED"
+                self._record(repository_name, snapshot_name, "FAILED")
+                metrics.observe("snapshot",
+                                time() - started[snapshot_name],
+                                status="FAILED")
+                logger.error("快照[{}/{}]已不存在,标记为失败".format(
+                    repository_name, snapshot_name))
+            for snapshot_name, status in polled.items():
+                _progress = progress[snapshot_name].update(status)
+                results[snapshot_name] = _progress.state
+                if _progress.is_finish():
+                    repository_name = running.pop(snapshot_name)
+                    self._record(repository_name, snapshot_name,
+                                 _progress.state)
+                    metrics.observe("snapshot",
+                                    time() - started[snapshot_name],
+                                    status=_progress.state)
+                    logger.info("快照[{}/{}]执行结束,{},耗时{:.1f}秒".format(
+                        repository_name, snapshot_name, _progress,
+                        time() - started[snapshot_name]))
+                else:
+                    logger.debug("监听快照[{}], {}".format(
+                        snapshot_name, _progress))
+            if max_watch < 0:
+                logger.warning("监听快照{}达到最大值{},返回最后状态".format(
+                    list(running), self.max_watch))
+                break
+
+        for snapshot_name, status in sorted(results.items()):
+            if status != "SUCCESS":
+                logger.error("快照[{}]未成功,状态:{}".format(snapshot_name, status))
+        return results
+
+    def _resume(self, repository_name, snapshot_name):
+        '''
+        @description: 运行日志中已开始且仍存在的快照直接监听, 不再创建
+        @return: running/None
+        '''
+        if not self.journal or self.journal.get(
+                "snapshot", "{}/{}".format(repository_name,
+                                           snapshot_name)) != "STARTED":
+            return None
+        if self._poll({snapshot_name: repository_name}):
+            logger.info("快照[{}]已在执行, 继续监听".format(snapshot_name))
+            return "running"
+        return None
+
+    def _record(self, repository_name, snapshot_name, state):
+        if self.journal:
+            self.journal.record(
+                "snapshot", "{}/{}".format(repository_name, snapshot_name),
+                state)
+
+    def _start(self, repository_name, snapshot_name, body):
+        '''
+        @description: 提交快照, 不等待完成
+        @return: running/busy/retry/failed
+        '''
+        try:
+            self.es.pace("snapshot")
+            result = self.es.snapshot.create(repository_name, snapshot_name,
+                                             body)
+            if result.get("accepted", "") or result.get("acknowledged", ""):
+                logger.debug("创建快照[{}]成功".format(snapshot_name))
+                return "running"
+            return "retry"
+        except es_exceptions.NotFoundError as e:
+            logger.error("创建快照[{}]失败,错误信息:{}".format(snapshot_name, e))
+            return "failed"
+        except es_exceptions.TransportError as e:
+            if self._poll({snapshot_name: repository_name}):
+                logger.debug("快照[{}]已经存在".format(snapshot_name))
+                return "running"
+            if "concurrent_snapshot_execution_exception" in str(e.error):
+                return "busy"
+            logger.warning("创建快照[{}]失败,稍后重试,错误信息:{}".format(
+                snapshot_name, e))
+            return "retry"
+
+    def _poll(self, running):
+        '''
+        @description: 按仓库合并请求, 获取快照_status
+        @param {dict}  running  {快照名: 仓库名}
+        @return: dict {快照名: _status返回}
+        '''
+        repositories = {}
+        for snapshot_name, repository_name in running.items():
+            repositories.setdefault(repository_name, []).append(snapshot_name)
+
+        result = {}
+        for repository_name, snapshot_names in repositories.items():
+            for batch in _chunk_index_names(sorted(snapshot_names)):
+                for _ in self.es.get_snapshot_status(repository_name, batch):
+                    result[_["snapshot"]] = _
+        return result
+
+
+class ForceMergeScheduler:
+    '''
+    @description: force merge调度, 每个节点同时最多合并per_node个index
+    '''
+
+    def __init__(self,
+                 es,
+                 per_node=1,
+                 workers=4,
+                 max_num_segments=1,
+                 timeout=21600,
+                 check_interval=30,
+                 max_watch=120):
+        self.es = es
+        self.per_node = max(1, int(per_node))
+        self.workers = max(1, int(workers))
+        self.max_num_segments = int(max_num_segments)
+        self.timeout = timeout
+        self.check_interval = check_interval
+        self.max_watch = max_watch
+
+    def run(self, indices):
+        '''
+        @description: 执行force merge
+        @param {dict}  indices  {index: [所在节点]}
+        @return: dict {index: MERGED/TIMEOUT/FAILED}
+        '''
+        from threading import Condition
+        pending = sorted(indices)
+        busy = {}
+        results = {}
+        condition = Condition()
+
+        def _next():
+            # 取所在节点都有空闲的index, 没有时等待其他合并结束
+            with condition:
+                while pending:
+                    for name in pending:
+                        if all(
+                                busy.get(_, 0) < self.per_node
+                                for _ in indices[name]):
+                            pending.remove(name)
+                            for _ in indices[name]:
+                                busy[_] = busy.get(_, 0) + 1
+                            return name
+                    condition.wait()
+                return None
+
+        def _release(name):
+            with condition:
+                for _ in indices[name]:
+                    busy[_] -= 1
+                condition.notify_all()
+
+        def _worker(_):
+            while True:
+                name = _next()
+                if name is None:
+                    return
+                try:
+                    results[name] = self._merge(name)
+                finally:
+                    _release(name)
+
+        _thread_map(_worker, range(min(self.workers, len(pending))),
+                    self.workers)
+        return results
+
+    def _merge(self, name):
+        '''
+        @description: 合并单个index并确认完成
+        @return: MERGED/TIMEOUT/FAILED
+        '''
+        from time import time
+        start = time()
+        # 请求超时不超过所属任务剩余时间, 超时后在轮询中取消
+        timeout = self.timeout
+        if _job_remaining() is not None:
+            timeout = max(1, min(timeout, _job_remaining()))
+        try:
+            self.es.pace("forcemerge")
+            self.es.indices.forcemerge(index=name,
+                                       max_num_segments=self.max_num_segments,
+                                       request_timeout=timeout)
+            state = self._wait(name)
+        except es_exceptions.ConnectionTimeout:
+            # 请求超时后服务端仍在合并, 轮询segment数
+            logger.warning("index[{}]合并请求超时, 继续等待合并完成".format(name))
+            state = self._wait(name)
+        except es_exceptions.TransportError as e:
+            logger.error("index[{}]合并失败,错误信息:{}".format(name, e))
+            state = "FAILED"
+        metrics.observe("forcemerge", time() - start, status=state)
+        logger.info("index[{}]合并结束,状态:{},耗时{:.1f}秒".format(
+            name, state,
+            time() - start))
+        return state
+
+    def _wait(self, name):
+        for _ in range(self.max_watch):
+            segments = self.es.get_merge_state([name]).get(name, {})
+            if segments.get("segments", 0) <= self.max_num_segments:
+                return "MERGED"
+            logger.debug("index[{}]合并中, 最大segment数:{}".format(
+                name, segments.get("segments")))
+            _job_sleep(self.check_interval)
+        return "TIMEOUT"
+
+
+class RestoreScheduler:
+    '''
+    @description: 快照恢复调度, 同时最多恢复concurrency个快照, 一次请求轮询所有恢复中的index
+    '''
+
+    def __init__(self,
+                 es,
+                 concurrency=1,
+                 min_sleep=1,
+                 max_sleep=60,
+                 max_watch=999,
+                 max_retry=10):
+        self.es = es
+        self.limit = max(1, int(concurrency))
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.max_watch = max_watch
+        self.max_retry = max_retry
+
+    def run(self, tasks):
+        '''
+        @description: 执行恢复任务
+        @param {list}  tasks  [(仓库名, 快照名, post_body, [恢复后的index名])]
+        @return: dict {快照名: 最后状态}
+        '''
+        from collections import deque
+        from time import time
+        pending = deque(tasks)
+        running = {}
+        started = {}
+        progress = {}
+        retry = {}
+        results = {}
+        max_watch = self.max_watch
+        while pending or running:
+            while pending and len(running) < self.limit:
+                task = pending.popleft()
+                repository_name, snapshot_name, body, targets = task
+                state = self._start(repository_name, snapshot_name, body)
+                if state == "running":
+                    running[snapshot_name] = (repository_name, targets)
+                    started[snapshot_name] = time()
+                    progress[snapshot_name] = SnapshotProgress(
+                        self.min_sleep, self.max_sleep)
+                    results[snapshot_name] = "STARTED"
+                elif state == "busy" and running:
+                    # 集群不允许更多并发恢复, 降低上限后排队等待
+                    self.limit = len(running)
+                    logger.debug("集群恢复并发已满,并发数调整为{}".format(self.limit))
+                    pending.appendleft(task)
+                    break
+                elif state in ["busy", "retry"]:
+                    retry[snapshot_name] = retry.get(snapshot_name, 0) + 1
+                    if retry[snapshot_name] >= self.max_retry:
+                        logger.error("恢复快照[{}]失败!".format(snapshot_name))
+                        results[snapshot_name] = "FAILED"
+                    else:
+                        pending.append(task)
+                    break
+                else:
+                    results[snapshot_name] = "FAILED"
+
+            if not running:
+                if pending:
+                    _job_sleep(self.max_sleep)
+                continue
+
+            _job_sleep(min(progress[_].next_sleep() for _ in running))
+
+            max_watch -= 1
+            state = self.es.get_restore_state(
+                sorted(set(i for _, targets in running.values()
+                           for i in targets)))
+            for snapshot_name, (repository_name,
+                                targets) in list(running.items()):
+                _progress = progress[snapshot_name].update(
+                    self._status(targets, state))
+                results[snapshot_name] = _progress.state
+                if _progress.is_finish():
+                    running.pop(snapshot_name)
+                    metrics.observe("restore",
+                                    time() - started[snapshot_name],
+                                    status=_progress.state)
+                    logger.info("快照[{}/{}]恢复结束,{},耗时{:.1f}秒".format(
+                        repository_name, snapshot_name, _progress,
+                        time() - started[snapshot_name]))
+                else:
+                    logger.debug("监听恢复[{}], {}".format(
+                        snapshot_name, _progress))
+            if max_watch < 0:
+                logger.warning("监听恢复{}达到最大值{},返回最后状态".format(
+                    list(running), self.max_watch))
+                break
+
+        for snapshot_name, status in sorted(results.items()):
+            if status != "SUCCESS":
+                logger.error("快照[{}]未恢复完成,状态:{}".format(
+                    snapshot_name, status))
+        return results
+
+    def _start(self, repository_name, snapshot_name, body):
+        '''
+        @description: 提交恢复, 不等待完成
+        @return: running/busy/retry/failed
+        '''
+        try:
+            self.es.pace("restore")
+            result = self.es.snapshot.restore(repository_name, snapshot_name,
+                                              body)
+            if result.get("accepted", "") or result.get("acknowledged", ""):
+                logger.debug("开始恢复快照[{}]".format(snapshot_name))
+                return "running"
+            return "retry"
+        except es_exceptions.TransportError as e:
+            if "concurrent_snapshot_execution_exception" in str(e.error):
+                return "busy"
+            # 目标index已存在、快照不存在等错误重试无效
+            logger.error("恢复快照[{}]失败,错误信息:{}".format(snapshot_name, e))
+            return "failed"
+
+    @classmethod
+    def _status(cls, targets, state):
+        '''
+        @description: 汇总快照对应index的恢复状态, 转为_status格式供SnapshotProgress使用
+        '''
+        items = [state.get(_, {}) for _ in targets]
+        if all(_.get("status") in ["yellow", "green"] for _ in items):
+            # 主分片全部启动即恢复完成
+            status = "SUCCESS"
+        elif any(_.get("status") == "red" and _.get("failed") for _ in items):
+            status = "FAILED"
+        else:
+            status = "STARTED"
+        return {
+            "state": status,
+            "shards_stats": {
+                "done": sum(_.get("shards_done", 0) for _ in items),
+                "total": sum(_.get("shards_total", 0) for _ in items),
+            },
+            "stats": {
+                "incremental": {
+                    "size_in_bytes": sum(_.get("total", 0) for _ in items)
+                },
+                "processed": {
+                    "size_in_bytes": sum(_.get("recovered", 0) for _ in items)
+                },
+            }
+        }
+
+
+class JobExecutor:
+    '''
+    @description: 按depends_on/group依赖, 用有界线程池并发执行playbook任务
+    '''
+
+    # 超时任务取消后最多等待其退出的秒数
+    cancel_wait = 60
+
+    def __init__(self, jobs, runner, workers=1, timeout=None):
+        '''
+        @param {list}      jobs     playbook任务列表
+        @param {function}  runner   执行单个任务的方法
+        @param {int}       workers  并发数
+        @param {int}       timeout  默认单任务超时秒数, 为空时不限制
+        '''
+        self.runner = runner
+        self.workers = max(1, int(workers))
+        self.jobs = []
+        last_in_group = {}
+        previous = None
+        for i, config in enumerate(jobs):
+            name = str(config.get("name", "{}-{}".format(config["job"], i)))
+            depends = config.get("depends_on", [])
+            depends = [depends] if isinstance(depends, str) else list(depends)
+            # 同一group内按顺序执行
+            group = config.get("group", None)
+            if group is not None:
+                if group in last_in_group:
+                    depends.append(last_in_group[group])
+                last_in_group[group] = name
+            elif "depends_on" not in config and previous is not None:
+                # 没有声明依赖时依赖上一个任务, 上一个任务失败后不再执行
+                depends.append(previous)
+            previous = name
+            self.jobs.append({
+                "name": name,
+                "config": config,
+                "depends": depends,
+                "timeout": config.get("timeout", timeout),
+            })
+
+    def run(self):
+        '''
+        @description: 执行全部任务, 依赖失败或超时的任务跳过
+        @return: list [{name, job, status, elapsed, result}]
+        '''
+        from Queue import Queue, Empty
+        from threading import Event, Thread
+        from time import time
+
+        names = set(_["name"] for _ in self.jobs)
+        done = Queue()
+        state = {}
+        results = {}
+        running = {}
+        pending = list(self.jobs)
+        abandoned = []
+        begin = time()
+
+        # 任务线程继承当前线程的上下文(如集群名)
+        parent = dict(_job_local().__dict__)
+
+        def _target(job, cancel):
+            start = time()
+            context = _job_local()
+            context.__dict__.update(parent)
+            context.cancel = cancel
+            context.deadline = None
+            if job["timeout"]:
+                context.deadline = start + float(job["timeout"])
+            result, status = None, "failed"
+            try:
+                result = self.runner(job["config"])
+                status = "success"
+            except JobCancelled:
+                logger.warning("任务[{}]超时, 已取消".format(job["name"]))
+            except Exception as e:
+                logger.error("任务[{}]执行失败: {}".format(job["name"], e))
+            finally:
+                # SystemExit、GreenletExit等也要返回结果, 否则run一直等待
+                done.put((job["name"], status, result, time() - start))
+
+        def _finish(job, status, result, elapsed):
+            state[job["name"]] = status
+            results[job["name"]] = {
+                "name": job["name"],
+                "job": job["config"]["job"],
+                "status": status,
+                "elapsed": elapsed,
+                "result": result,
+            }
+
+        while pending or running:
+            # 依赖不存在或未成功的任务跳过
+            for job in list(pending):
+                broken = [
+                    _ for _ in job["depends"] if _ not in names
+                    or state.get(_, "success") != "success"
+                ]
+                if broken:
+                    logger.error("任务[{}]依赖{}未成功, 跳过".format(
+                        job["name"], broken))
+                    pending.remove(job)
+                    _finish(job, "skipped", None, 0)
+
+            for job in list(pending):
+                if len(running) >= self.workers:
+                    break
+                if all(state.get(_) == "success" for _ in job["depends"]):
+                    pending.remove(job)
+                    logger.debug("开始执行任务[{}]".format(job["name"]))
+                    cancel = Event()
+                    thread = Thread(target=_target, args=(job, cancel))
+                    thread.daemon = True
+                    running[job["name"]] = (job, time(), thread, cancel)
+                    thread.start()
+
+            if not running:
+                # 循环依赖
+                for job in pending:
+                    logger.error("任务[{}]依赖{}无法满足, 跳过".format(
+                        job["name"], job["depends"]))
+                    _finish(job, "skipped", None, 0)
+                break
+
+            try:
+                name, status, result, elapsed = done.get(timeout=1)
+                if name in running:
+                    _finish(running.pop(name)[0], status, result, elapsed)
+            except Empty:
+                pass
+
+            # 超时任务通知取消, 在下一次轮询或重试等待时退出, 结果丢弃
+            now = time()
+            for name, (job, start, thread,
+                       cancel) in list(running.items()):
+                if job["timeout"] and now - start > float(job["timeout"]):
+                    logger.error("任务[{}]执行超过{}秒, 取消执行".format(
+                        name, job["timeout"]))
+                    cancel.set()
+                    running.pop(name)
+                    abandoned.append((name, thread))
+                    _finish(job, "timeout", None, now - start)
+
+        # 等待已取消的任务退出, 避免关闭运行日志后继续写入或daemon重复启动;
+        # 阻塞在单个请求中的任务最多等待cancel_wait秒
+        deadline = time() + self.cancel_wait
+        for name, thread in abandoned:
+            if thread.is_alive():
+                logger.warning("等待超时任务[{}]退出".format(name))
+                thread.join(max(0, deadline - time()))
+            if thread.is_alive():
+                logger.error("超时任务[{}]仍在执行, 不再等待".format(name))
+
+        result = [results[_["name"]] for _ in self.jobs]
+        logger.info("playbook执行完成, 总耗时{:.1f}秒".format(time() - begin))
+        for _ in sorted(result, key=lambda x: -x["elapsed"]):
+            logger.info("任务[{}]({}) {} 耗时{:.1f}秒".format(
+                _["name"], _["job"], _["status"], _["elapsed"]))
+        return result
+
+
+class Job:
+
+    __metaclass__ = ABCMeta
+
+    # 元数据目录, 为None时直接请求集群
+    catalog = None
+
+    def __init__(self, es):
+        self.es = es
+
+    def get_index_list(self, index="*"):
+        '''
+        @description: 获取index列表
+        '''
+        if self.catalog:
+            return self.catalog.match(index)
+        result = self.es.indices.get_alias(index)
+        if result:
+            return [_ for _ in result]
+        return result
+
+    def get_job(self, job):
+        '''
+        description: 获取任务方法
+        '''
+        return getattr(self, "job_{}".format(job), None)
+
+    def _filter_index(self, data, day):
+        '''
+        @description: 过滤需要删除的index
+        @param {dict}  data   index与创建日期的字典
+        @param {int}   day    保留天数
+        @return: dict
+        '''
+        last_time = self._expire_time(day)
+        return dict(filter(lambda x: int(x[1]) < last_time, data.items()))
+
+    def _expire_time(self, day):
+        '''
+        @description: 保留day天的过期时间点
+        @return: 毫秒时间戳
+        '''
+        from time import time
+        now_time = int(round(time() * 1000))
+        day_delta = int(day) * 86400000
+        return now_time - day_delta
+
+    def _exe_restore_job(self, config):
+        '''
+        @description: 按快照名匹配并恢复, playbook与cmd共用
+        @param {dict}  config  repository: 仓库名
+                               snapshot: 快照名表达式, 如"logstash-2019.09.*"
+                               indices: 恢复的index表达式, 默认全部
+                               rename_pattern/rename_replacement: index重命名
+                               body: 其他恢复参数
+                               concurrency: 同时恢复的快照数
+        @return: dict {快照名: 最后状态}
+        '''
+        repository_name = config.get("repository", "")
+        snapshot_pattern = config.get("snapshot", "")
+        if not repository_name or not snapshot_pattern:
+            logger.error("恢复任务需要指定repository与snapshot")
+            return {}
+        if isinstance(snapshot_pattern, list):
+            snapshot_pattern = ",".join(snapshot_pattern)
+
+        body = dict(config.get("body", None) or {})
+        body.setdefault("include_global_state", False)
+        indices = config.get("indices", None)
+        if isinstance(indices, list):
+            indices = ",".join(indices)
+        if indices:
+            body["indices"] = indices
+        rename_pattern = config.get("rename_pattern", None)
+        rename_replacement = config.get("rename_replacement", "")
+        if rename_pattern:
+            body["rename_pattern"] = rename_pattern
+            body["rename_replacement"] = rename_replacement
+
+        # 只恢复成功的快照
+        snapshots = _match_names(
+            [
+                k for k, v in self.es.get_snapshot_names(
+                    repository_name).items() if v == "SUCCESS"
+            ], snapshot_pattern)
+        if not snapshots:
+            logger.info("仓库[{}]中没有匹配[{}]的快照".format(repository_name,
+                                                     snapshot_pattern))
+            return {}
+
+        tasks = []
+        snapshot_indices = self.es.get_snapshot_indices(repository_name,
+                                                        snapshots)
+        for snapshot_name in snapshots:
+            targets = _match_names(snapshot_indices.get(snapshot_name, []),
+                                   indices or "*")
+            if rename_pattern:
+                # ES使用Java的$1引用分组
+                replacement = re.sub(r"\$(\d+)", r"\\g<\1>",
+                                     rename_replacement)
+                targets = [
+                    re.sub(rename_pattern, replacement, _) for _ in targets
+                ]
+            if not targets:
+                logger.warning("快照[{}]中没有需要恢复的index".format(snapshot_name))
+                continue
+            logger.debug("快照[{}]将恢复为: {}".format(snapshot_name, targets))
+            tasks.append((repository_name, snapshot_name, body, targets))
+
+        if tasks and not self.force:
+            yORn = raw_input("确定从[{}]恢复{}个快照?  (y/n)".format(
+                repository_name, len(tasks)))
+            if yORn not in ["y", "Y"]:
+                logger.debug("取消恢复任务.")
+                return {}
+
+        scheduler = RestoreScheduler(self.es,
+                                     concurrency=config.get("concurrency", 1),
+                                     min_sleep=config.get("min_sleep", 1),
+                                     max_sleep=config.get("max_sleep", 60),
+                                     max_watch=config.get("max_watch", 999))
+        result = scheduler.run(tasks)
+        if self.catalog:
+            # 恢复会新建index
+            self.catalog.invalidate()
+        return result
+
+    def _exe_settings_job(self, config):
+        '''
+        @description: 批量修改index配置, 已是目标值的index跳过, playbook与cmd共用
+        @param {dict}  config  index: index前缀或前缀列表
+                               settings: 目标配置, 如{"index.blocks.write": true}
+                               freeze: true冻结/false解冻, 不指定时不修改
+                               save/date_pattern: 只修改超过保留天数的index
+                               wildcard: 前缀下所有index的修改相同时用通配符提交
+        @return: dict {index: UPDATED/SKIPPED/FAILED}
+        '''
+        import json
+        index_name = config.get("index", "")
+        if isinstance(index_name, basestring):
+            index_name = [index_name]
+        target = _flatten_settings(config.get("settings", None) or {})
+        freeze = config.get("freeze", None)
+        save_day = config.get("save", None)
+        date_pattern = config.get("date_pattern", None)
+        max_url_length = int(config.get("max_url_length", 4000))
+        if not index_name or not (target or freeze is not None):
+            logger.error("配置任务需要指定index与settings或freeze")
+            return {}
+        if freeze is not None and self.es.get_version() >= (8, ):
+            logger.error("ES {}不支持冻结index".format(".".join(
+                str(_) for _ in self.es.get_version())))
+            return {}
+
+        # 一次读取前缀下open状态index的创建时间与目标字段, 没有设置的字段不会返回
+        patterns = ["{}*".format(_) for _ in index_name]
+        fields = ["creation_date"] + sorted(target) + (
+            ["frozen"] if freeze is not None else [])
+        current = self.es.get_indices_settings(patterns, fields, "open")
+        if save_day is not None:
+            if date_pattern:
+                expired = IndexTimeline(
+                    current.keys(),
+                    date_pattern).before(self._expire_time(save_day))
+            else:
+                expired = self._filter_index(
+                    dict((k, v.get("creation_date", 0))
+                         for k, v in current.items()), int(save_day))
+            current = dict((k, v) for k, v in current.items() if k in expired)
+
+        groups, frozen, result = {}, [], {}
+        for name in sorted(current):
+            settings = current[name]
+            body = {}
+            for key, value in sorted(target.items()):
+                now = _get_setting(settings, key)
+                # 没有设置的布尔配置默认为false
+                if now is None and (value is None or value is False):
+                    continue
+                if _setting_str(now) != _setting_str(value):
+                    body["index.{}".format(key)] = value
+            if body:
+                groups.setdefault(json.dumps(body, sort_keys=True),
+                                  []).append(name)
+            is_frozen = _setting_str(settings.get("frozen", False)) == "true"
+            if freeze is not None and bool(freeze) != is_frozen:
+                frozen.append(name)
+            result[name] = "UPDATED" if body or name in frozen else "SKIPPED"
+
+        changed = [k for k, v in result.items() if v == "UPDATED"]
+        if not changed:
+            logger.info("{}的配置任务执行完成.没有需要修改的index.".format(index_name))
+            return result
+        if not self.force:
+            yORn = raw_input("确定修改{}个index配置?  (y/n)".format(len(changed)))
+            if yORn not in ["y", "Y"]:
+                logger.debug("取消配置任务.")
+                return {}
+
+        # 前缀下全部index都需要相同修改时用通配符一次提交, 按保留天数过滤时不使用
+        wildcards = {}
+        if config.get("wildcard", True) and save_day is None:
+            for body, group in groups.items():
+                names = set(group)
+                for pattern, prefix in zip(patterns, index_name):
+                    matched = [_ for _ in current if _.startswith(prefix)]
+                    if matched and names.issuperset(matched):
+                        wildcards.setdefault(body, {})[pattern] = matched
+                        names.difference_update(matched)
+                groups[body] = sorted(names)
+
+        def _failed(status):
+            for k, v in status.items():
+                if not v:
+                    result[k] = "FAILED"
+
+        if freeze is False and frozen:
+            _failed(self.es.freeze_indices(frozen, False, max_url_length))
+        _failed(self._put_index_settings_groups(groups, max_url_length,
+                                                wildcards))
+        if freeze and frozen:
+            _failed(self.es.freeze_indices(frozen, True, max_url_length))
+        if self.catalog:
+            self.catalog.invalidate()
+        logger.info("配置任务执行完成, 修改{}个, 跳过{}个, 失败{}个".format(
+            len([_ for _ in result.values() if _ == "UPDATED"]),
+            len([_ for _ in result.values() if _ == "SKIPPED"]),
+            len([_ for _ in result.values() if _ == "FAILED"])))
+        return result
+
+    def _put_index_settings_groups(self, groups, max_url_length=4000,
+                                   wildcards=None):
+        '''
+        @description: 按修改内容分组批量提交index配置
+        @param {dict}  groups     {json格式的配置: [index]}
+        @param {dict}  wildcards  {json格式的配置: {通配符: [通配符覆盖的index]}}
+        @return: dict {index: True/False}
+        '''
+        import json
+        wildcards = wildcards or {}
+        result = {}
+        for body in sorted(set(groups) | set(wildcards)):
+            status = self.es.put_indices_settings(groups.get(body, []),
+                                                  json.loads(body),
+                                                  max_url_length)
+            for pattern, names in sorted(wildcards.get(body, {}).items()):
+                # 提交前确认通配符覆盖的index未变化, 有新建(如rollover)或关闭的index时逐个提交
+                if set(self._open_indices(pattern)) != set(names):
+                    logger.debug("通配符[{}]覆盖的index已变化,改为指定index提交".format(
+                        pattern))
+                    status.update(
+                        self.es.put_indices_settings(names, json.loads(body),
+                                                     max_url_length))
+                    continue
+                logger.debug("通配符[{}]修改{}个index配置{}".format(
+                    pattern, len(names), body))
+                success = all(
+                    self.es.put_indices_settings([pattern], json.loads(body),
+                                                 max_url_length,
+                                                 "open").values())
+                status.update(dict.fromkeys(names, success))
+                extra = sorted(set(self._open_indices(pattern)) - set(names))
+                if extra:
+                    logger.warning("通配符[{}]提交期间新建的index{}也被修改配置{}".format(
+                        pattern, extra, body))
+            failed = [k for k, v in status.items() if not v]
+            logger.info("修改{}个index配置{}, 失败{}个".format(
+                len(status), body, len(failed)))
+            for _ in failed:
+                logger.error("index[{}]修改配置{}失败".format(_, body))
+            result.update(status)
+        return result
+
+    def _open_indices(self, pattern):
+        '''
+        @description: 通配符当前匹配的open状态index
+        @param {string}  pattern  通配符
+        @return: list
+        '''
+        return list(
+            self.es.get_indices_settings([pattern], ["creation_date"], "open"))
+
+    @abstractmethod
+    def run(self):
+        pass
+
+
+class PlayBook(Job):
+
+    def __init__(self, config, settings=None, es=None, force=False,
+                 resume=False):
+        self.es = es
+        self.config = config
+        self.force = force
+        self.settings = settings
+        # 跳过运行日志中已完成的操作
+        self.resume = resume
+        self.journal = None
+
+    def run(self):
+        # 每次运行加载一次元数据
+        self.catalog = Catalog(self.es)
+        self.journal = self._open_journal()
+
+        # 限速
+        throttle = (self.settings or {}).get("throttle", None)
+        if throttle:
+            self.es.throttle = Throttle(self.es, throttle)
+
+        options = (self.settings or {}).get("playbook", None) or {}
+        workers = int(options.get("workers", 1))
+        if workers > 1 and not self.force:
+            # 需要逐个确认时不能并发
+            logger.warning("非强制模式下按顺序执行任务")
+            workers = 1
+        executor = JobExecutor(self.config, self.run_job, workers,
+                               options.get("timeout", None))
+        try:
+            result = executor.run()
+        finally:
+            if self.journal:
+                self.journal.close()
+        if self.journal and all(_["status"] == "success" for _ in result
+                                ) and not self.journal.unfinished():
+            # 全部完成后不再需要恢复
+            self.journal.close(remove=True)
+        return result
+
+    def _open_journal(self):
+        '''
+        @description: 按playbook内容与集群地址区分运行日志, 配置journal.path指定目录
+        @return: Journal/None
+        '''
+        import json
+        from hashlib import md5
+        options = (self.settings or {}).get("journal", None) or {}
+        if options.get("enabled", True) is False:
+            return None
+        directory = options.get("path",
+                                os.path.dirname(os.path.abspath(__file__)))
+        key = md5(
+            json.dumps([self.config, self.es.transport.hosts],
+                       sort_keys=True,
+                       default=str)).hexdigest()[:12]
+        try:
+            return Journal(
+                os.path.join(directory, "esTools.{}.journal".format(key)),
+                self.resume)
+        except (IOError, OSError) as e:
+            logger.warning("无法写入运行日志, 不记录: {}".format(e))
+            return None
+
+    def run_job(self, config):
+        '''
+        @description: 执行单个任务
+        '''
+        job_function = self.get_job(config["job"])
+        if job_function:
+            with metrics.timer("job",
+                               job=config["job"],
+                               name=config.get("name", config["job"])):
+                return job_function(config)
+
+    def get_snapshot(self, repository_name, snapshot_name):
+        '''
+        @description: 获取快照
+        @param {string}  repository_name   仓库名
+        @param {string}  snapshot_name     快照名
+        @return: dict
+        '''
+        try:
+            result = self.es.snapshot.get(repository=repository_name,
+                                          snapshot=snapshot_name)
+            logger.debug("获取快照仓库,返回:{}".format(str(result)))
+        except es_exceptions.NotFoundError:
+            result = {}
+            logger.debug("获取快照仓库,返回为空")
+        return result
+
+    def get_snapshot_repository(self, repository_name=None):
+        '''
+        @description: 获取快照仓库
+        @param {string}  repository_name   仓库名，默认为None
+        @return: dict
+        '''
+        try:
+            result = self.es.snapshot.get_repository(repository_name)
+            logger.debug("获取快照仓库,返回:{}".format(str(result)))
+        except es_exceptions.NotFoundError:
+            result = {}
+            logger.debug("获取快照仓库,返回为空")
+        return result
+
+    def create_snapshot_repository(self, repository_name, body):
+        '''
+        @description: 创建快照仓库
+        @param {string}  repository_name   仓库名
+        @param {dict}    body              参数
+        @return: True/False
+        '''
+        result = self.es.snapshot.create_repository(repository_name, body)
+        if result.get("acknowledged", ""):
+            logger.debug("成功创建仓库名为[{}]的快照, POST参数:{}".format(
+                repository_name, str(body)))
+            return True
+        logger.debug("创建仓库名为[{}]的快照失败! POST参数:{}".format(
+            repository_name, str(body)))
+        return False
+
+    def job_backup(self, config):
+        '''
+        @description: 备份任务  
+        '''
+        snapshot_settings = self.settings["snapshot"]
+        snapshot_repository_name = snapshot_settings["repository"]
+        snapshot_repository_post_body = snapshot_settings["body"]
+
+        index_list = config["index"]
+        index_body = config["body"]
+
+        snapshot_name = config.get("snapshot_name", None)
+
+        include_mode = config.get("include_mode", False)
+
+        concurrency = int(config.get("concurrency", 1))
+
+        incremental = config.get("incremental", False)
+
+        return self._exe_create_snapshot_job(snapshot_repository_name,
+                                             snapshot_repository_post_body,
+                                             index_list,
+                                             index_body,
+                                             include_mode,
+                                             concurrency,
+                                             snapshot_name=snapshot_name,
+                                             incremental=incremental)
+
+    def _exe_update_alias_job(self, body):
+        '''
+        description: 修改别名
+        '''
+        import json
+        from hashlib import md5
+        key = md5(json.dumps(body, sort_keys=True)).hexdigest()
+        if self.journal and self.journal.get("aliases", key):
+            logger.info("运行日志中别名已修改, 跳过: [{}]".format(str(body)))
+            return True
+        self.es.pace("aliases")
+        result = self.es.indices.update_aliases({"actions": body})
+        if result.get("acknowledged", ""):
+            if self.journal:
+                self.journal.record("aliases", key, "done")
+            if self.catalog:
+                # 别名变更后重新加载
+                self.catalog.invalidate()
+            for _ in body:
+                _job_name = None
+                _index = None
+                _alias = None
+                if _.get("remove", ""):
+                    _job_name = "删除"
+                    _index = _["remove"].get("index") or _["remove"].get(
+                        "indices")
+                    _alias = _["remove"]["alias"]
+                elif _.get("add", ""):
+                    _job_name = "新增"
+                    _index = _["add"].get("index") or _["add"].get("indices")
+                    _alias = _["add"]["alias"]
+                if all([_job_name, _index, _alias]):
+                    logger.debug("索引[{}]{}别名:{}".format(
+                        _index, _job_name, _alias))
+            logger.info("修改别名成功, 共{}个操作".format(len(body)))
+            return True
+        logger.error("修改别名失败, 返回:[{}]".format(str(result)))
+        return False
+
+    def job_aliases(self, config):
+        '''
+        description: 别名任务
+        '''
+        actions_body = config.get("actions", "")
+        if actions_body:
+            self._exe_update_alias_job(actions_body)
+        if config.get("aliases", None):
+            return self._exe_reconcile_alias_job(
+                config["aliases"], int(config.get("max_payload", 1048576)))
+
+    def _exe_reconcile_alias_job(self, aliases, max_payload=1048576):
+        '''
+        @description: 按期望的别名成员计算最少的新增/删除, 一次_aliases请求原子提交
+        @param {list}  aliases      [{alias, index, save, date_pattern}]
+        @param {int}   max_payload  单次请求body字节上限, 超过时分批, 先新增后删除
+        @return: dict {别名: {"add": 新增数, "remove": 删除数, "applied": True/False}}
+        '''
+        current = self.catalog.aliases() if self.catalog else None
+        result = {}
+        adds, removes = [], []
+        for item in aliases:
+            alias = item["alias"]
+            desired = set(
+                self._get_alias_desired_index(item["index"],
+                                              item.get("save", None),
+                                              item.get("date_pattern",
+                                                       None)))
+            if current is not None:
+                members = set(current.get(alias, []))
+            else:
+                members = set(self.es.indices.get_alias(name=alias,
+                                                        ignore=[404]).keys())
+                members.discard("error")
+                members.discard("status")
+            add = sorted(desired - members)
+            remove = sorted(members - desired)
+            logger.info("别名[{}]当前{}个index, 期望{}个, 新增{}个, 删除{}个".format(
+                alias, len(members), len(desired), len(add), len(remove)))
+            if add:
+                adds.append(("add", alias, add))
+            if remove:
+                removes.append(("remove", alias, remove))
+            result[alias] = {
+                "add": len(add),
+                "remove": len(remove),
+                "applied": True
+            }
+
+        # 分批时先新增再删除, 中途失败也不会出现别名为空
+        batches = self._chunk_alias_actions(adds + removes, max_payload)
+        if len(batches) > 1:
+            logger.warning("别名修改超过{}字节, 分{}次提交, 不再是原子操作".format(
+                max_payload, len(batches)))
+        for body in batches:
+            if not self._exe_update_alias_job(body):
+                for _ in body:
+                    for value in _.values():
+                        result[value["alias"]]["applied"] = False
+        return result
+
+    def _get_alias_desired_index(self, index, save=None, date_pattern=None):
+        '''
+        @description: 别名期望包含的index
+        @param {string/list}  index         index表达式
+        @param {int}          save          只包含最近save天的index, 为空时不限制
+        @param {string}       date_pattern  按index名中的日期判断, 名称中没有日期的index不包含
+        @return: list
+        '''
+        if isinstance(index, list):
+            index = ",".join(index)
+        if save is None:
+            return self.get_index_list(index)
+        expire = self._expire_time(save)
+        if date_pattern:
+            timeline = IndexTimeline(self.get_index_list(index), date_pattern)
+            expired = timeline.before(expire)
+            return [_ for _ in timeline.names if _ not in expired]
+        if self.catalog:
+            dates = self.catalog.creation_dates(index)
+        else:
+            dates = {
+                k: v["creation_date"]
+                for k, v in self.es.get_indices_settings(
+                    self.get_index_list(index), ["creation_date"]).items()
+            }
+        return sorted(k for k, v in dates.items() if int(v) >= expire)
+
+    @classmethod
+    def _chunk_alias_actions(cls, units, max_payload=1048576):
+        '''
+        @description: 合并为带indices列表的action, 按body字节数分批
+        @param {list}  units  [(add/remove, 别名, [index])]
+        @return: list [actions]
+        '''
+        import json
+        batches, batch, size = [], [], len('{"actions": []}')
+        for kind, alias, indices in units:
+            action = None
+            header = len(json.dumps({kind: {"alias": alias, "indices": []}}))
+            for name in indices:
+                cost = len(json.dumps(name)) + 2
+                if batch and size + cost + (header + 2 if action is None else
+                                            0) > max_payload:
+                    batches.append(batch)
+                    batch, size, action = [], len('{"actions": []}'), None
+                if action is None:
+                    action = {kind: {"alias": alias, "indices": []}}
+                    batch.append(action)
+                    size += header + 2
+                action[kind]["indices"].append(name)
+                size += cost
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def job_delete(self, config):
+        '''
+        @description: 删除任务
         '''
         index_name = config.get("index", "")
         save_day = config.get("save", "")
+        workers = int(config.get("workers", 1))
+        max_url_length = int(config.get("max_url_length", 4000))
+        date_pattern = config.get("date_pattern", None)
+
+        result = {}
+        if isinstance(index_name, list):
+            # 遍历index列表
+            for i in index_name:
+                result.update(
+                    self._exe_delete_index_job(i, save_day, workers,
+                                               max_url_length, date_pattern))
+        elif isinstance(index_name, str):
+            result.update(
+                self._exe_delete_index_job(index_name, save_day, workers,
+                                           max_url_length, date_pattern))
+        return result
+
+    def job_optimize(self, config):
+        '''
+        @description: 优化任务, 对超过保留天数的index禁止写入、降低副本数并force merge
+        '''
+        index_name = config.get("index", "")
+        save_day = config.get("save", 0)
+        date_pattern = config.get("date_pattern", None)
+        read_only = config.get("read_only", True)
+        replicas = config.get("replicas", None)
+        max_num_segments = int(config.get("max_num_segments", 1))
+        max_url_length = int(config.get("max_url_length", 4000))
+
+        if isinstance(index_name, basestring):
+            index_name = [index_name]
+        candidates = {}
+        for i in index_name:
+            candidates.update(
+                self._get_expired_index(i, save_day, date_pattern))
+        if self.catalog:
+            # 关闭的index无法修改与合并
+            indices = self.catalog.data()
+            candidates = {
+                k: v
+                for k, v in candidates.items()
+                if indices.get(k, {}).get("state", "open") == "open"
+            }
+        if not candidates:
+            logger.info("{}的优化任务执行完成.没发现需要优化的index.".format(index_name))
+            return {}
+
+        if not self.force:
+            yORn = raw_input("确定优化{}个index?  (y/n)".format(len(candidates)))
+            if yORn not in ["y", "Y"]:
+                logger.debug("取消优化任务.")
+                return {}
+
+        self._exe_update_index_settings(sorted(candidates), read_only,
+                                        replicas, max_url_length)
+
+        # 已合并的index跳过
+        merge_state = self.es.get_merge_state(sorted(candidates))
+        result = {}
+        todo = {}
+        for name in sorted(candidates):
+            state = merge_state.get(name)
+            if state is None:
+                logger.warning("index[{}]没有分片信息, 跳过合并".format(name))
+                result[name] = "FAILED"
+            elif state["segments"] <= max_num_segments:
+                logger.debug("index[{}]已合并, 跳过".format(name))
+                result[name] = "SKIPPED"
+            else:
+                todo[name] = state["nodes"]
+
+        scheduler = ForceMergeScheduler(
+            self.es,
+            per_node=config.get("per_node", 1),
+            workers=config.get("workers", 4),
+            max_num_segments=max_num_segments,
+            timeout=config.get("timeout", 21600),
+            check_interval=config.get("check_interval", 30),
+            max_watch=config.get("max_watch", 120))
+        result.update(scheduler.run(todo))
+        logger.info("优化任务执行完成, 合并{}个, 跳过{}个, 未完成{}个".format(
+            len([_ for _ in result.values() if _ == "MERGED"]),
+            len([_ for _ in result.values() if _ == "SKIPPED"]),
+            len([_ for _ in result.values() if _ in ["FAILED", "TIMEOUT"]])))
+        return result
+
+    def job_settings(self, config):
+        '''
+        @description: 配置任务, 批量修改匹配的index配置或冻结
+        '''
+        return self._exe_settings_job(config)
+
+    def job_prune(self, config):
+        '''
+        @description: 快照清理任务, 按保留天数与数量删除快照, 按数量删除仓库
+        '''
+        repository = config.get("repository", "*")
+        if isinstance(repository, list):
+            repository = ",".join(repository)
+        snapshot_pattern = config.get("snapshot", "*")
+        if isinstance(snapshot_pattern, list):
+            snapshot_pattern = ",".join(snapshot_pattern)
+        dry_run = config.get("dry_run", False)
+        workers = int(config.get("workers", 4))
+        max_url_length = int(config.get("max_url_length", 4000))
+
+        repositories = _match_names(self.get_snapshot_repository().keys(),
+                                    repository)
+        if not repositories:
+            logger.info("没有匹配[{}]的快照仓库".format(repository))
+            return {}
+        listing = dict(
+            zip(repositories,
+                _thread_map(self.es.get_snapshot_list, repositories,
+                            workers)))
+        plan = self._prune_plan(listing, snapshot_pattern, config,
+                                self._backup_references())
+
+        for repository_name, item in sorted(plan.items()):
+            logger.info("{}仓库[{}]删除{}个快照{}{}".format(
+                "[dry run]" if dry_run else "", repository_name,
+                len(item["snapshots"]), item["snapshots"],
+                ", 删除仓库" if item["remove"] else ""))
+        if dry_run or not plan:
+            return plan
+
+        if not self.force:
+            yORn = raw_input("确定删除{}个快照, {}个仓库?  (y/n)".format(
+                sum(len(_["snapshots"]) for _ in plan.values()),
+                len([_ for _ in plan.values() if _["remove"]])))
+            if yORn not in ["y", "Y"]:
+                logger.debug("取消清理任务.")
+                return {}
+
+        # 7.8之前集群同一时间只能执行一个快照删除
+        if self.es.get_version() < (7, 8):
+            workers = 1
+
+        def _prune(repository_name):
+            item = plan[repository_name]
+            deleted = self.es.delete_snapshots(repository_name,
+                                               item["snapshots"],
+                                               max_url_length)
+            removed = None
+            if item["remove"] and all(deleted.values()):
+                removed = self._delete_snapshot_repository(repository_name)
+            return {"snapshots": deleted, "remove": removed}
+
+        names = sorted(plan)
+        result = dict(zip(names, _thread_map(_prune, names, workers)))
+        self._discard_backup_state(result)
+        logger.info("清理任务执行完成, 删除{}个快照, {}个仓库".format(
+            sum(
+                len([_ for _ in v["snapshots"].values() if _])
+                for v in result.values()),
+            len([_ for _ in result.values() if _["remove"]])))
+        return result
+
+    def _discard_backup_state(self, prune_result):
+        '''
+        @description: 删除增量备份状态中指向已删除快照与仓库的记录, 没有状态库时跳过
+        @param {dict}  prune_result  {仓库名: {"snapshots": {快照名: True/False}, "remove": True/False}}
+        '''
+        if not os.path.exists(self._backup_state_path()):
+            return
+        state = self._get_backup_state()
+        for repository_name, item in prune_result.items():
+            if item["remove"]:
+                state.discard(self._cluster_uuid, repository_name)
+            else:
+                state.discard(
+                    self._cluster_uuid, repository_name,
+                    [k for k, v in item["snapshots"].items() if v])
+
+    def _backup_references(self):
+        '''
+        @description: 增量备份中仍是现有index最后一次成功快照的快照, 没有状态库时为空
+        @return: dict {(仓库名, 快照名): [index名]}
+        '''
+        if not os.path.exists(self._backup_state_path()):
+            return {}
+        uuids = None
+        if self.catalog:
+            # 已删除的index不再需要保留快照
+            uuids = set(_["uuid"] for _ in self.catalog.data().values())
+        return self._get_backup_state().references(self._cluster_uuid, uuids)
+
+    def _prune_plan(self, listing, snapshot_pattern, config, protected=None):
+        '''
+        @description: 计算需要删除的快照与仓库
+        @param {dict}    listing           {仓库名: _cat/snapshots返回}
+        @param {string}  snapshot_pattern  快照名表达式
+        @param {dict}    protected         {(仓库名, 快照名): [index名]}, 增量备份仍依赖的快照不删除
+        @param {dict}    config            save: 快照保留天数
+                                           keep: 每个仓库最多保留的快照数
+                                           min_keep: 每个仓库至少保留的快照数
+                                           keep_repositories: 保留最新的仓库数
+                                           remove_empty: 删除已清空的仓库
+        @return: dict {仓库名: {"snapshots": [快照名], "remove": True/False}}
+        '''
+        save = config.get("save", None)
+        keep = config.get("keep", None)
+        min_keep = int(config.get("min_keep", 0))
+        keep_repositories = config.get("keep_repositories", None)
+        remove_empty = config.get("remove_empty", False)
+        protected = protected or {}
+        expire = self._expire_time(save) if save is not None else None
+        # 当前备份使用的仓库不删除
+        current = (self.settings or {}).get("snapshot", {}).get("repository", "")
+
+        start = lambda x: int(x.get("start_epoch") or 0)
+        expired_repositories = set()
+        if keep_repositories is not None:
+            ordered = sorted(listing,
+                             key=lambda r: (max([start(_) for _ in listing[r]]
+                                                or [0]), r),
+                             reverse=True)
+            expired_repositories = set(ordered[int(keep_repositories):])
+            expired_repositories.discard(current)
+
+        plan = {}
+        for repository_name, snapshots in listing.items():
+            matched = set(
+                _match_names([_["id"] for _ in snapshots], snapshot_pattern))
+            # 执行中的快照不能删除, 按开始时间从旧到新
+            finished = sorted([
+                _ for _ in snapshots
+                if _["id"] in matched and _["status"] != "IN_PROGRESS"
+            ],
+                              key=lambda x: (start(x), x["id"]))
+            if repository_name in expired_repositories:
+                delete = finished
+            else:
+                candidates = finished[:max(len(finished) - min_keep, 0)]
+                delete = []
+                for i, _ in enumerate(candidates):
+                    if expire is not None and start(_) * 1000 < expire:
+                        delete.append(_)
+                    elif keep is not None and len(finished) - i > int(keep):
+                        delete.append(_)
+            # 未变更的index跳过了快照, 删除它们最后一次成功快照后将没有任何备份
+            for _ in [_ for _ in delete
+                      if (repository_name, _["id"]) in protected]:
+                logger.warning("快照[{}/{}]是index{}最近的增量备份, 不删除".format(
+                    repository_name, _["id"],
+                    sorted(protected[(repository_name, _["id"])])))
+                delete.remove(_)
+            remove = (repository_name in expired_repositories or remove_empty
+                      ) and len(delete) == len(snapshots) and (
+                          repository_name != current)
+            if delete or remove:
+                plan[repository_name] = {
+                    "snapshots": [_["id"] for _ in delete],
+                    "remove": remove
+                }
+        return plan
+
+    def _delete_snapshot_repository(self, repository_name):
+        '''
+        @description: 删除快照仓库, 只取消注册, 不删除仓库中的文件
+        @return: True/False
+        '''
+        try:
+            result = self.es.snapshot.delete_repository(repository_name)
+            if result.get("acknowledged", ""):
+                logger.debug("删除快照仓库[{}]成功".format(repository_name))
+                return True
+            logger.error("删除快照仓库[{}]失败,返回:{}".format(
+                repository_name, result))
+        except es_exceptions.TransportError as e:
+            logger.error("删除快照仓库[{}]失败,原因:{}".format(repository_name, e))
+        return False
+
+    def job_restore(self, config):
+        '''
+        @description: 恢复任务, 默认使用snapshot配置中的仓库
+        '''
+        config = dict(config)
+        if not config.get("repository", ""):
+            config["repository"] = (self.settings or {}).get(
+                "snapshot", {}).get("repository", "")
+        return self._exe_restore_job(config)
+
+    def _exe_update_index_settings(self,
+                                   names,
+                                   read_only=True,
+                                   replicas=None,
+                                   max_url_length=4000):
+        '''
+        @description: 只修改与目标不一致的index, 相同修改内容的index批量提交
+        @param {list}  names     index名列表
+        @param {bool}  read_only 是否禁止写入
+        @param {int}   replicas  副本数, None时不修改
+        '''
+        import json
+        if self.catalog:
+            indices = self.catalog.data()
+            current = {
+                _: {
+                    "blocks": indices.get(_, {}).get("blocks", {}),
+                    "number_of_replicas": indices.get(_, {}).get("replicas", "")
+                }
+                for _ in names
+            }
+        else:
+            current = self.es.get_indices_settings(
+                names, ["blocks.write", "number_of_replicas"])
+
+        groups = {}
+        for name in names:
+            settings = current.get(name, {})
+            body = {}
+            if read_only and str(settings.get("blocks", {}).get(
+                    "write", "false")).lower() != "true":
+                body["index.blocks.write"] = True
+            if replicas is not None and str(settings.get(
+                    "number_of_replicas", "")) != str(replicas):
+                body["index.number_of_replicas"] = int(replicas)
+            if body:
+                groups.setdefault(json.dumps(body, sort_keys=True),
+                                  []).append(name)
+
+        self._put_index_settings_groups(groups, max_url_length)
+        if groups and self.catalog:
+            self.catalog.invalidate()
+
+    def _exe_create_snapshot_job(self,
+                                 snapshot_repository_name,
+                                 snapshot_repository_post_body,
+                                 index_list,
+                                 index_body,
+                                 include_mode=False,
+                                 concurrency=1,
+                                 **kwargs):
+        '''
+        @description:  执行创建快照任务
+        @param {string}   snapshot_repository_name 快照仓库名
+        @param {dict}     snapshot_repository_post_body 快照仓库创建body
+        @param {list/string}     index_list  需要快照的index列表
+        @param {dict}     index_body  index创建body
+        @param {int}      concurrency 同时执行的快照数
+        @return: dict {快照名: 状态}
+        '''
+        # 判断快照仓库, 运行日志中已确认的仓库不再检查
+        repository_ready = True
+        if self.journal and self.journal.get("repository",
+                                             snapshot_repository_name):
+            pass
+        elif not self.get_snapshot_repository(snapshot_repository_name):
+            repository_ready = False
+            if not self.force:
+                yORn = raw_input(
+                    "确定需要创建[{}]快照仓库?  (y/n)".format(snapshot_repository_name))
+                if yORn == "y" or yORn == "Y":
+                    create_result = self.create_snapshot_repository(
+                        snapshot_repository_name,
+                        snapshot_repository_post_body)
+                    repository_ready = create_result
+                    if not create_result:
+                        logger.error(
+                            "创建[{}]快照仓库失败!".format(snapshot_repository_name))
+            else:
+                logger.debug(
+                    "没找到名为[{}]的快照仓库,需要创建".format(snapshot_repository_name))
+                repository_ready = self.create_snapshot_repository(
+                    snapshot_repository_name, snapshot_repository_post_body)
+
+        # 强制转index列表
+        index_list = [index_list] if isinstance(index_list,
+                                                str) else index_list
+
+        # 快照任务列表 [(快照名, index列表)]
+        tasks = []
+
+        # 存在快照名
+        if kwargs.get("snapshot_name", None):
+            _all_index_list = self.get_index_list()
+            tasks.append((kwargs["snapshot_name"],
+                          [_ for _ in index_list if _ in _all_index_list]))
+        else:
+            if include_mode:
+                # 生成一个index任务
+                # 包含该关键字的所有索引
+                for _ in index_list:
+                    _index_list = self.get_index_list("{}*".format(_))
+                    if _index_list:
+                        tasks.append((_, _index_list))
+            else:
+                for _ in index_list:
+                    tasks.append((_, [_]))
+
+        # 仓库已存在或创建成功才记入运行日志
+        if self.journal and repository_ready:
+            self.journal.record("repository", snapshot_repository_name,
+                                "ready")
+
+        # 运行日志中已成功的快照
+        finished = {}
+        if self.journal:
+            for name, _ in tasks:
+                if self.journal.get(
+                        "snapshot", "{}/{}".format(snapshot_repository_name,
+                                                   name)) == "SUCCESS":
+                    logger.info("运行日志中快照[{}]已完成, 跳过".format(name))
+                    finished[name] = "SUCCESS"
+            tasks = [_ for _ in tasks if _[0] not in finished]
+
+        # 增量备份, 跳过未变更的index
+        skipped, fingerprints = [], {}
+        if kwargs.get("incremental", False):
+            tasks, skipped, fingerprints = self._filter_unchanged_index(tasks)
+
+        # 渲染
+        scheduler = SnapshotScheduler(self.es,
+                                      concurrency,
+                                      journal=self.journal)
+        result = scheduler.run([
+            (snapshot_repository_name, name,
+             Config.format_data(index_body, {"index": ",".join(indices)}))
+            for name, indices in tasks
+        ])
+
+        if fingerprints:
+            self._save_backup_state(snapshot_repository_name, tasks,
+                                    fingerprints, result)
+        for _ in skipped:
+            result[_] = "UNCHANGED"
+        result.update(finished)
+
+        logger.info("S3快照任务执行完成")
+        return result
+
+    def _get_backup_state(self):
+        '''
+        @description: 增量备份状态库, 路径由配置state.path指定
+        '''
+        if getattr(self, "_backup_state", None) is None:
+            self._backup_state = BackupState(self._backup_state_path())
+            self._cluster_uuid = self.es.info().get("cluster_uuid", "")
+        return self._backup_state
+
+    def _backup_state_path(self):
+        return ((self.settings or {}).get("state", None) or {}).get(
+            "path", "{}.state.db".format(os.path.splitext(__file__)[0]))
+
+    def _filter_unchanged_index(self, tasks):
+        '''
+        @description: 对比上次成功快照时的指纹, 去掉未变更的index
+        @param {list}  tasks  [(快照名, index列表)]
+        @return: (需要执行的tasks, 全部未变更的快照名, {index: 指纹})
+        '''
+        state = self._get_backup_state()
+        catalog = self.catalog.data()
+
+        resolved = {}
+        for name, indices in tasks:
+            resolved[name] = sorted(
+                set(sum([self.get_index_list(_) for _ in indices], [])))
+        # 关闭的index无法获取stats, 按已变更处理
+        fingerprints = self.es.get_index_fingerprint(
+            sorted(
+                set(_ for names in resolved.values() for _ in names
+                    if catalog[_]["state"] == "open")))
+        last = state.get(
+            self._cluster_uuid,
+            set(catalog[_]["uuid"] for _ in fingerprints if _ in catalog))
+
+        # 记录的快照已被删除(prune、删除仓库、手动或SLM删除)时按已变更处理
+        available = set()
+        for repository_name in sorted(set(_[1] for _ in last.values())):
+            available.update(
+                (repository_name, k) for k, v in self.es.get_snapshot_names(
+                    repository_name).items() if v == "SUCCESS")
+
+        result, skipped = [], []
+        for name, indices in tasks:
+            if not resolved[name]:
+                result.append((name, indices))
+                continue
+            changed = []
+            for _ in resolved[name]:
+                previous = last.get(catalog[_]["uuid"], None)
+                if _ in fingerprints and previous and previous[
+                        0] == fingerprints[_]:
+                    if (previous[1], previous[2]) in available:
+                        logger.debug("index[{}]未变更, 最近快照:{}/{}".format(
+                            _, previous[1], previous[2]))
+                        continue
+                    logger.debug("index[{}]未变更, 但最近快照{}/{}已不存在".format(
+                        _, previous[1], previous[2]))
+                changed.append(_)
+            if changed:
+                result.append((name, changed))
+            else:
+                logger.info("快照[{}]的index均未变更, 跳过".format(name))
+                skipped.append(name)
+        return result, skipped, {
+            k: v
+            for k, v in fingerprints.items()
+            if any(k in indices for _, indices in result)
+        }
+
+    def _save_backup_state(self, repository_name, tasks, fingerprints,
+                           result):
+        '''
+        @description: 记录快照成功的index指纹
+        '''
+        catalog = self.catalog.data()
+        rows = []
+        for name, indices in tasks:
+            if result.get(name, "") != "SUCCESS":
+                continue
+            for _ in indices:
+                if _ in fingerprints and _ in catalog:
+                    rows.append((catalog[_]["uuid"], _, fingerprints[_],
+                                 repository_name, name))
+        if rows:
+            self._get_backup_state().set(self._cluster_uuid, rows)
+
+    def _exe_delete_index_job(self,
+                              index,
+                              save_day,
+                              workers=1,
+                              max_url_length=4000,
+                              date_pattern=None):
+        '''
+        @description:  执行删除index任务
+        @param {string}  index      索引名 
+        @param {int}     save_day   保存时间
+        @param {int}     workers    并发删除线程数
+        @param {int}     max_url_length  单次批量删除的URL长度上限
+        @param {string}  date_pattern    按index名中的日期删除, 如"%Y.%m.%d"
+        @return: dict {index: True/False}
+        '''
+        from time import localtime, strftime
+        delete_result = {}
+        result = self._get_expired_index(index, save_day, date_pattern)
+        if self.journal:
+            result = {
+                k: v
+                for k, v in result.items()
+                if not self.journal.get("delete", k)
+            }
+
+        # 发现需要删除列表
+        if result:
+            if self.force:
+                delete_result = self.es.delete_indices(
+                    sorted(result), max_url_length, workers)
+                self._discard_index(delete_result)
+                for index_name, create_time in sorted(result.items()):
+                    if delete_result.get(index_name):
+                        strTime = strftime("%Y年%m月%d日",
+                                           localtime(int(create_time[:10])))
+                        logger.debug("[*]index[{}]被删除,因该index创建于{}".format(
+                            index_name, strTime))
+                    else:
+                        logger.debug("[*]index[{}]删除失败".format(index_name))
+            else:
+                # 先逐个确认, 再批量删除
+                confirm_list = []
+                for index_name, create_time in sorted(result.items()):
+                    strTime = strftime("%Y年%m月%d日",
+                                       localtime(int(create_time[:10])))
+                    logger.debug(
+                        "index[{}]需要被删除,因配置文件保留{}天,而该index创建于{}".format(
+                            index_name, save_day, strTime))
+                    yORn = raw_input("确定删除[{}]?  (y/n)".format(index_name))
+                    if yORn == "y" or yORn == "Y":
+                        confirm_list.append(index_name)
+                    else:
+                        logger.debug("取消删除[{}]任务.".format(index_name))
+                delete_result = self.es.delete_indices(
+                    confirm_list, max_url_length, workers)
+                self._discard_index(delete_result)
+                for index_name in confirm_list:
+                    if delete_result.get(index_name):
+                        logger.debug("[*]index[{}]已被删除".format(index_name))
+                    else:
+                        logger.debug("[*]index[{}]删除失败".format(index_name))
+        else:
+            logger.info("[{}]的删除任务执行完成.没发现需要删除的index.".format(index))
+        return delete_result
+
+    def _get_expired_index(self, index, save_day, date_pattern=None):
+        '''
+        @description: 超过保留天数的index
+        @param {string}  index         index前缀
+        @param {int}     save_day      保留天数
+        @param {string}  date_pattern  按index名中的日期判断, 如"%Y.%m.%d"
+        @return: dict {index: 创建时间毫秒}
+        '''
+        if date_pattern:
+            # 只需要index名, 不读取settings
+            timeline = IndexTimeline(self.get_index_list("{}*".format(index)),
+                                     date_pattern)
+            return timeline.before(self._expire_time(save_day))
+        index_create_date_list = self._get_index_create_data(index)
+        return self._filter_index(index_create_date_list, int(save_day))
+
+    def _discard_index(self, delete_result):
+        '''
+        @description: 同步元数据目录中已删除的index, 并写入运行日志
+        @param {dict}  delete_result  {index: True/False}
+        '''
+        if self.journal:
+            self.journal.record(
+                "delete", sorted([k for k, v in delete_result.items() if v]),
+                "deleted")
+        if self.catalog:
+            self.catalog.discard([k for k, v in delete_result.items() if v])
+
+    def _get_index_create_data(self, index):
+        '''
+        @description: 获取index配置
+        @param {string} name  index前缀
+        '''
+        if self.catalog:
+            return self.catalog.creation_dates("{}*".format(index))
+        return {
+            k: v["creation_date"]
+            for k, v in self.es.iter_index_settings(index, ["creation_date"])
+        }
+
+
+class Cmd(Job):
+    def __init__(self, es, job, force=False, options=None):
+        self.es = es
+        self.force = force
+        self.job = job
+        # -o传入的参数
+        self.options = options or {}
+
+    def job_restore(self):
+        '''
+        description: 恢复快照
+        '''
+        return self._exe_restore_job(self.options)
+
+    def job_settings(self):
+        '''
+        description: 批量修改index配置
+        '''
+        return self._exe_settings_job(self.options)
+
+    def job_shards(self):
+        '''
+        description: 分片分析, 过大/过小分片与节点不均衡
+        '''
+        options = self.options
+        result = StorageAnalyzer(self.es, options.get(
+            "family_pattern", None)).shards(
+                options.get("index", ""),
+                _parse_size(options.get("max_shard_size", "50gb")),
+                _parse_size(options.get("min_shard_size", "1gb")),
+                int(options.get("top", 10)))
+        logger.info("共{}个分片, 主分片{}个, 未分配{}个".format(
+            result["shards"], result["primaries"], result["unassigned"]))
+        logger.info("节点不均衡(最大/平均): 分片数{:.2f}, 存储{:.2f}".format(
+            result["imbalance"]["shards"], result["imbalance"]["bytes"]))
+        for _ in result["nodes"]:
+            logger.info("node[{}] {}个分片 {}".format(_["node"], _["shards"],
+                                                  _format_size(_["bytes"])))
+        logger.info("过大分片{}个, 过小分片{}个".format(result["oversized_count"],
+                                               result["undersized_count"]))
+        for _ in result["oversized"]:
+            logger.info("过大分片: {}[{}]{} {} node[{}]".format(
+                _["index"], _["shard"], _["prirep"],
+                _format_size(_["store"]), _["node"]))
+        for _ in result["undersized_families"]:
+            logger.info("过小分片: 前缀[{}] {}个".format(_["family"], _["shards"]))
+        return result
+
+    def job_storage(self):
+        '''
+        description: 存储分析, 按index前缀统计并估算快照容量
+        '''
+        options = self.options
+        snapshot = options.get("snapshot", "*")
+        if isinstance(snapshot, list):
+            snapshot = ",".join(snapshot)
+        result = StorageAnalyzer(self.es, options.get(
+            "family_pattern", None)).storage(options.get("index", ""), snapshot,
+                                             int(options.get("top", 10)))
+        total = result["total"]
+        logger.info("共{}个index, {}个文档, 主分片{}, 总计{}".format(
+            total["indices"], int(total["docs"]),
+            _format_size(total["primary_bytes"]), _format_size(total["bytes"])))
+        for _ in result["families"]:
+            logger.info("前缀[{}] {}个index, {}个文档, 主分片{}, 总计{}".format(
+                _["family"], _["indices"], int(_["docs"]),
+                _format_size(_["primary_bytes"]), _format_size(_["bytes"])))
+        logger.info("匹配[{}]的index全量快照约{}".format(
+            snapshot, _format_size(result["snapshot_bytes"])))
+        return result
+
+    def job_getReadOnly(self):
+        '''
+        description: 获取只读
+        '''
+        from functools import partial
+        # 只取frozen和blocks, 没有设置的index不会返回
+        settings = self.es.iter_index_settings(fields=["frozen", "blocks"])
+
+        frozen = lambda x: x.get("frozen", "false") == "true"
+        blocks_item = lambda i, x: x.get("blocks", {}).get(i, "false"
+                                                          ) == "true"
+        write = partial(blocks_item, "write")
+        read_only = partial(blocks_item, "read_only")
+
+        result = {"frozen": [], "write": [], "read_only": []}
+        for i, item in settings:
+            if frozen(item):
+                logger.info("frozen index: {}".format(i))
+                result["frozen"].append(i)
+
+            if write(item):
+                logger.info("block write: {}".format(i))
+                result["write"].append(i)
+
+            if read_only(item):
+                logger.info("block read_only: {}".format(i))
+                result["read_only"].append(i)
+        return result
+
+    def run(self):
+        job = self.get_job(self.job)
+        if job:
+            with metrics.timer("job", job=self.job, name=self.job):
+                return job()
+        else:
+            logger.error("{}方法没有找到.".format(self.job))
+
+
+class CatTable:
+    '''
+    @description: _cat文本结果的列式存储, 字符串列存为编号(相同的值只存一份), 数值列存为array, 不为每行创建dict
+    '''
+
+    def __init__(self, strings, numbers):
+        '''
+        @param {list}  strings  字符串列名
+        @param {list}  numbers  数值列名
+        '''
+        from array import array
+        self.strings = list(strings)
+        self.numbers = list(numbers)
+        # {列名: {值: 编号}}, {列名: [值]}
+        self.ids = dict((_, {}) for _ in strings)
+        self.values = dict((_, []) for _ in strings)
+        self.columns = dict((_, array("l")) for _ in strings)
+        self.columns.update((_, array("d")) for _ in numbers)
+        self.size = 0
+
+    def intern(self, column, value):
+        ids = self.ids[column]
+        i = ids.get(value, None)
+        if i is None:
+            i = ids[value] = len(self.values[column])
+            self.values[column].append(value)
+        return i
+
+    def append(self, strings, numbers):
+        for column, value in zip(self.strings, strings):
+            self.columns[column].append(self.intern(column, value))
+        for column, value in zip(self.numbers, numbers):
+            self.columns[column].append(value)
+        self.size += 1
+
+    def group_sum(self, keys, column=None, size=None):
+        '''
+        @description: 按编号分组求和, 安装numpy时向量化计算
+        @param {array}   keys    编号列或编号数组
+        @param {string}  column  求和的数值列, 为None时计数
+        @param {int}     size    分组数
+        @return: list 按编号排列的合计
+        '''
+        if isinstance(keys, basestring):
+            size = len(self.values[keys]) if size is None else size
+            keys = self.columns[keys]
+        weights = self.columns[column] if column else None
+        if not len(keys):
+            return [0] * (size or 0)
+        np = _optional_import("numpy")
+        if np is not None:
+            return np.bincount(_as_numpy(np, keys),
+                               weights=None if weights is None else
+                               _as_numpy(np, weights),
+                               minlength=size or 0).tolist()
+        result = [0] * (size or (max(keys) + 1))
+        if weights is None:
+            for k in keys:
+                result[k] += 1
+        else:
+            for k, v in zip(keys, weights):
+                result[k] += v
+        return result
+
+    def remap(self, column, mapping):
+        '''
+        @description: 编号列按mapping转换为新的编号, 如index编号转为前缀编号
+        @return: array
+        '''
+        from array import array
+        np = _optional_import("numpy")
+        if np is not None:
+            result = np.asarray(mapping, dtype="i8")[_as_numpy(
+                np, self.columns[column])]
+            return array("l", result.astype("i{}".format(
+                array("l").itemsize)).tostring())
+        return array("l", [mapping[_] for _ in self.columns[column]])
+
+    def where(self, column, predicate):
+        '''
+        @description: 数值列满足条件的行号
+        @param {function}  predicate  作用于列的条件, 如 lambda x: x > 100
+        @return: list
+        '''
+        np = _optional_import("numpy")
+        values = self.columns[column]
+        if np is not None and len(values):
+            return np.nonzero(predicate(_as_numpy(np, values)))[0].tolist()
+        return [i for i, v in enumerate(values) if predicate(v)]
+
+    def row(self, i):
+        '''
+        @description: 单行转为dict, 只用于输出
+        '''
+        result = dict((_, self.values[_][self.columns[_][i]])
+                      for _ in self.strings)
+        result.update((_, self.columns[_][i]) for _ in self.numbers)
+        return result
+
+
+# array零拷贝转为numpy数组
+def _as_numpy(np, values):
+    return np.frombuffer(values,
+                         dtype="{}{}".format("f" if values.typecode == "d"
+                                             else "i", values.itemsize))
+
+
+class StorageAnalyzer:
+    '''
+    @description: 流式读取_cat/shards与_cat/indices的文本结果, 统计分片大小、节点分布与快照容量
+    '''
+
+    # 去掉index名末尾的日期与rollover序号得到前缀
+    family_pattern = r"([-_.]?\d{4}[-_.]?\d{2}([-_.]?\d{2}){0,2})?([-_.]\d{6})?$"
+
+    def __init__(self, es, family_pattern=None):
+        self.es = es
+        self.family_regex = re.compile(family_pattern or self.family_pattern)
+
+    def family(self, name):
+        return self.family_regex.sub("", name, count=1) or name
+
+    def load_shards(self, index=""):
+        '''
+        @description: 读取_cat/shards
+        @return: CatTable 字符串列index/shard/prirep/state/node, 数值列docs/store
+        '''
+        table = CatTable(["index", "shard", "prirep", "state", "node"],
+                         ["docs", "store"])
+        for line in self.es.iter_lines(
+                "/_cat/shards{}".format("/" + index if index else ""), {
+                    "h": "index,shard,prirep,state,docs,store,node",
+                    "bytes": "b"
+                }):
+            parts = line.split()
+            if len(parts) < 4:
+                continue
+            # 未分配的分片没有docs/store/node, 初始化中的分片可能没有docs/store
+            numbers, rest = [], parts[4:]
+            while rest and len(numbers) < 2 and rest[0].isdigit():
+                numbers.append(float(rest.pop(0)))
+            if len(numbers) == 1:
+                numbers.insert(0, 0.0)
+            table.append(parts[:4] + [rest[0] if rest else ""],
+                         numbers or [0.0, 0.0])
+        return table
+
+    def load_indices(self, index=""):
+        '''
+        @description: 读取_cat/indices
+        @return: CatTable 字符串列index, 数值列pri/rep/docs/primary_store/store
+        '''
+        table = CatTable(["index"],
+                         ["pri", "rep", "docs", "primary_store", "store"])
+        for line in self.es.iter_lines(
+                "/_cat/indices{}".format("/" + index if index else ""), {
+                    "h": "index,pri,rep,docs.count,pri.store.size,store.size",
+                    "bytes": "b"
+                }):
+            parts = line.split()
+            if not parts:
+                continue
+            # 关闭的index没有docs与store
+            numbers = [float(_) for _ in parts[1:6] if _.isdigit()]
+            table.append(parts[:1], (numbers + [0.0] * 5)[:5])
+        return table
+
+    def families(self, table):
+        '''
+        @description: index编号到前缀编号的映射
+        @return: (每行的前缀编号array, 前缀名列表)
+        '''
+        ids, names, mapping = {}, [], []
+        for name in table.values["index"]:
+            family = self.family(name)
+            if family not in ids:
+                ids[family] = len(names)
+                names.append(family)
+            mapping.append(ids[family])
+        return table.remap("index", mapping), names
+
+    def shards(self,
+               index="",
+               max_shard_size=50 * 1024**3,
+               min_shard_size=1024**3,
+               top=10):
+        '''
+        @description: 分片统计: 过大/过小分片、节点不均衡
+        @param {int}  max_shard_size  超过该字节数的分片为过大
+        @param {int}  min_shard_size  小于该字节数的已分配分片为过小
+        @return: dict
+        '''
+        table = self.load_shards(index)
+        nodes = table.values["node"]
+        node_shards = table.group_sum("node")
+        node_bytes = table.group_sum("node", "store")
+        assigned = [i for i, _ in enumerate(nodes) if _]
+        unassigned = node_shards[nodes.index("")] if "" in nodes else 0
+
+        oversized = sorted(table.where("store",
+                                       lambda x: x > max_shard_size),
+                           key=lambda i: -table.columns["store"][i])
+        undersized = table.where("store", lambda x: x < min_shard_size)
+        family_keys, family_names = self.families(table)
+        small = {}
+        for i in undersized:
+            # 未分配的分片没有大小
+            if nodes[table.columns["node"][i]]:
+                family = family_names[family_keys[i]]
+                small[family] = small.get(family, 0) + 1
+
+        def _imbalance(values):
+            values = [values[_] for _ in assigned]
+            if not values or not sum(values):
+                return 0.0
+            return max(values) / (float(sum(values)) / len(values))
+
+        return {
+            "shards": table.size,
+            "primaries":
+            table.group_sum("prirep")[table.ids["prirep"]["p"]]
+            if "p" in table.ids["prirep"] else 0,
+            "unassigned": unassigned,
+            "nodes":
+            sorted([{
+                "node": nodes[_],
+                "shards": node_shards[_],
+                "bytes": node_bytes[_]
+            } for _ in assigned],
+                   key=lambda x: -x["bytes"]),
+            "imbalance": {
+                "shards": _imbalance(node_shards),
+                "bytes": _imbalance(node_bytes)
+            },
+            "oversized_count": len(oversized),
+            "oversized": [table.row(_) for _ in oversized[:top]],
+            "undersized_count": sum(small.values()),
+            "undersized_families": [{
+                "family": k,
+                "shards": v
+            } for k, v in sorted(small.items(), key=lambda x: -x[1])[:top]],
+        }
+
+    def storage(self, index="", snapshot="*", top=10):
+        '''
+        @description: 按index前缀统计文档数与存储, 估算快照容量(主分片大小)
+        @param {string}  snapshot  需要快照的index表达式
+        @return: dict
+        '''
+        table = self.load_indices(index)
+        family_keys, family_names = self.families(table)
+        size = len(family_names)
+        counts = table.group_sum(family_keys, size=size)
+        docs = table.group_sum(family_keys, "docs", size)
+        primary = table.group_sum(family_keys, "primary_store", size)
+        store = table.group_sum(family_keys, "store", size)
+        families = sorted([{
+            "family": family_names[i],
+            "indices": counts[i],
+            "docs": docs[i],
+            "primary_bytes": primary[i],
+            "bytes": store[i],
+        } for i in range(size)],
+                          key=lambda x: -x["bytes"])
+
+        # 快照只包含主分片
+        matched = set(
+            table.ids["index"][_]
+            for _ in _match_names(table.values["index"], snapshot))
+        index_primary = table.group_sum("index", "primary_store")
+        return {
+            "families": families[:top],
+            "total": {
+                "indices": table.size,
+                "docs": sum(docs),
+                "primary_bytes": sum(primary),
+                "bytes": sum(store),
+            },
+            "snapshot_bytes": sum(index_primary[_] for _ in matched),
+        }
+
+
+# 嵌套配置展开为点分隔的key, 去掉"index."前缀
+def _flatten_settings(settings, prefix=""):
+    result = {}
+    for key, value in settings.items():
+        key = prefix + key
+        if isinstance(value, dict):
+            result.update(_flatten_settings(value, key + "."))
+        else:
+            result[key[6:] if key.startswith("index.") else key] = value
+    return result
+
+
+# 按点分隔的key读取settings.index中的值, 兼容嵌套与展开两种格式
+def _get_setting(settings, key):
+    if key in settings:
+        return settings[key]
+    head, _, rest = key.partition(".")
+    if rest and isinstance(settings.get(head, None), dict):
+        return _get_setting(settings[head], rest)
+    return None
+
+
+# 配置值统一转为ES返回的字符串格式
+def _setting_str(value):
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return None if value is None else str(value).lower()
+
+
+# 字节数转为可读格式
+def _format_size(size):
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if abs(size) < 1024 or unit == "TB":
+            return "{:.1f}{}".format(size, unit)
+        size /= 1024.0
+
+
+# 解析"50gb"等大小, 返回字节数
+def _parse_size(value):
+    if isinstance(value, (int, long, float)):
+        return value
+    match = re.match(r"^\s*([\d.]+)\s*([kmgt]?)b?\s*$", str(value).lower())
+    if not match:
+        raise ValueError("无法解析大小[{}]".format(value))
+    return float(match.group(1)) * 1024**"bkmgt".index(match.group(2) or "b")
+
+
+class Fleet:
+    '''
+    @description: 多集群并发执行, 每个集群独立连接, 单个集群异常不影响其他集群
+    '''
+
+    def __init__(self, clusters, concurrency=4):
+        '''
+        @param {list}  clusters     [{"name": 集群名, "url": 地址}]
+        @param {int}   concurrency  同时操作的集群数
+        '''
+        self.clusters = clusters
+        self.concurrency = int(concurrency)
+
+    def run(self, func):
+        '''
+        @description: 对每个集群执行func(cluster)
+        @return: list [{cluster, status, elapsed, result}]
+        '''
+        from time import time
+
+        def _run(cluster):
+            name = cluster.get("name", None) or ",".join(
+                _es_hosts(cluster["url"]))
+            start = time()
+            context = _job_local()
+            previous = getattr(context, "cluster", None)
+            context.cluster = name
+            try:
+                result, status = func(cluster), "success"
+            except Exception as e:
+                logger.error("集群[{}]执行失败: {}".format(name, e))
+                result, status = str(e), "failed"
+            finally:
+                context.cluster = previous
+            return {
+                "cluster": name,
+                "status": status,
+                "elapsed": time() - start,
+                "result": result,
+            }
+
+        report = _thread_map(_run, self.clusters, self.concurrency)
+        self.log_report(report)
+        return report
+
+    @classmethod
+    def log_report(cls, report):
+        '''
+        @description: 输出汇总结果
+        '''
+        logger.info("多集群执行完成, 共{}个集群, 失败{}个".format(
+            len(report), len([_ for _ in report if _["status"] != "success"])))
+        for _ in report:
+            logger.info("集群[{}] {} 耗时{:.1f}秒 {}".format(
+                _["cluster"], _["status"], _["elapsed"],
+                cls._summary(_["result"])))
+
+    @classmethod
+    def _summary(cls, result):
+        # playbook任务列表
+        if isinstance(result, list):
+            status = {}
+            for _ in result:
+                status[_["status"]] = status.get(_["status"], 0) + 1
+            return ", ".join(
+                ["{}:{}".format(k, v) for k, v in sorted(status.items())])
+        # cmd结果
+        if isinstance(result, dict):
+            return ", ".join([
+                "{}:{}".format(k, len(v) if isinstance(v, list) else v)
+                for k, v in sorted(result.items())
+            ])
+        return str(result) if result is not None else ""
+
+
+class CronSchedule:
+    '''
+    @description: crontab时间表达式, 分 时 日 月 周, 支持* , - /
+    '''
+
+    # (最小值, 最大值)
+    fields = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+    def __init__(self, expr):
+        self.expr = expr
+        parts = expr.split()
+        if len(parts) != 5:
+            raise ValueError("cron表达式[{}]应为5段".format(expr))
+        self.values = [
+            self._parse(part, low, high)
+            for part, (low, high) in zip(parts, self.fields)
+        ]
+        # 周日可写为0或7
+        if 7 in self.values[4]:
+            self.values[4].add(0)
+        self.any_day = parts[2] == "*"
+        self.any_weekday = parts[4] == "*"
+
+    @classmethod
+    def _parse(cls, part, low, high):
+        result = set()
+        for item in part.split(","):
+            value, _, step = item.partition("/")
+            step = int(step) if step else 1
+            if value == "*":
+                start, end = low, high
+            elif "-" in value:
+                start, end = [int(_) for _ in value.split("-", 1)]
+            else:
+                start = int(value)
+                end = high if step > 1 else start
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError("cron字段[{}]超出范围{}-{}".format(
+                    item, low, high))
+            result.update(range(start, end + 1, step))
+        return result
+
+    def match(self, timestamp):
+        '''
+        @description: 本地时间是否匹配
+        @param {int}  timestamp  秒级时间戳
+        @return: True/False
+        '''
+        from time import localtime
+        t = localtime(timestamp)
+        minutes, hours, days, months, weekdays = self.values
+        if t.tm_min not in minutes or t.tm_hour not in hours:
+            return False
+        if t.tm_mon not in months:
+            return False
+        day = t.tm_mday in days
+        # tm_wday周一为0, cron周日为0
+        weekday = (t.tm_wday + 1) % 7 in weekdays
+        # 日与周都有限制时满足其一即可
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+
+class Daemon:
+    '''
+    @description: 常驻运行, 按cron执行playbook; 复用每个集群的连接, 配置文件变更时重新加载
+    '''
+
+    def __init__(self, path, metrics_json=None, metrics_prom=None):
+        '''
+        @param {string}  path  配置文件路径, daemon.jobs为[{playbook, cron}]
+        '''
+        from threading import Lock
+        self.path = path
+        self.metrics_json = metrics_json
+        self.metrics_prom = metrics_prom
+        self.lock = Lock()
+        # {文件路径: (mtime, 内容)}
+        self.files = {}
+        self.jobs = []
+        self.running = set()
+        # {(url, maxsize): Es}
+        self.clients = {}
+
+    def read(self, path):
+        '''
+        @description: 读取yaml, 文件未变更时返回缓存
+        @return: (是否变更, 内容)
+        '''
+        mtime = os.path.getmtime(path)
+        cached = self.files.get(path)
+        if cached and cached[0] == mtime:
+            return False, cached[1]
+        data = Config.read(path)
+        self.files[path] = (mtime, data)
+        if cached:
+            logger.info("配置文件[{}]已变更, 重新加载".format(path))
+        return True, data
+
+    def reload(self):
+        '''
+        @description: 检查配置文件, 变更时重新解析任务
+        '''
+        try:
+            changed, data = self.read(self.path)
+        except Exception as e:
+            logger.error("读取配置文件[{}]失败, 继续使用原配置: {}".format(self.path, e))
+            return
+        if not changed:
+            return
+        jobs = []
+        for i, _ in enumerate((data.get("daemon", None) or {}).get("jobs", [])):
+            try:
+                jobs.append({
+                    "name": _.get("name", _["playbook"]),
+                    "playbook": _["playbook"],
+                    "cron": CronSchedule(_["cron"]),
+                })
+            except (KeyError, ValueError) as e:
+                logger.error("daemon第{}个任务配置错误: {}".format(i + 1, e))
+        self.jobs = jobs
+        logger.info("daemon加载{}个任务: {}".format(
+            len(jobs), ", ".join(
+                ["{}({})".format(_["name"], _["cron"].expr) for _ in jobs])))
+
+        # 丢弃配置中已不存在的集群连接, 执行中的任务仍持有引用
+        es_settings = data.get("elasticsearch", None) or {}
+        urls = [_["url"] for _ in es_settings.get("clusters", None) or []]
+        urls.append(es_settings.get("url", None))
+        keys = [self._client_key(_, es_settings) for _ in urls]
+        with self.lock:
+            for key in list(self.clients):
+                if key not in keys:
+                    self.clients.pop(key)
+
+    def client(self, url, options=None):
+        '''
+        @description: 每个集群只创建一次连接, 保持keep-alive
+        '''
+        key = self._client_key(url, options)
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = _connect(url, options)
+            return self.clients[key]
+
+    @classmethod
+    def _client_key(cls, url, options=None):
+        '''
+        @description: 地址与连接参数都相同时复用连接
+        '''
+        import json
+        return (tuple(_es_hosts(url) or []),
+                json.dumps(_connection_options(options), sort_keys=True))
 
-        if isinstance(index_name, list):
-            # 遍历index列表
-            for i in index_name:
-                self._exe_delete_index_job(i, save_day)
-        elif isinstance(index_name, str):
-            self._exe_delete_index_job(index_name, save_day)
+    def run_job(self, job):
+        '''
+        @description: 执行一次playbook, 每次重新计算env
+        '''
+        from copy import deepcopy
+        name = job["name"]
+        try:
+            _, book = self.read(job["playbook"])
+            config = Config(self.path, data=deepcopy(self.files[self.path][1]))
+            # daemon无法交互确认
+            return _run_playbook(config, deepcopy(book), True, self.client)
+        except Exception as e:
+            logger.error("daemon任务[{}]执行失败: {}".format(name, e))
+        finally:
+            with self.lock:
+                self.running.discard(name)
+            metrics.export(self.metrics_json, self.metrics_prom)
 
-    def _exe_create_snapshot_job(self,
-                                 snapshot_repository_name,
-                                 snapshot_repository_post_body,
-                                 index_list,
-                                 index_body,
-                                 include_mode=False,
-                                 **kwargs):
+    def start(self, job):
+        from threading import Thread
+        with self.lock:
+            if job["name"] in self.running:
+                logger.warning("daemon任务[{}]上次执行未结束, 跳过本次".format(
+                    job["name"]))
+                return
+            self.running.add(job["name"])
+        logger.info("daemon任务[{}]开始执行".format(job["name"]))
+        thread = Thread(target=self.run_job, args=(job, ))
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
         '''
-        @description:  执行创建快照任务
-        @param {string}   snapshot_repository_name 快照仓库名
-        @param {dict}     snapshot_repository_post_body 快照仓库创建body
-        @param {list/string}     index_list  需要快照的index列表
-        @param {dict}     index_body  index创建body
+        @description: 每分钟检查一次, 补执行因休眠错过的分钟
         '''
-        # 判断快照仓库
-        if not self.get_snapshot_repository(snapshot_repository_name):
-            if not self.force:
-                yORn = raw_input(
-                    "确定需要创建[{}]快照仓库?  (y/n)".format(snapshot_repository_name))
-                if yORn == "y" or yORn == "Y":
-                    create_result = self.create_snapshot_repository(
-                        snapshot_repository_name,
-                        snapshot_repository_post_body)
-                    if not create_result:
-                        logger.error(
-                            "创建[{}]快照仓库失败!".format(snapshot_repository_name))
-            else:
-                logger.debug(
-                    "没找到名为[{}]的快照仓库,需要创建".format(snapshot_repository_name))
-                self.create_snapshot_repository(snapshot_repository_name,
-                                                snapshot_repository_post_body)
+        from time import sleep, time
+        self.reload()
+        last = int(time() // 60)
+        while True:
+            sleep(60 - time() % 60 + 0.1)
+            self.reload()
+            minute = int(time() // 60)
+            for _ in range(max(last + 1, minute - 59), minute + 1):
+                for job in self.jobs:
+                    if job["cron"].match(_ * 60):
+                        self.start(job)
+            last = minute
 
-        # 强制转index列表
-        index_list = [index_list] if isinstance(index_list,
-                                                str) else index_list
 
-        # 存在快照名
-        if kwargs.get("snapshot_name", None):
-            _all_index_list = self.get_index_list()
-            post_body = Config.format_data(index_body, {
-                "index":
-                ",".join([_ for _ in index_list if _ in _all_index_list])
-            })
-            result = self.create_snapshot(snapshot_repository_name,
-                                          kwargs["snapshot_name"], post_body)
+def _endpoint(method, url):
+    '''
+    @description: 请求路径归类, index、快照名等替换为{}
+    '''
+    parts = []
+    for _ in url.split("?")[0].split("/"):
+        if not _:
+            continue
+        # _cat/_cluster/_nodes后为接口名
+        if _.startswith("_") or (parts and parts[-1] in
+                                 ["_cat", "_cluster", "_nodes"]):
+            parts.append(_)
         else:
-            if include_mode:
-                # 生成一个index任务
-                # 包含该关键字的所有索引
-                for _ in index_list:
-                    _index_list = self.get_index_list("{}*".format(_))
-                    if _index_list:
-                        post_body = Config.format_data(
-                            index_body, {"index": ",".join(_index_list)})
-                        result = self.create_snapshot(snapshot_repository_name,
-                                                      _, post_body)
-            else:
-                for _ in index_list:
-                    # 渲染
-                    post_body = Config.format_data(index_body, {"index": _})
-                    result = self.create_snapshot(snapshot_repository_name, _,
-                                                  post_body)
+            parts.append("{}")
+    return "{} /{}".format(method, "/".join(parts))
 
-        logger.info("S3快照任务执行完成")
 
-    def _exe_delete_index_job(self, index, save_day):
+# 第一次创建Es时才定义, 避免import时加载elasticsearch
+_metered_transport_class = None
+
+
+def _metered_transport():
+    '''
+    @description: 统计每个ES请求耗时的Transport
+    '''
+    global _metered_transport_class
+    if _metered_transport_class is None:
+        from elasticsearch import Transport
+
+        class MeteredTransport(Transport):
+            # 重试策略, 由Es设置
+            retry_policy = None
+
+            def perform_request(self, method, url, *args, **kwargs):
+                policy = self.retry_policy or RetryPolicy(max_retries=0)
+                return policy.call(self._perform_request, method, url, *args,
+                                   **kwargs)
+
+            def _perform_request(self, method, url, *args, **kwargs):
+                with metrics.timer("request", endpoint=_endpoint(method, url)):
+                    return super(MeteredTransport,
+                                 self).perform_request(method, url, *args,
+                                                       **kwargs)
+
+        _metered_transport_class = MeteredTransport
+    return _metered_transport_class
+
+
+class Es:
+    '''
+    @description: Elasticsearch客户端封装, 未定义的属性与方法交给elasticsearch客户端
+    '''
+
+    # 限速, 为None时不限制
+    throttle = None
+
+    def __init__(self, hosts=None, transport_class=None, retry=None, **kwargs):
         '''
-        @description:  执行删除index任务
-        @param {string}  index      索引名 
-        @param {int}     save_day   保存时间
-        @return: None
+        @param {list}  hosts  ES地址, 可为多个
+        @param {dict}  retry  重试策略参数, 见RetryPolicy
         '''
-        from time import localtime, strftime
-        index_create_date_list = self._get_index_create_data(index)
-        result = self._filter_index(index_create_date_list, int(save_day))
+        from elasticsearch import Elasticsearch
+        self.retry = retry if isinstance(retry, RetryPolicy) else RetryPolicy(
+            **(retry or {}))
+        if transport_class is None:
+            transport_class = _metered_transport()
+            # 由retry统一退避重试, transport失败后不立即重试
+            kwargs.setdefault("max_retries", 0)
+        # 创建客户端时sniff失败会直接抛出异常, 改为创建后按重试策略sniff
+        sniff_on_start = kwargs.pop("sniff_on_start", False)
+        self.client = Elasticsearch(hosts,
+                                    transport_class=transport_class,
+                                    **kwargs)
+        self.client.transport.retry_policy = self.retry
+        self._version = None
+        if sniff_on_start:
+            try:
+                self.retry.call(self.client.transport.sniff_hosts, True)
+            except es_exceptions.TransportError as e:
+                logger.warning("获取集群节点失败, 使用配置的节点: {}".format(e))
 
-        # 发现需要删除列表
-        if result:
-            if self.force:
-                for index_name, create_time in result.items():
-                    delete_index = self.es.delete_index(index_name)
-                    if delete_index:
-                        strTime = strftime("%Y年%m月%d日",
-                                           localtime(int(create_time[:10])))
-                        logger.debug("[*]index[{}]被删除,因该index创建于{}".format(
-                            index_name, strTime))
-                    else:
-                        logger.debug("[*]index[{}]删除失败".format(index_name))
-            else:
-                for index_name, create_time in result.items():
-                    strTime = strftime("%Y年%m月%d日",
-                                       localtime(int(create_time[:10])))
-                    logger.debug(
-                        "index[{}]需要被删除,因配置文件保留{}天,而该index创建于{}".format(
-                            index_name, save_day, strTime))
-                    yORn = raw_input("确定删除[{}]?  (y/n)".format(index_name))
-                    if yORn == "y" or yORn == "Y":
-                        delete_index = self.es.delete_index(index_name)
-                        if delete_index:
-                            logger.debug("[*]index[{}]已被删除".format(index_name))
-                        else:
-                            logger.debug("[*]index[{}]删除失败".format(index_name))
-                    else:
-                        logger.debug("取消删除[{}]任务.".format(index))
-        else:
-            logger.info("[{}]的删除任务执行完成.没发现需要删除的index.".format(index))
+    def __getattr__(self, name):
+        client = self.__dict__.get("client", None)
+        if client is None:
+            raise AttributeError(name)
+        return getattr(client, name)
 
-    def _filter_index(self, data, day):
+    def pace(self, kind=""):
         '''
-        @description: 过滤需要删除的index
-        @param {dict}  data   index与创建日期的字典
-        @param {int}   day    保留天数
-        @return: dict
+        @description: 重操作前调用, 按限速配置等待
         '''
-        from time import time
-        now_time = int(round(time() * 1000))
-        day_delta = int(day) * 86400000
-        last_time = now_time - day_delta
-        return dict(filter(lambda x: int(x[1]) < last_time, data.items()))
+        if self.throttle:
+            self.throttle.acquire(kind)
 
-    def _get_index_create_data(self, index):
+    # 新增获取index属性
+    def get_index_settings(self, index="", fields=None):
+        return self.transport.perform_request(
+            "GET",
+            "/{}*/_settings".format(index),
+            params=self._settings_params(fields))
+
+    def iter_index_settings(self, index="", fields=None):
         '''
-        @description: 获取index配置
-        @param {string} name  index前缀
+        @description: 逐个返回index的settings.index
+        @param {string}  index   index前缀
+        @param {list}    fields  只返回的settings.index字段, 为空时返回全部
+        @return: generator (index, dict)
         '''
-        settings_list = self.es.get_index_settings("{}*".format(index))
+        for name, value in self.iter_json("/{}*/_settings".format(index),
+                                          self._settings_params(fields)):
+            yield name, value.get("settings", {}).get("index", {})
+
+    @classmethod
+    def _settings_params(cls, fields=None):
+        if not fields:
+            return None
         return {
-            k: v["settings"]["index"]["creation_date"]
-            for k, v in settings_list.items() if settings_list
+            "filter_path":
+            ",".join(["*.settings.index.{}".format(_) for _ in fields])
         }
 
+    def iter_json(self, path, params=None, prefix=""):
+        '''
+        @description: GET请求并逐个返回prefix下对象的(key, value)
+                      安装ijson时边下载边解析, 否则整体加载
+        @param {string}  path    请求路径
+        @param {dict}    params  请求参数
+        @param {string}  prefix  对象路径, 如"metadata.indices"
+        @return: generator (key, value)
+        '''
+        response = None
+        if _optional_import("ijson"):
+            response = self._open_stream(path, params)
+        if response is not None:
+            from time import time
+            start = time()
+            status = "error"
+            try:
+                for _ in _iter_kvitems(response, prefix):
+                    yield _
+                status = "success"
+            except GeneratorExit:
+                # 调用方提前结束迭代
+                status = "success"
+                raise
+            finally:
+                response.release_conn()
+                metrics.observe("request",
+                                time() - start,
+                                endpoint=_endpoint("GET", path),
+                                status=status)
+            return
 
-class Cmd(Job):
-    def __init__(self, es, job, force=False):
-        self.es = es
-        self.force = force
-        self.job = job
+        result = self.transport.perform_request("GET", path, params=params)
+        for key in filter(None, prefix.split(".")):
+            result = result.get(key, {})
+        for _ in result.items():
+            yield _
 
-    def job_getReadOnly(self):
+    def iter_lines(self, path, params=None):
         '''
-        description: 获取只读
+        @description: GET请求并逐行返回文本结果, 如_cat接口, 不整体加载
+        @return: generator
         '''
-        from functools import partial
-        settings = self.es.get_index_settings()
+        response = self._open_stream(path, params)
+        if response is not None:
+            from time import time
+            start = time()
+            buffer = ""
+            status = "error"
+            try:
+                for chunk in response.stream(65536):
+                    lines = (buffer + chunk).split("\n")
+                    buffer = lines.pop()
+                    for _ in lines:
+                        yield _
+                if buffer:
+                    yield buffer
+                status = "success"
+            except GeneratorExit:
+                # 调用方提前结束迭代
+                status = "success"
+                raise
+            finally:
+                response.release_conn()
+                metrics.observe("request",
+                                time() - start,
+                                endpoint=_endpoint("GET", path),
+                                status=status)
+            return
 
-        frozen = lambda x: x["settings"]["index"].get("frozen", "false"
-                                                      ) == "true"
-        blocks_item = lambda i, x: x["settings"]["index"].get("blocks", {
-        }).get(i, "false") == "true"
-        write = partial(blocks_item, "write")
-        read_only = partial(blocks_item, "read_only")
+        result = self.transport.perform_request("GET", path, params=params)
+        for _ in (result or "").splitlines():
+            yield _
 
-        for i, v in settings.items():
-            item = dict(v)
-            if frozen(item):
-                logger.info("frozen index: {}".format(i))
+    def _open_stream(self, path, params=None):
+        '''
+        @description: 从transport的连接池发起GET, 返回未读取的响应
+                      与其他请求相同: 共用重试策略, 失败的节点标记不可用(开启sniff时重新获取节点)
+                      不支持流式读取或返回不可重试的错误状态时返回None, 交给transport处理
+        '''
+        from time import time
+        from urllib import urlencode
+        from urllib3.exceptions import ReadTimeoutError
 
-            if write(item):
-                logger.info("block write: {}".format(i))
+        def _open():
+            connection = self.transport.get_connection()
+            pool = getattr(connection, "pool", None)
+            if pool is None:
+                return None
+            url = connection.url_prefix + path
+            if params:
+                url = "{}?{}".format(url, urlencode(params))
+            start = time()
+            try:
+                response = pool.urlopen("GET",
+                                        url,
+                                        headers=connection.headers,
+                                        retries=False,
+                                        preload_content=False)
+                error = None
+                if response.status >= 300:
+                    response.release_conn()
+                    if response.status not in self.retry.retry_on_status:
+                        return None
+                    error = es_exceptions.TransportError(
+                        response.status, "流式请求[{}]返回{}".format(
+                            path, response.status))
+            except ReadTimeoutError as e:
+                error = es_exceptions.ConnectionTimeout("TIMEOUT", str(e), e)
+            except Exception as e:
+                error = es_exceptions.ConnectionError("N/A", str(e), e)
+            if error is None:
+                self.transport.connection_pool.mark_live(connection)
+                return response
+            metrics.observe("request",
+                            time() - start,
+                            endpoint=_endpoint("GET", path),
+                            status="error")
+            if self.retry.retryable(error):
+                try:
+                    self.transport.mark_dead(connection)
+                except es_exceptions.TransportError:
+                    # sniff失败不影响重试
+                    pass
+            raise error
 
-            if read_only(item):
-                logger.info("block read_only: {}".format(i))
+        return self.retry.call(_open)
 
-    def run(self):
-        job = self.get_job(self.job)
-        if job:
-            job()
+    # 集群版本
+    def get_version(self):
+        '''
+        @description: 主版本与次版本号, 只请求一次
+        @return: tuple, 如(7, 10)
+        '''
+        if self._version is None:
+            version = self.info()["version"]["number"]
+            self._version = tuple(
+                int(_) for _ in version.split("-")[0].split(".")[:2])
+        return self._version
+
+    # 仓库中的快照
+    def get_snapshot_list(self, repository):
+        '''
+        @description: 通过_cat/snapshots获取快照名、状态与开始时间, 不返回index列表
+        @param {string}  repository  仓库名
+        @return: list [{"id", "status", "start_epoch"}]
+        '''
+        try:
+            return self.cat.snapshots(repository=repository,
+                                      format="json",
+                                      h="id,status,start_epoch")
+        except es_exceptions.NotFoundError:
+            return []
+
+    def get_snapshot_names(self, repository):
+        '''
+        @description: 仓库中的快照名与状态
+        @return: dict {快照名: 状态}
+        '''
+        return {
+            _["id"]: _["status"]
+            for _ in self.get_snapshot_list(repository)
+        }
+
+    # 删除快照
+    def delete_snapshots(self, repository, snapshots, max_url_length=4000):
+        '''
+        @description: 删除快照, 7.8+逗号拼接批量删除, 之前的版本逐个删除
+        @param {string}  repository  仓库名
+        @param {list}    snapshots   快照名列表
+        @return: dict {快照名: True/False}
+        '''
+        if self.get_version() >= (7, 8):
+            batches = _chunk_index_names(snapshots, max_url_length)
         else:
-            logger.error("{}方法没有找到.".format(self.job))
+            batches = [[_] for _ in snapshots]
+        result = {}
+        for batch in batches:
+            try:
+                self.pace("snapshot_delete")
+                response = self.snapshot.delete(repository,
+                                                ",".join(batch),
+                                                request_timeout=3600)
+                success = bool(response.get("acknowledged", ""))
+            except es_exceptions.TransportError as e:
+                logger.error("仓库[{}]删除{}个快照失败,原因:{}".format(
+                    repository, len(batch), e))
+                success = False
+            for _ in batch:
+                logger.debug("仓库[{}]删除快照[{}]{}".format(
+                    repository, _, "成功" if success else "失败"))
+            result.update(dict.fromkeys(batch, success))
+        return result
+
+    # 快照包含的index
+    def get_snapshot_indices(self, repository, snapshots):
+        '''
+        @description: 按URL长度分批获取快照包含的index
+        @return: dict {快照名: [index]}
+        '''
+        result = {}
+        for batch in _chunk_index_names(snapshots):
+            response = self.snapshot.get(
+                repository=repository,
+                snapshot=",".join(batch),
+                filter_path="snapshots.snapshot,snapshots.indices")
+            for _ in response.get("snapshots", []):
+                result[_["snapshot"]] = _.get("indices", [])
+        return result
 
+    # 恢复进度
+    def _get_failed_primaries(self, indices):
+        '''
+        @description: 主分片分配失败(ALLOCATION_FAILED)的index
+        @return: set
+        '''
+        result = set()
+        for batch in _chunk_index_names(indices):
+            for line in self.iter_lines(
+                    "/_cat/shards/{}".format(",".join(batch)),
+                {"h": "index,prirep,state,unassigned.reason"}):
+                # 已分配的分片没有unassigned.reason
+                parts = line.split()
+                if len(parts) == 4 and parts[1] == "p" and parts[
+                        2] == "UNASSIGNED" and parts[3] == "ALLOCATION_FAILED":
+                    result.add(parts[0])
+        return result
 
-class Es(Elasticsearch):
-    '''
-    @description: 继承Elasticsearch 自定义封装
-    '''
+    def get_restore_state(self, indices):
+        '''
+        @description: 健康状态判断主分片是否恢复完成, _recovery统计从快照恢复的字节数
+                      恢复中副本与排队的主分片也是未分配状态, 只有主分片分配失败才算失败
+        @param {list}  indices  index名列表
+        @return: dict {index: {"status", "failed", "shards_done", "shards_total",
+                               "recovered", "total"}}
+        '''
+        result = {}
+        for batch in _chunk_index_names(indices):
+            expr = ",".join(batch)
+            # 还未创建的index不返回
+            health = self.cluster.health(index=expr,
+                                         level="indices",
+                                         ignore=[404, 408],
+                                         filter_path="indices.*.status")
+            for name, value in health.get("indices", {}).items():
+                result[name] = {
+                    "status": value.get("status"),
+                    "failed": False,
+                    "shards_done": 0,
+                    "shards_total": 0,
+                    "recovered": 0,
+                    "total": 0
+                }
+            red = [k for k, v in result.items() if k in batch and
+                   v["status"] == "red"]
+            for name in self._get_failed_primaries(red):
+                result[name]["failed"] = True
+            recovery = self.transport.perform_request(
+                "GET",
+                "/{}/_recovery".format(expr),
+                params={
+                    "ignore_unavailable":
+                    "true",
+                    "filter_path":
+                    ",".join([
+                        "*.shards.type", "*.shards.stage",
+                        "*.shards.index.size.total_in_bytes",
+                        "*.shards.index.size.recovered_in_bytes"
+                    ])
+                })
+            for name, value in recovery.items():
+                item = result.setdefault(name, {
+                    "status": None,
+                    "failed": False,
+                    "shards_done": 0,
+                    "shards_total": 0,
+                    "recovered": 0,
+                    "total": 0
+                })
+                for shard in value.get("shards", []):
+                    if shard.get("type") != "SNAPSHOT":
+                        continue
+                    size = shard.get("index", {}).get("size", {})
+                    item["shards_total"] += 1
+                    item["shards_done"] += shard.get("stage") == "DONE"
+                    item["recovered"] += size.get("recovered_in_bytes", 0)
+                    item["total"] += size.get("total_in_bytes", 0)
+        return result
 
-    # 新增获取index属性
-    def get_index_settings(self, index=""):
-        return self.transport.perform_request("GET",
-                                              "/{}*/_settings".format(index))
+    # 获取快照进度
+    def get_snapshot_status(self, repository, snapshots):
+        '''
+        @description: 一次请求获取多个快照的_status, 不存在的快照忽略
+        @param {string}  repository  仓库名
+        @param {list}    snapshots   快照名列表
+        @return: list
+        '''
+        try:
+            return self.snapshot.status(repository=repository,
+                                        snapshot=",".join(snapshots),
+                                        ignore_unavailable=True).get(
+                                            "snapshots", [])
+        except es_exceptions.NotFoundError:
+            return []
+
+    # index变更指纹
+    def get_index_fingerprint(self, indices):
+        '''
+        @description: 主分片max_seq_no之和与文档数, 写入、更新、删除都会改变
+        @param {list}  indices  index名列表
+        @return: dict {index: 指纹}
+        '''
+        result = {}
+        for batch in _chunk_index_names(indices):
+            stats = self.transport.perform_request(
+                "GET",
+                "/{}/_stats/docs".format(",".join(batch)),
+                params={
+                    "level":
+                    "shards",
+                    "filter_path":
+                    ",".join([
+                        "indices.*.primaries.docs",
+                        "indices.*.shards.*.routing.primary",
+                        "indices.*.shards.*.seq_no.max_seq_no",
+                    ])
+                })
+            for name, value in stats.get("indices", {}).items():
+                docs = value.get("primaries", {}).get("docs", {})
+                max_seq_no = sum([
+                    _.get("seq_no", {}).get("max_seq_no", 0)
+                    for copies in value.get("shards", {}).values()
+                    for _ in copies if _.get("routing", {}).get("primary")
+                ])
+                result[name] = "{}:{}:{}".format(max_seq_no,
+                                                 docs.get("count", 0),
+                                                 docs.get("deleted", 0))
+        return result
+
+    # 批量读取index配置
+    def get_indices_settings(self, indices, fields=None,
+                             expand_wildcards=None):
+        '''
+        @description: 按URL长度分批读取指定index的settings.index
+        @param {list}    indices           index名列表
+        @param {list}    fields            只返回的settings.index字段
+        @param {string}  expand_wildcards  通配符匹配的index状态, 如open
+        @return: dict {index: settings.index}
+        '''
+        params = self._settings_params(fields) or {}
+        if expand_wildcards:
+            params["expand_wildcards"] = expand_wildcards
+        result = {}
+        for batch in _chunk_index_names(indices):
+            for name, value in self.iter_json(
+                    "/{}/_settings".format(",".join(batch)), params or None):
+                result[name] = value.get("settings", {}).get("index", {})
+        return result
+
+    # 批量修改index配置
+    def put_indices_settings(self,
+                             indices,
+                             body,
+                             max_url_length=4000,
+                             expand_wildcards=None):
+        '''
+        @description: 逗号拼接批量修改index配置
+        @param {list}    indices           index名列表
+        @param {dict}    body              配置内容
+        @param {string}  expand_wildcards  通配符匹配的index状态, 默认open与closed
+        @return: dict {index: True/False}
+        '''
+        result = {}
+        for batch in _chunk_index_names(indices, max_url_length):
+            try:
+                self.pace("settings")
+                response = self.indices.put_settings(
+                    body,
+                    index=",".join(batch),
+                    expand_wildcards=expand_wildcards)
+                success = bool(response.get("acknowledged", ""))
+            except es_exceptions.TransportError as e:
+                logger.error("修改{}个index配置失败,原因:{}".format(len(batch), e))
+                success = False
+            result.update(dict.fromkeys(batch, success))
+        return result
+
+    # 批量冻结/解冻
+    def freeze_indices(self, indices, freeze=True, max_url_length=4000):
+        '''
+        @description: 逗号拼接批量冻结或解冻index
+        @param {list}  indices  index名列表
+        @param {bool}  freeze   True冻结, False解冻
+        @return: dict {index: True/False}
+        '''
+        action = self.indices.freeze if freeze else self.indices.unfreeze
+        result = {}
+        for batch in _chunk_index_names(indices, max_url_length):
+            try:
+                self.pace("settings")
+                response = action(index=",".join(batch))
+                success = bool(response.get("acknowledged", ""))
+            except es_exceptions.TransportError as e:
+                logger.error("{}{}个index失败,原因:{}".format(
+                    "冻结" if freeze else "解冻", len(batch), e))
+                success = False
+            result.update(dict.fromkeys(batch, success))
+        return result
+
+    # 合并状态
+    def get_merge_state(self, indices):
+        '''
+        @description: 每个index分片所在节点与单个分片的最大segment数
+        @param {list}  indices  index名列表
+        @return: dict {index: {"nodes": [节点id], "segments": int}}
+        '''
+        result = {}
+        for batch in _chunk_index_names(indices):
+            stats = self.transport.perform_request(
+                "GET",
+                "/{}/_stats/segments".format(",".join(batch)),
+                params={
+                    "level":
+                    "shards",
+                    "ignore_unavailable":
+                    "true",
+                    "filter_path":
+                    ",".join([
+                        "indices.*.shards.*.routing.node",
+                        "indices.*.shards.*.segments.count",
+                    ])
+                })
+            for name, value in stats.get("indices", {}).items():
+                copies = [
+                    _ for shard in value.get("shards", {}).values()
+                    for _ in shard
+                ]
+                result[name] = {
+                    "nodes":
+                    sorted(
+                        set(_.get("routing", {}).get("node") for _ in copies
+                            if _.get("routing", {}).get("node"))),
+                    "segments":
+                    max([_.get("segments", {}).get("count", 0)
+                         for _ in copies] or [0])
+                }
+        return result
 
     # 删除index
     def delete_index(self, index):
@@ -601,6 +4516,7 @@ class Es(Elasticsearch):
         @return: True/False
         '''
         try:
+            self.pace("delete")
             result = self.indices.delete(index=index, ignore=[400, 404])
             if result.get("acknowledged", ""):
                 logger.debug("删除[{}]成功".format(index))
@@ -613,6 +4529,199 @@ class Es(Elasticsearch):
                 index, e))
             return False
 
+    # 批量删除index
+    def delete_indices(self, indices, max_url_length=4000, workers=1):
+        '''
+        @description: 逗号拼接批量删除index, 按URL长度切分批次
+        @param {list}    indices         index名列表
+        @param {int}     max_url_length  单批拼接长度上限
+        @param {int}     workers         并发线程数
+        @return: dict  {index: True/False}
+        '''
+        def _delete_batch(batch):
+            with metrics.timer("delete_batch"):
+                return _delete(batch)
+
+        def _delete(batch):
+            if len(batch) == 1:
+                return {batch[0]: self.delete_index(batch[0])}
+            try:
+                self.pace("delete")
+                result = self.indices.delete(index=",".join(batch),
+                                             ignore=[400, 404])
+                if result.get("acknowledged", ""):
+                    for _ in batch:
+                        logger.debug("删除[{}]成功".format(_))
+                    return dict.fromkeys(batch, True)
+                logger.debug("批量删除{}个index失败,返回:{}, 改为逐个删除".format(
+                    len(batch), str(result)))
+            except Exception as e:
+                logger.error(
+                    "function (delete_indices)批量删除{}个index失败,原因:{}, 改为逐个删除".
+                    format(len(batch), e))
+            # 整批失败时(如其中某个index已不存在), 逐个删除确认结果
+            return {_: self.delete_index(_) for _ in batch}
+
+        result = {}
+        batches = list(_chunk_index_names(indices, max_url_length))
+        for _ in _thread_map(_delete_batch, batches, workers):
+            result.update(_)
+        return result
+
+
+def _connect(url, options=None, **kwargs):
+    '''
+    @description: 创建Es客户端
+    @param {string/list}  url      ES地址, 多个节点时为列表或逗号分隔
+    @param {dict}         options  elasticsearch配置, 见_connection_options
+    '''
+    # 默认请求超时30秒, elasticsearch.timeout可覆盖
+    kwargs.setdefault("timeout", 30)
+    kwargs.update(_connection_options(options))
+    return Es(_es_hosts(url), **kwargs)
+
+
+def _es_hosts(url):
+    '''
+    @description: ES地址转为节点列表
+    '''
+    if isinstance(url, basestring):
+        return [_.strip() for _ in url.split(",") if _.strip()]
+    return list(url) if url else None
+
+
+def _connection_options(options=None):
+    '''
+    @description: elasticsearch配置转为客户端参数
+    @param {dict}  options  maxsize: 每个节点保持的keep-alive连接数
+                            timeout: 请求超时秒数
+                            sniff: 启动时与连接失败时获取集群节点, 请求分散到所有节点
+                            sniff_interval: 定时刷新节点的秒数, 默认300
+                            http_compress: gzip压缩请求与响应
+                            retry: 重试策略, 见RetryPolicy
+    @return: dict
+    '''
+    options = options or {}
+    kwargs = {}
+    if options.get("maxsize", None):
+        kwargs["maxsize"] = int(options["maxsize"])
+    if options.get("timeout", None):
+        kwargs["timeout"] = float(options["timeout"])
+    if options.get("sniff", False):
+        kwargs.update({
+            "sniff_on_start": True,
+            "sniff_on_connection_fail": True,
+            "sniffer_timeout": int(options.get("sniff_interval", 300)),
+            "sniff_timeout": float(options.get("sniff_timeout", 10)),
+        })
+    if options.get("http_compress", False):
+        kwargs["http_compress"] = True
+    if options.get("retry", None):
+        kwargs["retry"] = dict(options["retry"])
+    return kwargs
+
+
+def _run_playbook(config, book_config, force, connect, resume=False):
+    '''
+    @description: 在配置的集群上执行playbook
+    @param {Config}    config       已渲染env的配置
+    @param {list}      book_config  未渲染的playbook
+    @param {bool}      force        强制模式
+    @param {function}  connect      connect(url, elasticsearch配置)返回Es
+    @param {bool}      resume       跳过运行日志中已完成的操作
+    @return: 单集群为任务结果列表, 多集群为汇总结果
+    '''
+    # mapping格式化后
+    book_config = Config.format_data(book_config, config.env)
+
+    # 多集群
+    es_settings = config.data["elasticsearch"]
+    if es_settings.get("clusters", None):
+
+        def _run(cluster):
+            settings = dict(config.data)
+            settings.update(cluster.get("settings", None) or {})
+            return PlayBook(book_config, settings,
+                            connect(cluster["url"], es_settings), force,
+                            resume).run()
+
+        # 需要逐个确认时不能并发
+        concurrency = es_settings.get("concurrency", 4) if force else 1
+        return Fleet(es_settings["clusters"], concurrency).run(_run)
+
+    # 加载playbook
+    playbook = PlayBook(book_config, config.data,
+                        connect(es_settings["url"], es_settings), force,
+                        resume)
+    return playbook.run()
+
+
+def run_playbook(playbook, config=None, es=None, force=True, resume=False):
+    '''
+    @description: 以库的方式执行playbook
+    @param {list/string}  playbook  playbook任务列表, 或yaml文件路径
+    @param {dict/string}  config    配置内容(elasticsearch/env/snapshot等), 或yaml文件路径
+    @param {Es/string}    es        Es实例或ES地址, 指定时不使用config中的elasticsearch
+    @param {bool}         force     强制模式, 库调用时无法逐个确认, 默认True
+    @param {bool}         resume    跳过运行日志中已完成的操作
+    @return: list 单集群为[{name, job, status, elapsed, result}],
+                  多集群为[{cluster, status, elapsed, result}]
+    '''
+    from copy import deepcopy
+    if isinstance(playbook, basestring):
+        playbook = Config.read(playbook)
+    if isinstance(config, basestring):
+        config = Config(config)
+    else:
+        # 渲染env时会修改配置, 不影响调用方的数据
+        config = Config(None, data=deepcopy(config or {}))
+
+    if es is None:
+        return _run_playbook(
+            config, playbook, force, _connect, resume)
+    if isinstance(es, basestring):
+        es = _connect(es, config.data.get("elasticsearch", None))
+    return PlayBook(Config.format_data(playbook, config.env), config.data, es,
+                    force, resume).run()
+
+
+def run_cmd(job, es, options=None, force=True):
+    '''
+    @description: 以库的方式执行cmd
+    @param {string}     job      cmd方法名, 如getReadOnly
+    @param {Es/string}  es       Es实例或ES地址
+    @param {dict}       options  cmd参数, 同-o
+    @return: cmd方法的返回
+    '''
+    if isinstance(es, basestring):
+        es = _connect(es)
+    return Cmd(es, job, force, options).run()
+
+
+def _parse_options(options):
+    '''
+    @description: 解析-o key=value参数
+    @return: dict
+    '''
+    result = {}
+    for _ in options or []:
+        key, sep, value = _.partition("=")
+        if not sep:
+            logger.error("参数[{}]格式错误, 应为key=value".format(_))
+            continue
+        result[key.strip()] = yaml.safe_load(value) if value else ""
+    return result
+
+
+def _write_report(path, report):
+    '''
+    @description: 汇总结果写入json文件
+    '''
+    import json
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
+    logger.info("汇总结果已写入[{}]".format(path))
+
 
 def main(args):
     '''
@@ -620,38 +4729,94 @@ def main(args):
     @param {dict} args 传入的参数 
     '''
 
+    _init_logging(args.v, args.q)
+
     # 强制模式
     force = args.force
 
+    use_engine(args.engine)
+
     if args.mode == "playbook":
         if not args.playbook:
             logger.error("[playbook]模式, [--playbook]不能为空")
             return
         # 实例化Config
-        c = Config(args.c)
-
-        # ES配置
-        ES_URL = c.data["elasticsearch"]["url"]
-        ES = Es(ES_URL, request_timeout=30)
+        c = Config(args.c or "config.yaml")
 
         # 源数据
         book_config_source = Config.read(args.playbook)
 
-        # mapping格式化后
-        book_config = Config.format_data(book_config_source, c.env)
+        result = _run_playbook(
+            c, book_config_source, force, _connect, args.resume)
+        if args.report and c.data["elasticsearch"].get("clusters", None):
+            _write_report(args.report, result)
+        return result
 
-        # 加载playbook
-        playbook = PlayBook(book_config, c.data, ES, force)
-        playbook.run()
+    if args.mode == "daemon":
+        # 常驻运行时无法逐个确认
+        if not force:
+            logger.error("[daemon]模式需要[--force]")
+            return
+        Daemon(args.c or "config.yaml", args.metrics_json,
+               args.metrics_prom).run()
+        return
 
     if args.mode == "cmd":
-        if not args.s:
-            logger.error("[cmd]模式, [-s]不能为空")
-            return
-        ES = Es(args.s)
-        cmd = Cmd(ES, args.cmd)
-        cmd.run()
+        concurrency = 4
+        es_settings = {}
+        if args.s:
+            clusters = [{"name": _, "url": _} for _ in args.s]
+        elif args.c:
+            # 没有指定-s时使用-c指定的配置文件中的集群, 会执行其中的env
+            es_settings = Config(args.c).data["elasticsearch"]
+            clusters = es_settings.get("clusters", None) or [{
+                "name": ",".join(_es_hosts(es_settings["url"])),
+                "url": es_settings["url"]
+            }]
+            concurrency = es_settings.get("concurrency", concurrency)
+        else:
+            clusters = [{"name": "local", "url": "http://127.0.0.1:9200"}]
+
+        options = _parse_options(args.o)
+        if len(clusters) == 1:
+            ES = _connect(clusters[0]["url"], es_settings)
+            cmd = Cmd(ES, args.cmd, force, options)
+            return cmd.run()
+
+        # 需要逐个确认时不能并发
+        concurrency = concurrency if force else 1
+        report = Fleet(clusters, concurrency).run(lambda cluster: Cmd(
+            _connect(cluster["url"], es_settings), args.cmd, force, options).
+                                                  run())
+        if args.report:
+            _write_report(args.report, report)
+        return report
+
+
+def _has_failure(result):
+    '''
+    @description: playbook任务或集群存在失败、超时、跳过
+    @param {list}  result  任务结果列表或多集群汇总结果
+    '''
+    if not isinstance(result, list):
+        return False
+    for _ in result:
+        if not isinstance(_, dict) or "status" not in _:
+            continue
+        if _["status"] != "success":
+            return True
+        if "cluster" in _ and _has_failure(_.get("result", None)):
+            return True
+    return False
 
 
 if __name__ == "__main__":
-    main(args)
+    args = _parse_args()
+    try:
+        result = main(args)
+    finally:
+        metrics.export(args.metrics_json, args.metrics_prom)
+    # 有任务未成功时返回非0, 便于cron发现
+    if _has_failure(result):
+        import sys
+        sys.exit(1)
@@ -0,0 +1,45 @@
+# coding: utf-8
+'''
+@message: 测试公共fixture, 在benchmark/fake_es.py模拟的ES上执行
+'''
+import os
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(HERE, ".."), os.path.join(HERE, "..", "benchmark")]
+
+import esTools  # noqa: E402
+from fake_es import FakeCluster, FakeServer  # noqa: E402
+
+
+def pytest_configure(config):
+    # elasticsearch-py调用urllib3已弃用的接口
+    config.addinivalue_line("filterwarnings",
+                            "ignore::DeprecationWarning:elasticsearch")
+
+
+@pytest.fixture
+def cluster():
+    return FakeCluster(100, snapshot_seconds=0.1)
+
+
+@pytest.fixture
+def server(cluster):
+    server = FakeServer(cluster).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def es(server):
+    return esTools.Es(server.url)
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    esTools.metrics.reset()
+    yield
+    esTools.metrics.reset()
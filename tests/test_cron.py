@@ -0,0 +1,62 @@
+# coding: utf-8
+import time
+
+import pytest
+
+import esTools
+
+
+def _at(year, month, day, hour=0, minute=0):
+    return time.mktime((year, month, day, hour, minute, 0, 0, 0, -1))
+
+
+def test_parse_fields():
+    cron = esTools.CronSchedule("*/15 1,3 10-12 * 1-5/2")
+    assert cron.values[0] == {0, 15, 30, 45}
+    assert cron.values[1] == {1, 3}
+    assert cron.values[2] == {10, 11, 12}
+    assert cron.values[3] == set(range(1, 13))
+    assert cron.values[4] == {1, 3, 5}
+
+
+def test_step_from_value_runs_to_max():
+    assert esTools.CronSchedule("50/5 * * * *").values[0] == {50, 55}
+
+
+@pytest.mark.parametrize("expr", [
+    "* * * *", "* * * * * *", "60 * * * *", "* 24 * * *", "* * 0 * *",
+    "* * * 13 *", "* * * * 8", "5-1 * * * *", "*/0 * * * *", "a * * * *"
+])
+def test_invalid(expr):
+    with pytest.raises(ValueError):
+        esTools.CronSchedule(expr)
+
+
+def test_sunday_as_0_or_7():
+    # 2024-06-02为周日
+    sunday = _at(2024, 6, 2, 3, 0)
+    assert esTools.CronSchedule("0 3 * * 0").match(sunday)
+    assert esTools.CronSchedule("0 3 * * 7").match(sunday)
+    assert not esTools.CronSchedule("0 3 * * 1").match(sunday)
+
+
+def test_match_minute_and_hour():
+    cron = esTools.CronSchedule("30 2 * * *")
+    assert cron.match(_at(2024, 6, 3, 2, 30))
+    assert not cron.match(_at(2024, 6, 3, 2, 31))
+    assert not cron.match(_at(2024, 6, 3, 3, 30))
+
+
+def test_day_or_weekday_when_both_restricted():
+    # 每月1号或每周一
+    cron = esTools.CronSchedule("0 0 1 * 1")
+    assert cron.match(_at(2024, 6, 1))  # 周六, 1号
+    assert cron.match(_at(2024, 6, 3))  # 周一
+    assert not cron.match(_at(2024, 6, 4))
+
+
+def test_day_and_weekday_when_one_is_any():
+    cron = esTools.CronSchedule("0 0 1 6 *")
+    assert cron.match(_at(2024, 6, 1))
+    assert not cron.match(_at(2024, 6, 3))
+    assert not cron.match(_at(2024, 7, 1))
@@ -0,0 +1,78 @@
+# coding: utf-8
+import time
+
+import esTools
+
+
+def _run(jobs, runner, **kwargs):
+    result = esTools.JobExecutor(jobs, runner, **kwargs).run()
+    return [(_["name"], _["status"]) for _ in result]
+
+
+def _runner(config):
+    if config["job"] == "boom":
+        raise ValueError("boom")
+    if config["job"] == "exit":
+        raise SystemExit(1)
+    if config["job"] == "hang":
+        esTools._job_sleep(30)
+    if config["job"] == "hang_pool":
+        esTools._thread_map(lambda _: esTools._job_sleep(30), range(3), 3)
+    return config["job"]
+
+
+def test_undeclared_jobs_depend_on_previous():
+    assert _run([{"job": "boom"}, {"job": "delete"}], _runner) == [
+        ("boom-0", "failed"), ("delete-1", "skipped")]
+
+
+def test_empty_depends_on_opts_out():
+    assert _run([{"job": "boom"}, {"job": "delete", "depends_on": []}],
+                _runner) == [("boom-0", "failed"), ("delete-1", "success")]
+
+
+def test_group_runs_in_order_and_skips_after_failure():
+    jobs = [{"job": "boom", "group": "a"}, {"job": "x", "group": "b"},
+            {"job": "y", "group": "a"}]
+    assert _run(jobs, _runner, workers=2) == [
+        ("boom-0", "failed"), ("x-1", "success"), ("y-2", "skipped")]
+
+
+def test_missing_and_circular_dependencies_are_skipped():
+    jobs = [{"job": "a", "name": "a", "depends_on": ["nope"]},
+            {"job": "b", "name": "b", "depends_on": ["c"]},
+            {"job": "c", "name": "c", "depends_on": ["b"]}]
+    assert _run(jobs, _runner, workers=2) == [
+        ("a", "skipped"), ("b", "skipped"), ("c", "skipped")]
+
+
+def test_timeout_cancels_job_and_skips_dependents():
+    start = time.time()
+    jobs = [{"job": "hang", "timeout": 0.5}, {"job": "after"}]
+    assert _run(jobs, _runner) == [("hang-0", "timeout"),
+                                    ("after-1", "skipped")]
+    # 取消后不再等待30秒
+    assert time.time() - start < 5
+
+
+def test_timeout_cancels_pool_workers():
+    start = time.time()
+    assert _run([{"job": "hang_pool", "timeout": 0.5}], _runner) == [
+        ("hang_pool-0", "timeout")]
+    assert time.time() - start < 5
+
+
+def test_base_exception_still_reports_result():
+    jobs = [{"job": "exit"}, {"job": "after", "depends_on": []}]
+    assert _run(jobs, _runner) == [("exit-0", "failed"),
+                                    ("after-1", "success")]
+
+
+def test_has_failure():
+    ok = [{"name": "a", "job": "a", "status": "success"}]
+    assert not esTools._has_failure(ok)
+    assert esTools._has_failure([{"name": "a", "job": "a",
+                                  "status": "timeout"}])
+    assert esTools._has_failure([{
+        "cluster": "c", "status": "success",
+        "result": [{"job": "a", "status": "skipped"}]}])
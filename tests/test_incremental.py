@@ -0,0 +1,71 @@
+# coding: utf-8
+import esTools
+
+FAMILIES = ["logstash-family001", "logstash-family002"]
+
+
+def _settings(tmpdir, repository):
+    return {
+        "snapshot": {"repository": repository, "body": {"type": "fs"}},
+        "state": {"path": str(tmpdir.join("state.db"))},
+        "journal": {"enabled": False},
+    }
+
+
+def _backup(es, tmpdir, repository):
+    book = [{
+        "job": "backup",
+        "index": list(FAMILIES),
+        "include_mode": True,
+        "incremental": True,
+        "concurrency": 2,
+        "min_sleep": 0.1,
+        "body": {"indices": "{index}"},
+    }]
+    return esTools.PlayBook(book, _settings(tmpdir, repository), es,
+                            True).run()[0]["result"]
+
+
+def _family(cluster, family):
+    return sorted(_ for _ in cluster.indices if _.startswith(family))
+
+
+def test_unchanged_indices_are_skipped(es, cluster, tmpdir):
+    assert _backup(es, tmpdir, "r1") == dict.fromkeys(FAMILIES, "SUCCESS")
+    assert _backup(es, tmpdir, "r2") == dict.fromkeys(FAMILIES, "UNCHANGED")
+    assert not cluster.repositories["r2"]["snapshots"]
+
+
+def test_only_changed_indices_are_snapshotted(es, cluster, tmpdir):
+    _backup(es, tmpdir, "r1")
+    changed = _family(cluster, "logstash-family001")[-1]
+    cluster.indices[changed]["docs"] += 5
+    assert _backup(es, tmpdir, "r2") == {
+        "logstash-family001": "SUCCESS",
+        "logstash-family002": "UNCHANGED"
+    }
+    snapshot = cluster.repositories["r2"]["snapshots"]["logstash-family001"]
+    assert snapshot["indices"] == [changed]
+
+
+def test_deleted_snapshot_is_treated_as_changed(es, cluster, tmpdir):
+    _backup(es, tmpdir, "r1")
+    cluster.repositories["r1"]["snapshots"].pop("logstash-family001")
+    assert _backup(es, tmpdir, "r2") == {
+        "logstash-family001": "SUCCESS",
+        "logstash-family002": "UNCHANGED"
+    }
+    snapshot = cluster.repositories["r2"]["snapshots"]["logstash-family001"]
+    assert snapshot["indices"] == _family(cluster, "logstash-family001")
+
+
+def test_backup_state_discard(tmpdir):
+    state = esTools.BackupState(str(tmpdir.join("state.db")))
+    state.set("c", [("u1", "i1", "f1", "r1", "s1"),
+                    ("u2", "i2", "f2", "r1", "s2"),
+                    ("u3", "i3", "f3", "r2", "s3")])
+    state.discard("c", "r1", ["s1"])
+    assert sorted(state.get("c", ["u1", "u2", "u3"])) == ["u2", "u3"]
+    state.discard("c", "r2")
+    assert sorted(state.get("c", ["u1", "u2", "u3"])) == ["u2"]
+    assert state.references("c") == {("r1", "s2"): ["i2"]}
@@ -0,0 +1,104 @@
+# coding: utf-8
+import os
+
+import esTools
+
+from test_incremental import FAMILIES
+
+
+def _journal(tmpdir, resume=False):
+    return esTools.Journal(str(tmpdir.join("run.journal")), resume)
+
+
+def test_resume_restores_records(tmpdir):
+    journal = _journal(tmpdir)
+    journal.record("delete", ["a", "b"], "deleted")
+    journal.record("snapshot", "r1/a", "STARTED")
+    journal.record("snapshot", "r1/a", "SUCCESS")
+    journal.close()
+
+    journal = _journal(tmpdir, resume=True)
+    assert journal.get("delete", "a") == "deleted"
+    assert journal.get("delete", "b") == "deleted"
+    assert journal.get("snapshot", "r1/a") == "SUCCESS"
+    assert journal.get("snapshot", "r1/b") is None
+    journal.close()
+
+
+def test_without_resume_starts_empty(tmpdir):
+    journal = _journal(tmpdir)
+    journal.record("delete", "a", "deleted")
+    journal.close()
+
+    journal = _journal(tmpdir)
+    assert journal.get("delete", "a") is None
+    journal.close()
+    assert tmpdir.join("run.journal").read() == ""
+
+
+def test_empty_keys_are_not_recorded(tmpdir):
+    journal = _journal(tmpdir)
+    journal.record("delete", [], "deleted")
+    journal.close()
+    assert tmpdir.join("run.journal").read() == ""
+
+
+def test_truncated_last_line_is_ignored(tmpdir):
+    journal = _journal(tmpdir)
+    journal.record("delete", "a", "deleted")
+    journal.close()
+    # 模拟写到一半时中断
+    with open(journal.path, "a") as f:
+        f.write('{"kind": "delete", "keys": ["b"')
+
+    journal = _journal(tmpdir, resume=True)
+    assert journal.get("delete", "b") is None
+    journal.record("delete", "c", "deleted")
+    journal.close()
+
+    journal = _journal(tmpdir, resume=True)
+    assert journal.get("delete", "a") == "deleted"
+    assert journal.get("delete", "c") == "deleted"
+    journal.close()
+
+
+def test_unfinished_snapshots(tmpdir):
+    journal = _journal(tmpdir)
+    journal.record("snapshot", ["r1/a", "r1/b"], "STARTED")
+    journal.record("snapshot", "r1/a", "SUCCESS")
+    journal.record("snapshot", "r1/c", "FAILED")
+    journal.record("delete", "d", "deleted")
+    assert journal.unfinished() == ["r1/b", "r1/c"]
+    journal.close()
+
+
+def test_close_remove(tmpdir):
+    journal = _journal(tmpdir)
+    journal.record("delete", "a", "deleted")
+    journal.close(remove=True)
+    assert not os.path.exists(journal.path)
+
+
+def test_playbook_resume_skips_finished_snapshots(es, cluster, tmpdir):
+    book = [{
+        "job": "backup",
+        "index": list(FAMILIES),
+        "include_mode": True,
+        "min_sleep": 0.1,
+        "body": {"indices": "{index}"},
+    }]
+    settings = {
+        "snapshot": {"repository": "r1", "body": {"type": "fs"}},
+        "journal": {"path": str(tmpdir)},
+    }
+    playbook = esTools.PlayBook(book, settings, es, True, resume=True)
+    journal = playbook._open_journal()
+    journal.record("snapshot", "r1/logstash-family001", "SUCCESS")
+    journal.close()
+
+    result = playbook.run()[0]["result"]
+    assert result == dict.fromkeys(FAMILIES, "SUCCESS")
+    assert list(cluster.repositories["r1"]["snapshots"]) == [
+        "logstash-family002"]
+    # 全部成功后删除运行日志
+    assert not os.path.exists(journal.path)
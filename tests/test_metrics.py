@@ -0,0 +1,112 @@
+# coding: utf-8
+import json
+
+import pytest
+
+import esTools
+
+
+def _families(text):
+    '''
+    @return: [(family, type, [样本行])], 按出现顺序
+    '''
+    result = []
+    for line in text.splitlines():
+        if line.startswith("# TYPE "):
+            _, _, name, kind = line.split()
+            result.append((name, kind, []))
+        elif line and not line.startswith("#"):
+            result[-1][2].append(line)
+    return result
+
+
+def test_timer_records_success_and_error():
+    metrics = esTools.Metrics()
+    with metrics.timer("job", job="a"):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.timer("job", job="a"):
+            raise ValueError()
+    labels = sorted(
+        (_["labels"]["status"], _["count"])
+        for _ in metrics.summary()["metrics"])
+    assert labels == [("error", 1), ("success", 1)]
+
+
+def test_prometheus_families_are_contiguous():
+    metrics = esTools.Metrics()
+    metrics.observe("snapshot", 1.5, status="SUCCESS")
+    metrics.observe("request", 0.1, endpoint="GET /_cat", status="success")
+    metrics.observe("snapshot", 2.0, status="FAILED")
+    metrics.observe("snapshot", 0.5, status="SUCCESS")
+    families = _families(metrics.prometheus())
+    names = [_[0] for _ in families]
+    # 每个family只出现一次
+    assert len(names) == len(set(names))
+    for name, kind, samples in families:
+        assert samples
+        for line in samples:
+            sample = line.split("{")[0].split(" ")[0]
+            if kind == "summary":
+                assert sample in [name + "_count", name + "_sum"]
+            else:
+                assert sample == name
+    snapshot = dict((_[0], _) for _ in families)
+    assert snapshot["estools_snapshot_seconds"][1] == "summary"
+    assert snapshot["estools_snapshot_seconds_max"][1] == "gauge"
+    assert 'estools_snapshot_seconds_count{status="SUCCESS"} 2' in \
+        snapshot["estools_snapshot_seconds"][2]
+    assert 'estools_snapshot_seconds_max{status="SUCCESS"} 1.500000' in \
+        snapshot["estools_snapshot_seconds_max"][2]
+
+
+def test_prometheus_escapes_label_values():
+    metrics = esTools.Metrics()
+    metrics.observe("request", 0.1, endpoint='a"b\\c', status="success")
+    assert 'endpoint="a\\"b\\\\c"' in metrics.prometheus()
+
+
+def test_fleet_adds_cluster_label():
+    def _observe(cluster):
+        esTools.metrics.observe("job", 1, status="success")
+        return {}
+
+    esTools.Fleet([{"name": "a", "url": "http://a:9200"},
+                   {"name": "b", "url": "http://b:9200"}], 2).run(_observe)
+    esTools.metrics.observe("job", 1, status="success")
+    clusters = sorted(_["labels"].get("cluster", "")
+                      for _ in esTools.metrics.summary()["metrics"])
+    assert clusters == ["", "a", "b"]
+
+
+class _BrokenResponse:
+    def stream(self, size):
+        yield "a\nb"
+        raise IOError("connection reset")
+
+    def release_conn(self):
+        pass
+
+
+def test_stream_error_is_recorded(es, monkeypatch):
+    assert len(list(es.iter_lines("/_cat/indices"))) == 100
+    monkeypatch.setattr(es, "_open_stream",
+                        lambda *args: _BrokenResponse())
+    with pytest.raises(IOError):
+        list(es.iter_lines("/_cat/indices"))
+    # 调用方提前结束不算失败
+    next(es.iter_lines("/_cat/indices"))
+    status = sorted((_["labels"]["status"], _["count"])
+                    for _ in esTools.metrics.summary()["metrics"]
+                    if _["name"] == "request")
+    assert status == [("error", 1), ("success", 2)]
+
+
+def test_export(tmpdir):
+    metrics = esTools.Metrics()
+    metrics.observe("job", 1, status="success")
+    json_path, prom_path = str(tmpdir.join("m.json")), str(
+        tmpdir.join("m.prom"))
+    metrics.export(json_path, prom_path)
+    assert json.load(open(json_path))["metrics"][0]["count"] == 1
+    assert "estools_job_seconds_count" in open(prom_path).read()
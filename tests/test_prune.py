@@ -0,0 +1,93 @@
+# coding: utf-8
+import time
+
+import esTools
+
+from test_incremental import _backup, _family, _settings
+
+DAY = 86400
+
+
+def _snapshots(*ages, **kwargs):
+    '''
+    @param {list}  ages  快照开始时间距今的天数
+    '''
+    now = int(time.time())
+    return [{
+        "id": "s{}".format(i),
+        "status": kwargs.get("status", "SUCCESS"),
+        "start_epoch": str(now - age * DAY)
+    } for i, age in enumerate(ages)]
+
+
+def _plan(listing, config, snapshot="*", protected=None):
+    playbook = esTools.PlayBook([], {"snapshot": {"repository": "current"}})
+    return playbook._prune_plan(listing, snapshot, config, protected)
+
+
+def test_save_and_min_keep():
+    listing = {"r": _snapshots(40, 35, 31, 2)}
+    assert _plan(listing, {"save": 30}) == {
+        "r": {"snapshots": ["s0", "s1", "s2"], "remove": False}}
+    # 至少保留最新的3个
+    assert _plan(listing, {"save": 30, "min_keep": 3}) == {
+        "r": {"snapshots": ["s0"], "remove": False}}
+
+
+def test_keep_count_and_pattern():
+    listing = {"r": _snapshots(4, 3, 2, 1)}
+    assert _plan(listing, {"keep": 2}) == {
+        "r": {"snapshots": ["s0", "s1"], "remove": False}}
+    assert _plan(listing, {"keep": 1}, snapshot="s0,s3") == {
+        "r": {"snapshots": ["s0"], "remove": False}}
+
+
+def test_in_progress_snapshots_are_kept():
+    listing = {"r": _snapshots(40, status="IN_PROGRESS")}
+    assert _plan(listing, {"save": 1}) == {}
+
+
+def test_keep_repositories_never_removes_current():
+    listing = {
+        "old": _snapshots(10),
+        "current": _snapshots(20),
+        "new": _snapshots(1),
+    }
+    assert _plan(listing, {"keep_repositories": 1}) == {
+        "old": {"snapshots": ["s0"], "remove": True}}
+
+
+def test_remove_empty():
+    listing = {"r": _snapshots(40), "current": _snapshots(40)}
+    assert _plan(listing, {"save": 30, "remove_empty": True}) == {
+        "r": {"snapshots": ["s0"], "remove": True},
+        "current": {"snapshots": ["s0"], "remove": False},
+    }
+
+
+def test_protected_snapshots_are_kept():
+    listing = {"old": _snapshots(10, 9), "new": _snapshots(1)}
+    plan = _plan(listing, {"keep_repositories": 1},
+                 protected={("old", "s1"): ["index-a"]})
+    # 仓库中还有被依赖的快照时不删除仓库
+    assert plan == {"old": {"snapshots": ["s0"], "remove": False}}
+
+
+def test_prune_keeps_incremental_references(es, cluster, tmpdir):
+    _backup(es, tmpdir, "r1")
+    for _ in _family(cluster, "logstash-family002"):
+        cluster.indices[_]["docs"] += 1
+    time.sleep(1.1)
+    _backup(es, tmpdir, "r2")
+    book = [{"job": "prune", "repository": "r*", "keep_repositories": 1}]
+    result = esTools.PlayBook(book, _settings(tmpdir, "r2"), es,
+                              True).run()[0]["result"]
+    # family001未变更, 仍依赖r1中的快照
+    assert result == {"r1": {"snapshots": {"logstash-family002": True},
+                             "remove": None}}
+    assert sorted(cluster.repositories["r1"]["snapshots"]) == [
+        "logstash-family001"]
+    assert _backup(es, tmpdir, "r3") == {
+        "logstash-family001": "UNCHANGED",
+        "logstash-family002": "UNCHANGED"
+    }